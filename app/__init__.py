@@ -15,6 +15,16 @@ def init_logger():
     logging.basicConfig(level=level)
 
 
+def create_redis():
+    import redis
+    from app.config import Redis
+    return redis.Redis(host=Redis.REDIS_HOST,
+                       port=Redis.REDIS_PORT,
+                       db=Redis.REDIS_DB,
+                       password=Redis.REDIS_PWD
+                       )
+
+
 def create_app():
     # 避免循环导入
     from app.config import AppConfig, BaseConfig
@@ -31,6 +41,7 @@ def create_app():
 
     # 加载配置
     application.config.from_object(AppConfig)
+    application.config["SESSION_REDIS"] = create_redis()
     # 注册蓝图
     application.register_blueprint(bp_service)
 
@@ -54,7 +65,7 @@ def init_env(application):
     首次启动时初始化环境
     :return:
     """
-    from app.config import BaseConfig, Default, AppConfig
+    from app.config import BaseConfig, Default
     from app.extensions import db
     from app.models.models import User, Role
 
@@ -100,6 +111,87 @@ def init_env(application):
         sys.exit(-1)
 
 
+def init_gallery(application):
+    """
+    启动时加载内存特征库
+    :return:
+    """
+    from app.config import BaseConfig
+    from app.facelib.face_recogni import FaceRecogni
+    from app.facelib.gallery import Gallery, ExamGalleryCache
+    from app.facelib.sync import GallerySync
+    from app.facelib.result_cache import ResultCache
+    from app.models.migrate import count_unversioned
+
+    try:
+        if BaseConfig.SEARCH_PROCESSES > 0 and BaseConfig.GALLERY_DTYPE != "float32":
+            logger.error(f"SEARCH_PROCESSES Requires GALLERY_DTYPE float32, Got {BaseConfig.GALLERY_DTYPE}")
+            sys.exit(-1)
+        with application.app_context():  # 旧特征未标记模型版本时特征库为空，拒绝启动
+            unversioned = count_unversioned()
+        if unversioned:
+            logger.error(f"{unversioned} Embeddings Without modelVersion, "
+                         f"Run `python -m app.models.migrate` Before Starting")
+            sys.exit(-1)
+        if BaseConfig.GALLERY_SYNC:  # 需要在加载特征库之前订阅
+            sync = GallerySync(application.config["SESSION_REDIS"], application)
+            sync.listeners.append(ExamGalleryCache.get_instance().on_gallery_change)
+            sync.listeners.append(ResultCache.get_instance().on_gallery_change)
+            sync.start()
+            GallerySync.INSTANCE = sync
+        with application.app_context():
+            handler = FaceRecogni.get_instance()
+            Gallery.get_instance(metric=handler.metric, model_version=handler.model_version)
+    except Exception:
+        traceback.print_exc()
+        logger.error("Gallery Loading Failed")
+        sys.exit(-1)
+
+
+def init_model(background=True):
+    """
+    启用服务端人脸识别时预加载模型并预热，否则在首次推理时加载
+    FACE_ALIGN时同时创建人脸关键点检测的FaceMesh实例
+    预热完成前 /ready 返回503
+    :param background: 在后台预热，服务先开始监听
+    :return:
+    """
+    import threading
+    from app.config import BaseConfig
+    from app.facelib.face_recogni import FaceRecogni
+
+    if not BaseConfig.USE_FACE_RECOGNI:
+        return
+
+    def preload():
+        try:
+            handler = FaceRecogni.get_instance()
+            handler.preload()
+            logger.info(f"FaceRecogni Ready: warm up {handler.warm_up_stats}")
+            if BaseConfig.FACE_ALIGN:
+                from app.facelib.face_landmark import LandmarkDetector
+                LandmarkDetector.get_instance().prewarm(BaseConfig.LANDMARK_POOL_SIZE)
+                logger.info(f"LandmarkDetector Ready: {BaseConfig.LANDMARK_POOL_SIZE} FaceMesh")
+        except Exception:
+            traceback.print_exc()
+            logger.error("FaceRecogni Preload Failed")
+
+    if background:
+        threading.Thread(target=preload, name="FaceRecogniPreload", daemon=True).start()
+    else:
+        preload()
+
+
+def startup_report(phases):
+    """
+    输出启动各阶段耗时
+    :param phases: [(阶段, 耗时/秒)]
+    """
+    total = sum(elapsed for _, elapsed in phases)
+    lines = [f"  {name:<16s}{elapsed:8.3f}s" for name, elapsed in phases]
+    logger.info("Startup Time Report:\n" + "\n".join(lines) + f"\n  {'total':<16s}{total:8.3f}s")
+
+
 def ensure_mysql():
     """
     确保mysql可用
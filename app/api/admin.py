@@ -63,19 +63,40 @@ class EmbeddingView(BaseModelView):
     can_edit = False
     can_create = False
 
-    column_list = ("uuid", "user.userId", "createTime", "embdBytes", "base64Img")
+    column_list = ("uuid", "user.userId", "createTime", "embdBlob", "base64Img", "modelVersion")
     column_labels = {"uuid": u"特征编号",
                      "user.userId": u"学号",
                      "createTime": u"创建时间",
-                     "embdBytes": u"特征值",
-                     "base64Img": u"人脸图片"}
-    column_exclude_list = ("embdBytes",)
+                     "embdBlob": u"特征值",
+                     "base64Img": u"人脸图片",
+                     "modelVersion": u"模型版本"}
+    column_exclude_list = ("embdBytes", "embdBlob")
     column_searchable_list = ["uuid", "user.userId"]
     column_formatters = {'base64Img': _avatar}
 
     def __init__(self, table, session, **kwargs):
         super(EmbeddingView, self).__init__(table, session, **kwargs)
 
+    def after_model_delete(self, model):
+        # 同步删除内存特征库中的特征
+        from app.facelib.gallery import Gallery, ExamGalleryCache
+        from app.facelib.sync import GallerySync
+        from app.facelib.result_cache import ResultCache
+        from app.models.models import Embedding
+        # 同一张人脸在其它模型版本的特征(重新编码产生)一起删除
+        copies = self.session.query(Embedding.uuid).filter(Embedding.userId == model.userId,
+                                                           Embedding.base64Img == model.base64Img,
+                                                           Embedding.uuid != model.uuid).all()
+        uuids = [model.uuid] + [uuid for uuid, in copies]
+        if copies:
+            self.session.query(Embedding).filter(Embedding.uuid.in_(uuids[1:])).delete(synchronize_session=False)
+            self.session.commit()
+        if Gallery.INSTANCE is not None:
+            Gallery.INSTANCE.remove(uuids)
+        ExamGalleryCache.get_instance().invalidate_user(model.userId)
+        ResultCache.get_instance().invalidate_user(model.userId)
+        GallerySync.notify("remove", uuids, [model.userId] * len(uuids))
+
 
 class ExamInfoView(BaseModelView):
     """考试信息表"""
@@ -97,6 +118,15 @@ class ExamListView(BaseModelView):
     column_labels = dict(uuid=u"记录编号", userId=u"考生编号", examId=u"考试编号")
     column_searchable_list = ['userId', 'examId']
 
+    def after_model_change(self, form, model, is_created):
+        # 名单变更时清除对应考试的特征子库
+        from app.facelib.gallery import ExamGalleryCache
+        ExamGalleryCache.get_instance().invalidate(model.examId)
+
+    def after_model_delete(self, model):
+        from app.facelib.gallery import ExamGalleryCache
+        ExamGalleryCache.get_instance().invalidate(model.examId)
+
 
 class RoleView(BaseModelView):
     """角色表"""
@@ -17,3 +17,34 @@ def show_request():
     print(request.get_data())
     return jsonify(status_code="success", message="ok")
 
+
+
+@bp_debug.route("/debug/result_cache", methods=["GET"])
+def result_cache_stats():
+    from app.facelib.result_cache import ResultCache
+    return jsonify(status_code="success", message="ok", **ResultCache.get_instance().stats())
+
+
+@bp_debug.route("/debug/inference", methods=["GET"])
+def inference_stats():
+    from app.facelib.face_recogni import FaceRecogni
+    batcher = FaceRecogni.get_instance().batcher
+    if batcher is None:
+        return jsonify(status_code="fail", message="未启用推理微批处理")
+    return jsonify(status_code="success", message="ok", **batcher.stats())
+
+
+@bp_debug.route("/debug/executor", methods=["GET"])
+def executor_stats():
+    from app.facelib.executor import Executor
+    executors = [executor.stats() for executor in Executor.INSTANCES.values()]
+    return jsonify(status_code="success", message="ok", executors=executors)
+
+
+@bp_debug.route("/debug/pipeline", methods=["GET"])
+def pipeline_stats():
+    from app.facelib.serving import Serving
+    pipeline = Serving.INSTANCE._pipeline if Serving.INSTANCE is not None else None
+    if pipeline is None:
+        return jsonify(status_code="fail", message="未使用服务端编码流水线")
+    return jsonify(status_code="success", message="ok", **pipeline.stats())
@@ -14,6 +14,8 @@ from app.extensions import db
 from app.models.models import User, ExamInfo, ExamList
 from app.api.forms import ExamInfoForm
 from app.config import BaseConfig
+from app.facelib.gallery import ExamGalleryCache
+from app.facelib.face_recogni import FaceRecogni
 from app.utils.utils import parse_request, encrypt_response, parse_df
 
 
@@ -71,6 +73,7 @@ def create_exam():
             examList.append(p)
         db.session.add_all(examList)
         db.session.commit()
+        ExamGalleryCache.get_instance().invalidate(exam.uuid)
         return jsonify(status_code="success", message="ok", nums=len(examList), examId=exam.uuid)
     except Exception:
         traceback.print_exc()
@@ -101,6 +104,7 @@ def del_exam():
         ExamList.query.filter_by(examId=examId).delete()
         ExamInfo.query.filter_by(uuid=examId).delete()
         db.session.commit()
+        ExamGalleryCache.get_instance().invalidate(examId)
         return jsonify(status_code="success", message="ok")
     except Exception:
         traceback.print_exc()
@@ -161,6 +165,7 @@ def load_exam_data():
         if students is None or len(students) <= 0:
             return jsonify(status_code="fail", message="未查询到考试名单")
         examList = []
+        model_version = FaceRecogni.get_instance().model_version  # 只返回当前模型的特征
         for student in students:
             info = {
                 "userId": student.userId,
@@ -171,8 +176,8 @@ def load_exam_data():
                 "embd1": "",
                 "embd2": "",
             }
-            for idx, embedding in enumerate(student.embedding, 1):
-                info[f"embd{idx}"] = embedding.embdBytes
+            for idx, embedding in enumerate(student.embedding.filter_by(modelVersion=model_version), 1):
+                info[f"embd{idx}"] = embedding.get_base64()
                 info[f"img{idx}"] = embedding.base64Img
             examList.append(info)
         if examList and BaseConfig.CRYPTO_TYPE:
@@ -6,31 +6,87 @@ import json
 
 from . import bp_service
 from app.config import BaseConfig, AppConfig
-from app.facelib.face_recogni import FaceRecogni
+from app.facelib.gallery import ExamGalleryCache
+from app.facelib.serving import Serving
+from app.facelib.sync import GallerySync
+from app.facelib.result_cache import ResultCache
+from app.facelib.executor import run_search
+from app.facelib.pipeline import encode_face
 from app.models.models import Embedding, User
-from app.utils.utils import parse_request, base64_to_image, encrypt_response
+from app.utils.utils import parse_request, base64_to_array, encrypt_response
 from app.extensions import db
 
 import os
 import time
 import base64
-import warnings
 import traceback
 import numpy as np
 from flask import request, jsonify, current_app, session
 from flask_login import login_required, current_user
 
-# FaceHandler = False
-# if BaseConfig.USE_FACE_RECOGNI:
-#     FaceHandler = FaceRecogni.get_instance()
-FaceHandler = FaceRecogni.get_instance()
+def get_gallery(serving, examId=None):
+    """
+    获取检索使用的特征库，与模型使用相同的距离度量
+    :param serving: Serving 本次请求使用的模型与特征库
+    :param examId: 考试编号，None表示全部特征
+    :return: Gallery
+    """
+    if examId is not None:
+        return ExamGalleryCache.get_instance().get(examId)
+    return serving.search_engine()
+
+
+def parse_images(data, nums):
+    """
+    解析前端上传的原始图片
+    {
+        mode: "RGB"|"RGBA"
+        width: int 图片宽度
+        height: int 图片高度
+        im$: 图片 base64
+    }
+    :return: ret, List of RGB np.ndarray|错误信息
+    """
+    mode = data.get("mode", None)
+    im_w = data.get("width", None)
+    im_h = data.get("height", None)
+    if None in (mode, im_w, im_h):
+        return False, "缺少参数"
+    mode = mode.upper()
+    images = []
+    for i in range(nums):
+        im_raw = data.get(f"im{i}", None)  # base64 编码的图片
+        ret = base64_to_array(im_raw, size=(im_w, im_h), mode=mode)
+        if not ret[0]:
+            return ret
+        im_rgb = ret[1]
+        if AppConfig.DEBUG:  # 测试条件下保存图片
+            from PIL import Image
+            Image.fromarray(np.ascontiguousarray(im_rgb)).save(
+                os.path.join(BaseConfig.TMP_PATH, f"{time.time_ns()}.png"))
+        images.append(im_rgb)
+    return True, images
+
+
+def embed_images(serving, images):
+    """
+    服务端编码，FACE_ALIGN时经过 检测->对齐->编码 流水线
+    :return: embeddings [n,dim], faces 编码使用的RGB人脸; 有图片未检测到人脸时为 None, None
+    """
+    if not BaseConfig.FACE_ALIGN:
+        return serving.recogni.predict(images), images
+    result = serving.pipeline().run(images)
+    current_app.logger.debug(f"FacePipeline timings: {result.timings}")
+    if len(result.index) != len(images):
+        return None, None
+    return result.embeddings, result.faces
 
 
 @bp_service.route("/anti_spoof", methods=["POST"])
 @login_required
 def anti_spoof():
     """
-    接受前端上传的人脸图片，通过模型编码保存特征
+    接受前端上传的人脸图片，经 检测->对齐->编码 流水线保存特征及对齐后的人脸
     {
         mode: "RGB"|"RGBA"
         width: int 图片宽度
@@ -41,8 +97,7 @@ def anti_spoof():
     }
     :return:
     """
-    warnings.warn("该方法产生的编码精度存在问题", DeprecationWarning)
-    if BaseConfig.USE_FACE_RECOGNI:
+    if not BaseConfig.USE_FACE_RECOGNI:
         return jsonify(status_code="fail", message="服务器未启用功能")
 
     logger = current_app.logger
@@ -50,44 +105,49 @@ def anti_spoof():
     if request.json is None:
         return jsonify(status_code="fail", message="请求错误")
     data = request.json
-    mode = data.get("mode", None)
-    im_w = data.get("width", None)
-    im_h = data.get("height", None)
     encoding = data.get("encoding", None)
     nums = data.get("nums", None)
-    if None in (mode, im_w, im_h, encoding, nums):
+    if None in (encoding, nums):
         return jsonify(status_code="fail", message="缺少参数")
     if nums <= 1 or nums >= 10:
         return jsonify(status_code="fail", message="图片数量错误")
-    mode = mode.upper()
 
     # noinspection PyBroadException
     try:
-        images = []
-        for i in range(nums):
-            im_raw = data.get(f"im{i}", None)  # base64 编码的图片
-            ret = base64_to_image(im_raw, size=(im_w, im_h), mode=mode)
-            if not ret[0]:
-                return jsonify(status_code="fail", message=ret[1])
-            im_rgb = ret[1]
-            if AppConfig.DEBUG:  # 测试条件下保存图片
-                im_rgb.save(os.path.join(BaseConfig.TMP_PATH, f"{time.time_ns()}.png"))
-            images.append(np.array(im_rgb))
-
-        # 比对距离
-        embeddings = FaceHandler.predict(images)
-        dist = FaceHandler.calculate_distance(embeddings)
-        issame = np.all(dist < FaceHandler.threshold)
-        logger.debug(dist)
-
-        if not issame:
-            return jsonify(status_code="fail", message="识别失败", socre=f"{np.mean(dist):2.4f}")
-
-        for embedding in embeddings:
-            embedding = base64.b64encode(embedding.tobytes()).decode("utf-8")
-            embedding = Embedding(embdBytes=embedding, userId=current_user.get_id())
-            db.session.add(embedding)
-        db.session.commit()
+        ret, images = parse_images(data, nums)
+        if not ret:
+            return jsonify(status_code="fail", message=images)
+
+        with Serving.use() as serving:
+            if serving.enrollment_paused():
+                return jsonify(status_code="fail", message="正在更新模型，请稍后重试")
+            handler = serving.recogni
+            # 比对距离
+            embeddings, faces = embed_images(serving, images)
+            if embeddings is None:
+                return jsonify(status_code="fail", message="未检测到人脸")
+            dist = handler.calculate_distance(embeddings)
+            issame = np.all(dist < handler.threshold)
+            logger.debug(dist)
+
+            if not issame:
+                return jsonify(status_code="fail", message="识别失败", socre=f"{np.mean(dist):2.4f}")
+
+            rows = []
+            for embedding, face in zip(embeddings, faces):
+                embedding = Embedding(embdBlob=embedding.tobytes(), base64Img=encode_face(np.asarray(face)),
+                                      modelVersion=handler.model_version, userId=current_user.get_id())
+                rows.append(embedding)
+            db.session.add_all(rows)
+            db.session.flush()  # 获取主键
+            uuids = [row.uuid for row in rows]
+            db.session.commit()
+            # 同步到内存特征库
+            user_ids = [int(current_user.get_id())] * len(uuids)
+            serving.gallery.add(uuids, user_ids, embeddings)
+        ExamGalleryCache.get_instance().invalidate_user(current_user.get_id())
+        ResultCache.get_instance().invalidate_user(current_user.get_id())
+        GallerySync.notify("add", uuids, user_ids)
         return jsonify(status_code="success", message="ok", socre=f"{np.mean(dist):2.4f}")
 
     except Exception:
@@ -124,35 +184,75 @@ def face_collect():
         if nums <= 1 or nums >= 5:
             return jsonify(status_code="fail", message="参数错误")
         embeddings = []
-        embdBytes = []
         base64Imgs = []
         for idx in range(nums):
             embd = data.get(f"embedding{idx}", None)
             img = data.get(f"image{idx}", None)
             if embd is None or embd == "" or img is None or img == "":
                 return jsonify(status_code="fail", message="参数错误")
-            embdBytes.append(embd)
             base64Imgs.append(img)
             embd = base64.b64decode(embd)
             embd = np.frombuffer(embd, dtype=np.float32)
             embeddings.append(embd)
         embeddings = np.vstack(embeddings)
-        dist = FaceHandler.calculate_distance(embeddings)
-        issame = np.all(dist <= FaceHandler.threshold)
-        logger.debug(dist)
-
-        if not issame:
-            return jsonify(status_code="fail", message="识别失败", socre=f"{np.mean(dist):2.4f}")
-        for embedding, img in zip(embdBytes, base64Imgs):
-            embedding = Embedding(embdBytes=embedding, base64Img=img, userId=current_user.get_id())
-            db.session.add(embedding)
-        db.session.commit()
+        with Serving.use() as serving:
+            if serving.enrollment_paused():
+                return jsonify(status_code="fail", message="正在更新模型，请稍后重试")
+            handler = serving.recogni
+            dist = handler.calculate_distance(embeddings)
+            issame = np.all(dist <= handler.threshold)
+            logger.debug(dist)
+
+            if not issame:
+                return jsonify(status_code="fail", message="识别失败", socre=f"{np.mean(dist):2.4f}")
+            rows = []
+            for embedding, img in zip(embeddings, base64Imgs):
+                embedding = Embedding(embdBlob=embedding.tobytes(), base64Img=img,
+                                      modelVersion=handler.model_version, userId=current_user.get_id())
+                rows.append(embedding)
+            db.session.add_all(rows)
+            db.session.flush()  # 获取主键
+            uuids = [row.uuid for row in rows]
+            db.session.commit()
+            # 同步到内存特征库
+            user_ids = [int(current_user.get_id())] * len(uuids)
+            serving.gallery.add(uuids, user_ids, embeddings)
+        ExamGalleryCache.get_instance().invalidate_user(current_user.get_id())
+        ResultCache.get_instance().invalidate_user(current_user.get_id())
+        GallerySync.notify("add", uuids, user_ids)
         return jsonify(status_code="success", message="ok", socre=f"{np.mean(dist):2.4f}")
     except Exception:
         traceback.print_exc()
         return jsonify(status_code="fail", message="服务器内部错误")
 
 
+def search_user(serving, query, examId=None):
+    """
+    在内存特征库中检索最相近的用户，重复提交时先查结果缓存
+    :param serving: Serving 本次请求使用的模型与特征库
+    :param query: [1,dim]
+    :param examId: 考试编号，None表示全部特征
+    :return: User, 距离; 阈值内没有时为 None, None
+    """
+    threshold = serving.recogni.threshold
+    gallery = get_gallery(serving, examId)
+    cached = None
+    if BaseConfig.RESULT_CACHE:
+        cached = ResultCache.get_instance().get(query, gallery, threshold, scope=examId)
+    if cached is not None:
+        uuids, user_ids, dists = [cached[0]], [cached[1]], [cached[2]]
+    else:
+        uuids, user_ids, dists = run_search(gallery.search, query, k=1)
+    if len(dists) <= 0 or dists[0] > threshold:
+        return None, None
+    if BaseConfig.RESULT_CACHE and cached is None:
+        ResultCache.get_instance().put(query, uuids[0], user_ids[0], scope=examId)
+    user = User.query.filter_by(uuid=int(user_ids[0])).first()
+    if user is None:
+        return None, None
+    return user, dists[0]
+
+
 @bp_service.route("/recogni", methods=["POST"])
 @login_required
 def face_recogni():
@@ -161,6 +261,7 @@ def face_recogni():
     {
         encrypt: bool 是否加密
         embedding: 人脸编码 base64
+        examId: int 可选，只在该考试名单中检索
     }
     :return:
     """
@@ -180,39 +281,144 @@ def face_recogni():
         query = np.frombuffer(embedding, dtype=np.float32)
         query = np.expand_dims(query, axis=0)
 
-        # 分页查询
-        offset = 0
-        page_size = 200
-        while True:
-            embeddings = Embedding.query.offset(offset).limit(page_size).all()
-            if embeddings is None or len(embeddings) <= 0:
-                db.session.remove()
-                return jsonify(status_code="fail", message="not found")
-            gallery = []
-            for embedding in embeddings:
-                embedding = base64.b64decode(embedding.embdBytes.encode("utf-8"))
-                embedding = np.frombuffer(embedding, dtype=np.float32)
-                gallery.append(embedding)
-            gallery = np.vstack(gallery)
-            dist = np.linalg.norm(np.subtract(query, gallery), axis=1)
-            dist_argmin = np.argmin(dist)
-            dist_min = dist[dist_argmin]
-            if dist_min <= FaceHandler.threshold:
-                embedding = embeddings[dist_argmin]
-                user = embedding.user
-                user = User.query.filter_by(uuid=user.uuid).first()
-                resp = dict(
-                    info=str(user),
-                    # img=embedding.base64Img,
-                    score=str(dist_min)
-                )
-                if BaseConfig.CRYPTO_TYPE:
-                    ret, resp = encrypt_response(resp, session)
-                    if not ret:  # 加密失败
-                        return jsonify(status_code="fail", message=data)
-                db.session.remove()  # 防止连接池耗尽
-                return jsonify(status_code="success", message="ok", **resp)
-            offset += page_size
+        with Serving.use() as serving:
+            user, score = search_user(serving, query, data.get("examId", None))
+        if user is None:
+            db.session.remove()
+            return jsonify(status_code="fail", message="not found")
+        resp = dict(
+            info=str(user),
+            score=str(score)
+        )
+        if BaseConfig.CRYPTO_TYPE:
+            ret, resp = encrypt_response(resp, session)
+            if not ret:  # 加密失败
+                return jsonify(status_code="fail", message=data)
+        db.session.remove()  # 防止连接池耗尽
+        return jsonify(status_code="success", message="ok", **resp)
+
+    except Exception:
+        traceback.print_exc()
+    return jsonify(status_code="fail", message="服务器内部出错")
+
+
+@bp_service.route("/recogni_image", methods=["POST"])
+@login_required
+def face_recogni_image():
+    """
+    前端上传原始图片，由服务端 检测->对齐->编码 后进行人脸检索，供无法在本地编码的客户端使用
+    {
+        mode: "RGB"|"RGBA"
+        width: int 图片宽度
+        height: int 图片高度
+        im0: 图片 base64
+        examId: int 可选，只在该考试名单中检索
+    }
+    :return:
+    """
+    if not BaseConfig.USE_FACE_RECOGNI:
+        return jsonify(status_code="fail", message="服务器未启用功能")
+    # noinspection PyBroadException
+    try:
+        data = request.get_json()
+        if data is None:
+            return jsonify(status_code="fail", message="请求错误")
+        ret, images = parse_images(data, 1)
+        if not ret:
+            return jsonify(status_code="fail", message=images)
+        with Serving.use() as serving:
+            embeddings, _ = embed_images(serving, images)
+            if embeddings is None:
+                return jsonify(status_code="fail", message="未检测到人脸")
+            user, score = search_user(serving, embeddings[:1], data.get("examId", None))
+        if user is None:
+            db.session.remove()
+            return jsonify(status_code="fail", message="not found")
+        resp = dict(
+            info=str(user),
+            score=str(score)
+        )
+        if BaseConfig.CRYPTO_TYPE:
+            ret, resp = encrypt_response(resp, session)
+            if not ret:  # 加密失败
+                return jsonify(status_code="fail", message=resp)
+        db.session.remove()  # 防止连接池耗尽
+        return jsonify(status_code="success", message="ok", **resp)
+
+    except Exception:
+        traceback.print_exc()
+    return jsonify(status_code="fail", message="服务器内部出错")
+
+
+@bp_service.route("/recogni_batch", methods=["POST"])
+@login_required
+def face_recogni_batch():
+    """
+    前端一次上传多个Embedding，批量进行人脸检索，每个Embedding返回阈值内最相近的topk个用户
+    {
+        encrypt: bool 是否加密
+        json:{
+            nums: int 数量
+            embedding$: 人脸编码 base64
+            topk: int 可选，每个编码返回的候选数量
+            examId: int 可选，只在该考试名单中检索
+        }
+    }
+    :return: results: [[{info, score}...]...] 与embedding$一一对应
+    """
+    # noinspection PyBroadException
+    try:
+        data = request.get_json()
+        ret, data = parse_request(data, session)
+        if not ret:
+            return jsonify(status_code="fail", message=data)
+        if BaseConfig.CRYPTO_TYPE and not data.get("encrypt", False):
+            return jsonify(status_code="fail", message="识别失败")
+
+        nums = data.get("nums", 0)
+        topk = data.get("topk", 1)
+        if not isinstance(nums, int) or nums < 1 or nums > BaseConfig.RECOGNI_BATCH_SIZE:
+            return jsonify(status_code="fail", message="参数错误")
+        if not isinstance(topk, int) or topk < 1 or topk > BaseConfig.RECOGNI_TOPK:
+            return jsonify(status_code="fail", message="参数错误")
+        queries = []
+        for idx in range(nums):
+            embd = data.get(f"embedding{idx}", None)
+            if embd is None or embd == "":
+                return jsonify(status_code="fail", message="参数错误")
+            queries.append(np.frombuffer(base64.b64decode(embd), dtype=np.float32))
+        queries = np.vstack(queries)
+
+        # 一个用户有多条特征，多取一些候选再按用户去重
+        with Serving.use() as serving:
+            threshold = serving.recogni.threshold
+            gallery = get_gallery(serving, data.get("examId", None))
+            _, user_ids, dists = run_search(gallery.search_batch, queries, k=topk * BaseConfig.EMBEDDINGS_PER_USER)
+
+        candidates = []
+        for row_ids, row_dists in zip(user_ids, dists):
+            row = {}
+            for user_id, dist in zip(row_ids, row_dists):
+                if dist > threshold or len(row) >= topk:
+                    break
+                if int(user_id) not in row:
+                    row[int(user_id)] = dist
+            candidates.append(row)
+
+        found = set(user_id for row in candidates for user_id in row)
+        users = User.query.filter(User.uuid.in_(found)).all() if found else []
+        users = {user.uuid: str(user) for user in users}
+        results = []
+        for row in candidates:
+            results.append([dict(info=users[user_id], score=str(dist))
+                            for user_id, dist in row.items() if user_id in users])
+        resp = dict(results=results)
+        if BaseConfig.CRYPTO_TYPE:
+            ret, resp = encrypt_response(resp, session)
+            if not ret:  # 加密失败
+                return jsonify(status_code="fail", message=data)
+        db.session.remove()  # 防止连接池耗尽
+        return jsonify(status_code="success", message="ok", **resp)
 
     except Exception:
         traceback.print_exc()
@@ -0,0 +1,33 @@
+from . import bp_service
+from app.config import BaseConfig
+
+from flask import jsonify
+
+
+@bp_service.route("/ready", methods=["GET"])
+def ready():
+    """
+    负载均衡的就绪检查：特征库已加载，启用服务端人脸识别时模型已完成预热，
+    FACE_ALIGN时人脸关键点检测的FaceMesh实例已创建
+    :return: 200 就绪 503 未就绪
+    """
+    from app.facelib.gallery import Gallery
+    from app.facelib.face_recogni import FaceRecogni
+    from app.facelib.face_landmark import LandmarkDetector
+
+    gallery_ready = Gallery.INSTANCE is not None and Gallery.INSTANCE.loaded
+    model_ready = True
+    landmark_ready = True
+    warm_up = {}
+    if BaseConfig.USE_FACE_RECOGNI:
+        handler = FaceRecogni.INSTANCE
+        model_ready = handler is not None and handler.ready
+        warm_up = {} if handler is None else {str(size): stats for size, stats in handler.warm_up_stats.items()}
+        if BaseConfig.FACE_ALIGN:
+            landmark_ready = LandmarkDetector.INSTANCE is not None and LandmarkDetector.INSTANCE.ready
+    is_ready = gallery_ready and model_ready and landmark_ready
+    model_version = Gallery.INSTANCE.model_version if Gallery.INSTANCE is not None else None
+    resp = jsonify(status_code="success" if is_ready else "fail", message="ready" if is_ready else "not ready",
+                   gallery=gallery_ready, model=model_ready, landmark=landmark_ready,
+                   model_version=model_version, warm_up=warm_up)
+    return resp, 200 if is_ready else 503
@@ -0,0 +1,49 @@
+"""
+reload.py
+管理员触发的模型与特征库热切换，不需要重启服务
+"""
+from . import bp_service
+from app.config import BaseConfig, Default
+
+from flask import jsonify, current_app
+from flask_login import login_required, current_user
+
+
+@bp_service.route("/reload", methods=["POST"])
+@login_required
+def reload():
+    """
+    在原生线程中加载当前启用的模型(FaceRecogniModel.active)与对应版本的特征库，预热后切换
+    解码特征、训练索引等计算不在事件循环中执行，加载期间不影响其它请求
+    正在处理的请求继续使用旧实例，GET /reload 查看切换耗时与内存峰值
+    :return:
+    """
+    from app.facelib.serving import Serving
+    from app.facelib.executor import Executor
+
+    if not current_user.is_active or current_user.role.power < Default.ROLES["Administrator"]:
+        return jsonify(status_code="fail", message="权限不足")
+    if Serving._reload_lock.locked():
+        return jsonify(status_code="fail", message="正在重新加载")
+    application = current_app._get_current_object()
+    Executor.get_instance("background").spawn(Serving.reload, application, BaseConfig.USE_FACE_RECOGNI)
+    return jsonify(status_code="success", message="ok")
+
+
+@bp_service.route("/reload", methods=["GET"])
+@login_required
+def reload_report():
+    """
+    最近一次热切换的报告
+        status: loading|swapped|done|failed
+        model_ms 加载并预热模型, gallery_ms 加载特征库并预热检索, swap_ms 切换引用
+        drain_ms 切换后旧实例上的请求全部结束的耗时, in_flight 切换时旧实例上的请求数
+        reembedded/reembed_failed 切换模型版本时，旧实例上录入的特征由新模型重新编码的数量
+        peak_rss_mb_before/peak_rss_mb_after 进程内存峰值/MB
+    :return:
+    """
+    from app.facelib.serving import Serving
+
+    if not current_user.is_active or current_user.role.power < Default.ROLES["Administrator"]:
+        return jsonify(status_code="fail", message="权限不足")
+    return jsonify(status_code="success", message="ok", **Serving.last_reload)
@@ -1,4 +1,6 @@
 from .static_file import download_model, download_js, download_css
 from .user import init_session, login
-from .face_api import anti_spoof, face_collect, face_recogni
+from .face_api import anti_spoof, face_collect, face_recogni, face_recogni_batch, face_recogni_image
 from .exam import create_exam, del_exam, get_exam_list, load_exam_data
+from .health import ready
+from .reload import reload, reload_report
@@ -0,0 +1,5 @@
+"""
+benchmark
+识别检索的性能测试，使用合成特征，不依赖模型与线上数据库
+python -m app.benchmark.recogni --sizes 1000,10000,100000,1000000 --output bench.json
+"""
@@ -0,0 +1,233 @@
+"""
+recogni.py
+/recogni 检索延迟与特征库规模的关系，输出JSON便于跨版本对比
+    db_paged      原分页查询数据库逐页比对的方式(SQLite)
+    exact_*       内存特征库精确检索，float32/float16/int8存储
+    template      按用户聚合的模板检索
+    ivf           倒排索引近似检索
+    sharded       多进程分片检索(--processes > 0)
+python -m app.benchmark.recogni --sizes 1000,10000 --output bench.json
+"""
+import os
+import sys
+
+project_path = os.path.join(os.path.dirname(__file__), os.path.pardir, os.path.pardir)
+sys.path.append(project_path)
+
+import gc
+import time
+import sqlite3
+import logging
+import platform
+import tempfile
+
+import numpy as np
+
+from app.benchmark.synthetic import synthetic_gallery, synthetic_queries
+
+logger = logging.getLogger(__name__)
+
+
+def measure(search, queries, warm_up=5):
+    """
+    逐条执行查询，统计延迟
+    :param search: callable(query [1, dim]) -> user_id，未找到时为-1
+    :param queries: [m, dim]
+    :param warm_up: 预热次数，不计入统计
+    :return: dict p50_ms, p99_ms, mean_ms, qps, 以及每条查询的结果
+    """
+    for query in queries[:warm_up]:
+        search(query[None, :])
+    latencies = np.empty(len(queries), dtype=np.float64)
+    found = np.empty(len(queries), dtype=np.int64)
+    begin = time.perf_counter()
+    for i, query in enumerate(queries):
+        enter = time.perf_counter()
+        found[i] = search(query[None, :])
+        latencies[i] = time.perf_counter() - enter
+    total = time.perf_counter() - begin
+    return dict(p50_ms=float(np.percentile(latencies, 50) * 1000),
+                p99_ms=float(np.percentile(latencies, 99) * 1000),
+                mean_ms=float(np.mean(latencies) * 1000),
+                qps=float(len(queries) / total)), found
+
+
+def gallery_search(gallery, threshold):
+    def search(query):
+        _, user_ids, dists = gallery.search(query, k=1)
+        return int(user_ids[0]) if len(dists) and dists[0] <= threshold else -1
+
+    return search
+
+
+class PagedDatabase:
+    """
+    在SQLite中复现按页读取Embeddings逐页比对的检索方式
+    """
+    PAGE_SIZE = 200
+
+    def __init__(self, uuids, user_ids, embeddings, path=None):
+        self.tmp_dir = None if path else tempfile.mkdtemp(prefix="face_bench_")
+        self.path = path or os.path.join(self.tmp_dir, "bench.sqlite")
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute("CREATE TABLE Embeddings (uuid INTEGER PRIMARY KEY, userId INTEGER NOT NULL, "
+                          "embdBlob BLOB, base64Img TEXT NOT NULL DEFAULT '')")
+        self.conn.executemany("INSERT INTO Embeddings (uuid, userId, embdBlob) VALUES (?, ?, ?)",
+                              ((int(u), int(user), vector.tobytes())
+                               for u, user, vector in zip(uuids, user_ids, embeddings)))
+        self.conn.commit()
+
+    def search(self, query, threshold):
+        """
+        逐页读取并计算L2距离，找到阈值内的特征即返回
+        """
+        offset = 0
+        while True:
+            rows = self.conn.execute("SELECT userId, embdBlob FROM Embeddings LIMIT ? OFFSET ?",
+                                     (self.PAGE_SIZE, offset)).fetchall()
+            if not rows:
+                return -1
+            page = np.vstack([np.frombuffer(blob, dtype=np.float32) for _, blob in rows])
+            dist = np.linalg.norm(np.subtract(query, page), axis=1)
+            best = int(np.argmin(dist))
+            if dist[best] <= threshold:
+                return rows[best][0]
+            offset += self.PAGE_SIZE
+
+    def close(self):
+        self.conn.close()
+        os.remove(self.path)
+        if self.tmp_dir is not None:
+            os.rmdir(self.tmp_dir)
+
+
+def run_size(n, dim, methods, n_queries=1000, threshold=1.0, metric="l2", processes=0, db_max_size=100000,
+             nlist=None, nprobe=16, seed=0):
+    """
+    :return: list of dict，每种检索方式一条
+    """
+    from app.facelib.gallery import Gallery
+
+    uuids, user_ids, embeddings, centers = synthetic_gallery(n, dim=dim, seed=seed)
+    queries, expected = synthetic_queries(centers, n_queries, seed=seed + 1)
+    results = []
+
+    def record(method, build_time, search):
+        stats, found = measure(search, queries)
+        stats.update(size=n, method=method, build_s=build_time, accuracy=float(np.mean(found == expected)))
+        logger.info(f"{n:>8d} {method:<14s} p50 {stats['p50_ms']:8.3f}ms p99 {stats['p99_ms']:8.3f}ms "
+                    f"qps {stats['qps']:9.1f} acc {stats['accuracy']:.3f}")
+        results.append(stats)
+
+    if "db_paged" in methods:
+        if n <= db_max_size:
+            begin = time.perf_counter()
+            database = PagedDatabase(uuids, user_ids, embeddings)
+            build_time = time.perf_counter() - begin
+            record("db_paged", build_time, lambda query: database.search(query, threshold))
+            database.close()
+        else:
+            logger.info(f"{n:>8d} db_paged skipped, size > {db_max_size}")
+
+    for dtype in ("float32", "float16", "int8"):
+        if f"exact_{dtype}" not in methods:
+            continue
+        begin = time.perf_counter()
+        gallery = Gallery(metric=metric, dtype=dtype)
+        gallery.add(uuids, user_ids, embeddings)
+        if gallery.quantized:
+            from app.facelib.quantize import ArrayVectors
+            gallery.rerank_source = ArrayVectors(uuids, embeddings)
+        record(f"exact_{dtype}", time.perf_counter() - begin, gallery_search(gallery, threshold))
+        del gallery
+        gc.collect()
+
+    if methods & {"template", "ivf", "sharded"}:
+        gallery = Gallery(metric=metric)
+        gallery.add(uuids, user_ids, embeddings)
+
+        if "template" in methods:
+            from app.facelib.template import TemplateSearch
+            begin = time.perf_counter()
+            template = TemplateSearch(gallery, threshold)
+            template.search_batch(queries[:1])  # 首次检索时聚合
+            record("template", time.perf_counter() - begin, gallery_search(template, threshold))
+            template.detach()
+
+        if "sharded" in methods and processes > 0:
+            from app.facelib.sharded import ShardedSearchEngine
+            begin = time.perf_counter()
+            engine = ShardedSearchEngine(gallery, workers=processes, min_size=0)
+            engine.search_batch(queries[:1])  # 启动进程并发布共享内存
+            record(f"sharded_{processes}", time.perf_counter() - begin, gallery_search(engine, threshold))
+            engine.close()
+
+        if "ivf" in methods:
+            from app.facelib.ann import IVFIndex
+            begin = time.perf_counter()
+            index = IVFIndex(metric=metric, nlist=nlist or max(1, int(4 * np.sqrt(n))), nprobe=nprobe)
+            index.build(embeddings)
+            gallery.set_index(index)
+            record("ivf", time.perf_counter() - begin, gallery_search(gallery, threshold))
+            gallery.set_index(None)
+        del gallery
+        gc.collect()
+    return results
+
+
+def load_model_config():
+    """
+    读取模型的 output_shape/metric/threshold，模型不存在时返回None
+    """
+    try:
+        from app.facelib.face_recogni import FaceRecogni
+        return FaceRecogni.load_config()
+    except Exception:
+        return None
+
+
+if __name__ == '__main__':
+    import json
+    import argparse
+
+    all_methods = ("db_paged", "exact_float32", "exact_float16", "exact_int8", "template", "ivf", "sharded")
+    parser = argparse.ArgumentParser(description="检索延迟与特征库规模的关系")
+    parser.add_argument("--sizes", default="1000,10000,100000,1000000", help="特征数，逗号分隔")
+    parser.add_argument("--methods", default=",".join(all_methods), help="检索方式，逗号分隔")
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--dim", type=int, default=None, help="默认使用模型的output_shape")
+    parser.add_argument("--metric", default=None, help="默认使用模型配置")
+    parser.add_argument("--threshold", type=float, default=None, help="默认使用模型配置")
+    parser.add_argument("--processes", type=int, default=0, help="分片检索的进程数")
+    parser.add_argument("--db-max-size", type=int, default=100000, help="db_paged只测试不超过该规模的特征库")
+    parser.add_argument("--nlist", type=int, default=None, help="默认 4*sqrt(n)")
+    parser.add_argument("--nprobe", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="保存为JSON文件")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    config = load_model_config() or {}
+    dim = args.dim or int(np.ravel(config.get("output_shape", [512]))[-1])
+    metric = args.metric or config.get("metric", "l2")
+    threshold = args.threshold if args.threshold is not None else float(config.get("threshold", 1.0))
+    methods = set(args.methods.split(","))
+    unknown = methods - set(all_methods)
+    if unknown:
+        parser.error(f"未知的检索方式: {','.join(sorted(unknown))}")
+
+    report = dict(
+        meta=dict(dim=dim, metric=metric, threshold=threshold, queries=args.queries, seed=args.seed,
+                  python=platform.python_version(), numpy=np.__version__, platform=platform.platform(),
+                  cpu_count=os.cpu_count(), time=time.strftime("%Y-%m-%d %H:%M:%S")),
+        results=[]
+    )
+    for size in [int(s) for s in args.sizes.split(",")]:
+        report["results"] += run_size(size, dim, methods, n_queries=args.queries, threshold=threshold,
+                                      metric=metric, processes=args.processes, db_max_size=args.db_max_size,
+                                      nlist=args.nlist, nprobe=args.nprobe, seed=args.seed)
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
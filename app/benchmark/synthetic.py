@@ -0,0 +1,47 @@
+"""
+synthetic.py
+合成L2正则化的人脸特征：每个用户一个随机中心，加噪声得到多条录入特征，查询特征取自库中用户
+"""
+import numpy as np
+
+
+def normalize(x) -> np.ndarray:
+    x = np.asarray(x, dtype=np.float32)
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+def synthetic_gallery(n, dim=512, per_user=3, noise=0.3, seed=0, chunk_size=65536):
+    """
+    :param n: 特征数
+    :param dim: 特征维度，与模型output_shape一致
+    :param per_user: 每个用户的特征数
+    :param noise: 噪声相对中心的比例，决定同一用户特征之间的距离
+    :param seed:
+    :param chunk_size: 分块生成，限制临时内存
+    :return: uuids [n] 从1开始升序, user_ids [n], embeddings [n, dim] float32, centers [n_users, dim]
+    """
+    rng = np.random.default_rng(seed)
+    n_users = (n + per_user - 1) // per_user
+    centers = normalize(rng.standard_normal((n_users, dim), dtype=np.float32))
+    user_ids = np.arange(n, dtype=np.int64) // per_user
+    embeddings = np.empty((n, dim), dtype=np.float32)
+    scale = noise / np.sqrt(dim)
+    for begin in range(0, n, chunk_size):
+        end = min(begin + chunk_size, n)
+        block = centers[user_ids[begin:end]] + scale * rng.standard_normal((end - begin, dim), dtype=np.float32)
+        embeddings[begin:end] = normalize(block)
+    return np.arange(1, n + 1, dtype=np.int64), user_ids + 1, embeddings, centers
+
+
+def synthetic_queries(centers, m, noise=0.3, seed=1):
+    """
+    在已有用户附近生成查询
+    :param centers: synthetic_gallery返回的用户中心
+    :param m: 查询数量
+    :return: queries [m, dim], 对应的用户编号 [m]
+    """
+    rng = np.random.default_rng(seed)
+    users = rng.integers(0, len(centers), size=m)
+    dim = centers.shape[1]
+    queries = centers[users] + noise / np.sqrt(dim) * rng.standard_normal((m, dim), dtype=np.float32)
+    return normalize(queries), users + 1
@@ -1,5 +1,4 @@
 import os
-import redis
 import platform
 
 # 暂时禁用GPU
@@ -65,12 +64,64 @@ class BaseConfig:
     RESOURCE_FOLDER = os.path.join(BASE_PATH, os.path.pardir, "resources")
     # 人脸识别模型
     FACE_RECOGNI_MODEL_PATH = os.path.join(RESOURCE_FOLDER, "FaceRecogniModel")
+    # 记录当前启用的模型目录，重新编码完成后切换，不存在时使用FACE_RECOGNI_MODEL_PATH
+    FACE_RECOGNI_ACTIVE = os.path.join(RESOURCE_FOLDER, "FaceRecogniModel.active")
     # 用户上传文件
     UPLOAD_FILES = os.path.join(RESOURCE_FOLDER, "UploadFiles")
     # 初始化标志
     INIT_FLAG = os.path.join(RESOURCE_FOLDER, "flask.init")
     # 启动服务端人脸识别
     USE_FACE_RECOGNI = False
+    # 按考试缓存的特征子库数量
+    EXAM_GALLERY_CACHE_SIZE = 64
+    # 检索索引 "flat": 精确检索 "ivf": 倒排索引近似检索
+    GALLERY_INDEX = "flat"
+    # 离线构建的索引文件，python -m app.facelib.ann
+    GALLERY_INDEX_PATH = os.path.join(RESOURCE_FOLDER, "gallery_ivf.npz")
+    # 倒排桶数量；检索时扫描的桶数，越大召回越高、延迟越高
+    IVF_NLIST = 1024
+    IVF_NPROBE = 16
+    # 特征库快照，启动时内存映射加载，多进程共享；压缩存储时作为float32重排的来源，否则从数据库读取
+    GALLERY_SNAPSHOT = True
+    GALLERY_SNAPSHOT_PATH = os.path.join(RESOURCE_FOLDER, "gallery.snapshot")
+    # 特征存储格式 "float32"|"float16"|"int8"，压缩存储时取 k*GALLERY_RERANK 个候选用float32精确重排
+    GALLERY_DTYPE = "float32"
+    GALLERY_RERANK = 8
+    # 多进程分片检索的进程数，0表示在当前进程检索；特征数小于SEARCH_SHARD_MIN_SIZE时不分片
+    # 只支持float32存储，与压缩存储同时启用时拒绝启动
+    SEARCH_PROCESSES = 0
+    SEARCH_SHARD_MIN_SIZE = 50000
+    # 多进程部署时通过Redis同步各进程的特征库
+    GALLERY_SYNC = True
+    # 批量检索：单次请求的最大编码数量、每个编码返回的最大候选数
+    RECOGNI_BATCH_SIZE = 16
+    RECOGNI_TOPK = 5
+    # 批量检索时每个候选用户多取的特征数，用于按用户去重
+    EMBEDDINGS_PER_USER = 4
+    # 按用户聚合的模板检索，模板距离在 阈值±TEMPLATE_MARGIN 内时使用该用户的全部特征精确比对
+    GALLERY_TEMPLATE = False
+    TEMPLATE_MARGIN = 0.1
+    # 模板检索时每个query取 k*TEMPLATE_CANDIDATES 个候选用户
+    TEMPLATE_CANDIDATES = 4
+    # 识别结果缓存：条数、有效期/秒；查询特征按随机超平面分桶(每组RESULT_CACHE_BITS个，共RESULT_CACHE_TABLES组)，
+    # 与缓存查询的距离(正则化后的欧氏距离)不超过RESULT_CACHE_TOLERANCE时使用，命中后仍与缓存用户的特征确认距离
+    RESULT_CACHE = True
+    RESULT_CACHE_SIZE = 4096
+    RESULT_CACHE_TTL = 10.0
+    RESULT_CACHE_TOLERANCE = 0.4
+    RESULT_CACHE_BITS = 8
+    RESULT_CACHE_TABLES = 6
+    # 推理微批处理：合并并发请求，每批最多INFERENCE_MAX_BATCH张图片，最多等待INFERENCE_MAX_WAIT_MS毫秒
+    INFERENCE_BATCHING = True
+    INFERENCE_MAX_BATCH = 32
+    INFERENCE_MAX_WAIT_MS = 5.0
+    # 模型推理与特征检索使用的原生线程数，计算期间事件循环仍可处理其它请求
+    INFERENCE_WORKERS = max(1, THREAD_NUM // 2)
+    SEARCH_WORKERS = THREAD_NUM
+    # 人脸关键点检测的FaceMesh实例数，每个实例同时只能被一个线程使用
+    LANDMARK_POOL_SIZE = INFERENCE_WORKERS
+    # 服务端编码时先检测人脸并对齐到模型模板，False时只做等比例缩放
+    FACE_ALIGN = True
 
     # Flask资源文件
     TEMPLATE_FOLDER = f"{BASE_PATH}/templates"
@@ -111,12 +162,7 @@ class AppConfig:
     SESSION_USE_SIGNER = True
     # session有效期/秒
     PERMANENT_SESSION_LIFETIME = 7200  # 默认120分钟
-    # Redis连接
-    SESSION_REDIS = redis.Redis(host=Redis.REDIS_HOST,
-                                port=Redis.REDIS_PORT,
-                                db=Redis.REDIS_DB,
-                                password=Redis.REDIS_PWD
-                                )
+    # Redis连接 SESSION_REDIS 在create_app中创建，导入配置时不连接
 
     # 数据库配置
     SQLALCHEMY_DATABASE_URI = MySQL.url()
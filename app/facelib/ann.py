@@ -0,0 +1,322 @@
+"""
+ann.py
+近似最近邻检索，倒排索引(IVF)：k-means粗量化将特征划分到nlist个桶，检索时只扫描最近的nprobe个桶
+桶中只保存特征库的行号，桶内距离由特征库的存储按精确检索相同的度量计算，压缩存储时同样经过float32重排，
+返回的距离可以直接与config.yaml中的threshold比较
+"""
+import os
+import sys
+
+project_path = os.path.join(os.path.dirname(__file__), os.path.pardir, os.path.pardir)
+sys.path.append(project_path)
+
+import logging
+
+import numpy as np
+
+from app.facelib.distance import normalize_metric, pairwise_distance, topk_smallest, chunked_topk
+
+logger = logging.getLogger(__name__)
+
+
+def nearest_centroid(data, centroids, metric="l2", max_elements=1 << 24):
+    """
+    按行分块计算最近的聚类中心，每块的距离矩阵不超过max_elements个元素(默认64MB)，
+    100万特征、4000个中心时不会一次生成 n*nlist 的距离矩阵
+    :param data: [n, dim] float32
+    :param centroids: [k, dim]
+    :param metric:
+    :param max_elements: 每块距离矩阵的最大元素数
+    :return: [n] int64
+    """
+    n = data.shape[0]
+    chunk_size = max(1, max_elements // max(len(centroids), 1))
+    assign = np.empty(n, dtype=np.int64)
+    for begin in range(0, n, chunk_size):
+        end = min(begin + chunk_size, n)
+        assign[begin:end] = np.argmin(pairwise_distance(data[begin:end], centroids, metric), axis=1)
+    return assign
+
+
+def kmeans(data, k, n_iter=20, spherical=False, seed=0):
+    """
+    k-means聚类
+    :param data: [n, dim] float32
+    :param k: 聚类中心数量
+    :param n_iter: 迭代次数
+    :param spherical: 中心归一化，用于cosine
+    :param seed:
+    :return: centroids [k, dim]
+    """
+    rng = np.random.default_rng(seed)
+    n = data.shape[0]
+    centroids = data[rng.choice(n, size=k, replace=False)].copy()
+    for _ in range(n_iter):
+        assign = nearest_centroid(data, centroids)
+        counts = np.bincount(assign, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, data)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        if np.any(empty):  # 空桶重新随机初始化
+            centroids[empty] = data[rng.choice(n, size=int(np.count_nonzero(empty)), replace=False)]
+        if spherical:
+            centroids /= np.linalg.norm(centroids, axis=1, keepdims=True)
+    return centroids.astype(np.float32)
+
+
+class IVFIndex:
+    """
+    倒排索引，桶中只保存特征在Gallery数组中的行号，不复制特征，距离由Gallery的存储(含压缩存储)计算
+    由Gallery在持有锁时同步增删，训练前所有特征保存在同一个桶中，退化为精确检索
+    """
+
+    def __init__(self, metric="l2", nlist=1024, nprobe=16):
+        self.metric = normalize_metric(metric)
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.centroids = None  # [nlist, dim]
+        self._lists = []  # 每个桶: 行号 int64
+        self._size = 0  # 已写入的行数，与Gallery一致
+        self.reset()
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def trained(self):
+        return self.centroids is not None
+
+    def reset(self):
+        """
+        清空所有桶，保留聚类中心
+        """
+        nlist = 1 if self.centroids is None else len(self.centroids)
+        self._lists = [np.empty(0, dtype=np.int64) for _ in range(nlist)]
+        self._size = 0
+
+    def train(self, embeddings, n_iter=20, max_samples=100000, seed=0):
+        """
+        训练粗量化中心
+        :param embeddings: [n, dim]
+        :param n_iter: k-means迭代次数
+        :param max_samples: 参与训练的最大样本数
+        :param seed:
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        n = embeddings.shape[0]
+        if n <= 0:
+            raise ValueError("没有可用于训练的特征")
+        if n > max_samples:
+            embeddings = embeddings[np.random.default_rng(seed).choice(n, size=max_samples, replace=False)]
+        if self.metric == "cosine":
+            embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+        nlist = min(self.nlist, embeddings.shape[0])
+        self.centroids = kmeans(embeddings, nlist, n_iter=n_iter, spherical=self.metric == "cosine", seed=seed)
+
+    def build(self, embeddings, **kwargs):
+        """
+        训练并写入全部特征
+        :param embeddings: [n, dim] 顺序与Gallery的行一致
+        """
+        self.train(embeddings, **kwargs)
+        self.reset()
+        self.add(np.arange(len(embeddings)), embeddings)
+        return self
+
+    def assign(self, embeddings) -> np.ndarray:
+        """
+        :param embeddings: [n, dim] float32
+        :return: [n] 各特征所属的桶
+        """
+        if self.centroids is None:
+            return np.zeros(embeddings.shape[0], dtype=np.int64)
+        return nearest_centroid(embeddings, self.centroids, self.metric)
+
+    def _insert(self, rows, assign):
+        # 替换桶列表而不是原地修改，检索方持有的旧列表与同时取得的Gallery快照保持一致
+        lists = list(self._lists)
+        for list_id in np.unique(assign):
+            lists[list_id] = np.concatenate([lists[list_id], rows[assign == list_id]])
+        self._lists = lists
+        self._size += len(rows)
+
+    def add(self, rows, embeddings, assign=None):
+        """
+        :param rows: 新增特征在Gallery中的行号
+        :param embeddings: [n, dim] float32，只用于分配桶
+        :param assign: 已由 assign 计算的桶，None时在此计算
+        """
+        if assign is None:
+            embeddings = np.asarray(embeddings, dtype=np.float32)
+            if embeddings.ndim == 1:
+                embeddings = np.expand_dims(embeddings, axis=0)
+            assign = self.assign(embeddings)
+        self._insert(np.asarray(rows, dtype=np.int64).reshape(-1), assign)
+
+    def remove(self, keep) -> int:
+        """
+        Gallery删除特征后剩余的行前移，同步各桶的行号
+        :param keep: [删除前的行数] bool，保留的行
+        :return: 删除的数量
+        """
+        removed = len(keep) - int(np.count_nonzero(keep))
+        if removed == 0:
+            return 0
+        moved = np.cumsum(keep) - 1  # 删除前的行号 -> 删除后的行号
+        self._lists = [moved[rows[keep[rows]]] for rows in self._lists]
+        self._size -= removed
+        return removed
+
+    def lists(self):
+        """
+        当前的桶列表，与Gallery快照在同一次持锁中取得
+        """
+        return self._lists
+
+    def search_batch(self, queries, state, lists, k=1, nprobe=None):
+        """
+        批量检索，只计算候选桶中的行
+        :param queries: [m, dim]
+        :param state: Gallery._snapshot
+        :param lists: 与state同时取得的 lists()
+        :param k:
+        :param nprobe: 扫描的桶数，越大召回越高、耗时越长，默认使用self.nprobe
+        :return: 行号, distances 均为[m, k]，候选不足k个时行号为-1，距离为inf
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = np.expand_dims(queries, axis=0)
+        m = queries.shape[0]
+        out_rows = np.full((m, k), -1, dtype=np.int64)
+        out_dists = np.full((m, k), np.inf, dtype=np.float32)
+
+        nprobe = min(nprobe or self.nprobe, len(lists))
+        if self.centroids is None:
+            probes = np.zeros((m, 1), dtype=np.int64)
+        else:
+            probes = topk_smallest(pairwise_distance(queries, self.centroids, self.metric), nprobe)
+
+        scales = state["scales"]
+        for i in range(m):
+            buckets = [lists[list_id] for list_id in probes[i] if len(lists[list_id]) > 0]
+            if not buckets:
+                continue
+            rows = np.concatenate(buckets)
+            top, dist = chunked_topk(queries[i:i + 1], state["embeddings"][rows], state["sq_norms"][rows], k,
+                                     self.metric, scales=None if scales is None else scales[rows])
+            n = top.shape[1]
+            out_rows[i, :n] = rows[top[0]]
+            out_dists[i, :n] = dist[0]
+        return out_rows, out_dists
+
+    def save(self, path, uuids):
+        """
+        保存索引，桶中的行号转换为特征编号，加载时再对应到特征库的行
+        先写临时文件再替换，避免其它进程读到不完整的文件
+        :param uuids: Gallery的特征编号，下标为行号
+        """
+        lists = self._lists
+        offsets = np.cumsum([0] + [len(rows) for rows in lists])
+        dim = 0 if self.centroids is None else self.centroids.shape[1]
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f,
+                     metric=np.array(self.metric),
+                     nlist=np.array(self.nlist),
+                     nprobe=np.array(self.nprobe),
+                     centroids=np.empty((0, dim), dtype=np.float32) if self.centroids is None else self.centroids,
+                     offsets=offsets,
+                     uuids=np.concatenate([uuids[rows] for rows in lists]))
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path):
+        """
+        :return: 只有聚类中心的IVFIndex, 保存的特征编号, 对应的桶编号
+        """
+        with np.load(path) as data:
+            index = IVFIndex(metric=str(data["metric"]), nlist=int(data["nlist"]), nprobe=int(data["nprobe"]))
+            centroids = data["centroids"]
+            index.centroids = centroids if len(centroids) > 0 else None
+            offsets = data["offsets"]
+            uuids = data["uuids"]
+        index.reset()
+        list_ids = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        return index, uuids, list_ids
+
+    @staticmethod
+    def from_gallery(gallery, path=None, nlist=1024, nprobe=16):
+        """
+        为特征库创建索引：存在离线构建的索引文件时按特征编号对应到特征库的行，新增的特征重新分配桶，否则直接训练
+        :param gallery: app.facelib.gallery.Gallery
+        :param path: 索引文件
+        :param nlist:
+        :param nprobe:
+        :return: IVFIndex
+        """
+        uuids = gallery.uuids
+        if path is not None and os.path.exists(path):
+            index, stored, list_ids = IVFIndex.load(path)
+            if index.metric != gallery.metric:
+                raise ValueError(f"索引距离度量与特征库不一致: {index.metric} != {gallery.metric}")
+            index.nprobe = nprobe
+            order = np.argsort(stored)
+            stored, list_ids = stored[order], list_ids[order]
+            pos = np.minimum(np.searchsorted(stored, uuids), max(len(stored) - 1, 0))
+            found = stored[pos] == uuids if len(stored) else np.zeros(len(uuids), dtype=bool)
+            assign = np.empty(len(uuids), dtype=np.int64)
+            assign[found] = list_ids[pos[found]]
+            missing = ~found
+            if np.any(missing):
+                assign[missing] = index.assign(gallery.get_embeddings(uuids[missing]))
+            index._insert(np.arange(len(uuids)), assign)
+            logger.info(f"IVF Index Loaded: {len(index)} embeddings, {int(np.count_nonzero(missing))} added")
+            return index
+
+        index = IVFIndex(metric=gallery.metric, nlist=nlist, nprobe=nprobe)
+        if len(uuids) > 0:
+            index.build(gallery.embeddings)
+        logger.info(f"IVF Index Built: {len(index)} embeddings")
+        return index
+
+
+def build_index(path, nlist=1024, nprobe=16, n_iter=20):
+    """
+    从Embeddings表离线构建索引，需要在app_context中调用
+    """
+    from app.facelib.face_recogni import FaceRecogni
+    from app.facelib.gallery import Gallery
+
+    config = FaceRecogni.load_config()
+    gallery = Gallery(metric=config["metric"], model_version=FaceRecogni.fingerprint(config)).load_from_db()
+    index = IVFIndex(metric=gallery.metric, nlist=nlist, nprobe=nprobe)
+    index.build(gallery.embeddings, n_iter=n_iter)
+    index.save(path, gallery.uuids)
+    return index
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    from app.config import BaseConfig
+    from app import create_app
+    from app.facelib.face_recogni import FaceRecogni
+    from app.facelib.gallery import Gallery
+
+    parser = argparse.ArgumentParser(description="从Embeddings表离线构建当前模型版本的IVF索引")
+    parser.add_argument("--path", default=None, help="默认为服务启动时加载的路径")
+    parser.add_argument("--nlist", type=int, default=BaseConfig.IVF_NLIST)
+    parser.add_argument("--nprobe", type=int, default=BaseConfig.IVF_NPROBE)
+    parser.add_argument("--iter", type=int, default=20)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    path = args.path or Gallery.snapshot_path(BaseConfig.GALLERY_INDEX_PATH,
+                                              FaceRecogni.fingerprint(FaceRecogni.load_config()))
+    application = create_app()
+    begin = time.time()
+    with application.app_context():
+        ivf = build_index(path, nlist=args.nlist, nprobe=args.nprobe, n_iter=args.iter)
+    logger.info(f"{len(ivf)} embeddings, {len(ivf.centroids)} lists, time used: {time.time() - begin:3.3f}s")
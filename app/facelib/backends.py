@@ -0,0 +1,89 @@
+"""
+backends.py
+人脸识别模型的推理后端，由模型配置 config.yaml 的 format 字段选择
+    KERAS   tf.keras load_model 加载 SavedModel/h5 (默认)
+    TFLITE  tflite_runtime 或 tf.lite 解释器
+    ONNX    onnxruntime CPU
+各后端的输入均为预处理后的 float32 [batch,height,width,channel]，输出为未正则化的特征 [batch,dim]
+TFLITE/ONNX 不需要导入完整的TensorFlow，单个进程的启动时间与内存占用更小
+python -m app.facelib.convert 将Keras模型转换为其它格式
+"""
+import logging
+
+import numpy as np
+
+from .executor import native_lock
+
+logger = logging.getLogger(__name__)
+
+
+class KerasBackend:
+
+    def __init__(self, model_path, num_threads=None):
+        from tensorflow.keras.models import load_model
+        self.model = load_model(model_path)
+
+    def __call__(self, inputs) -> np.ndarray:
+        return np.asarray(self.model(inputs, training=False))
+
+
+class TFLiteBackend:
+
+    def __init__(self, model_path, num_threads=None):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+        self.interpreter = Interpreter(model_path=model_path, num_threads=num_threads)
+        self.input_index = self.interpreter.get_input_details()[0]["index"]
+        self.output_index = self.interpreter.get_output_details()[0]["index"]
+        self.batch_size = None
+        # 解释器不是线程安全的，推理线程池(INFERENCE_WORKERS)与预热依次使用
+        self._lock = native_lock()
+
+    def __call__(self, inputs) -> np.ndarray:
+        inputs = np.ascontiguousarray(inputs, dtype=np.float32)
+        with self._lock:
+            if inputs.shape[0] != self.batch_size:  # 批大小变化时重新分配张量
+                self.interpreter.resize_tensor_input(self.input_index, list(inputs.shape))
+                self.interpreter.allocate_tensors()
+                self.batch_size = inputs.shape[0]
+            self.interpreter.set_tensor(self.input_index, inputs)
+            self.interpreter.invoke()
+            return self.interpreter.get_tensor(self.output_index).copy()
+
+
+class ONNXBackend:
+
+    def __init__(self, model_path, num_threads=None):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(model_path, sess_options=options,
+                                                    providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, inputs) -> np.ndarray:
+        inputs = np.ascontiguousarray(inputs, dtype=np.float32)
+        return self.session.run(None, {self.input_name: inputs})[0]
+
+
+BACKENDS = {
+    "KERAS": KerasBackend,
+    "TFLITE": TFLiteBackend,
+    "ONNX": ONNXBackend,
+}
+
+
+def load_backend(model_format, model_path, num_threads=None):
+    """
+    :param model_format: config.yaml 的 format，不是TFLITE/ONNX时按Keras加载
+    :param model_path: 模型路径
+    :param num_threads: 推理线程数，None表示后端默认
+    :return: callable(inputs) -> np.ndarray
+    """
+    backend = BACKENDS.get(model_format.upper(), KerasBackend)
+    logger.info(f"FaceRecogni Backend: {backend.__name__} {model_path}")
+    return backend(model_path, num_threads=num_threads)
@@ -0,0 +1,165 @@
+"""
+batcher.py
+推理微批处理：合并并发请求的人脸图片，凑满max_batch或等待max_wait_ms后执行一次前向计算，再按请求拆分结果
+gevent monkey patch 后线程与队列均为协程实现，等待结果时不阻塞其它请求
+队列与事件只能在创建时所在的hub中使用，需要在主线程中创建(见 executor.call_in_main_hub)，
+其它原生线程(热切换后的重新编码等)提交时直接计算
+"""
+import time
+import queue
+import logging
+import threading
+from collections import Counter, deque
+
+import numpy as np
+
+from .executor import current_hub
+
+logger = logging.getLogger(__name__)
+
+
+class _Request:
+    __slots__ = ("inputs", "enqueue_time", "event", "result", "error")
+
+    def __init__(self, inputs):
+        self.inputs = inputs
+        self.enqueue_time = time.perf_counter()
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class InferenceBatcher:
+
+    def __init__(self, forward, max_batch=32, max_wait_ms=5.0, history=1024):
+        """
+        :param forward: callable([batch, ...] np.ndarray) -> [batch, dim] np.ndarray
+        :param max_batch: 每次前向计算的最大图片数，单个请求超出时单独计算
+        :param max_wait_ms: 收到第一个请求后等待其它请求的最长时间/毫秒
+        :param history: 保留最近多少个请求的等待时间用于统计分位数
+        """
+        self.forward = forward
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._pending = 0  # 队列中的图片数
+        self._lock = threading.Lock()
+        self._running = True
+        self._carry = None  # 上一批放不下的请求
+        self.batch_sizes = Counter()  # 每次前向计算的图片数 -> 次数
+        self.waits = deque(maxlen=history)  # 请求从入队到开始计算的时间/秒
+        self.batches = 0
+        self.requests = 0
+        self._hub = current_hub()
+        self._thread = threading.Thread(target=self._loop, name="InferenceBatcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, inputs) -> np.ndarray:
+        """
+        提交预处理后的图片，阻塞等待结果
+        :param inputs: [n, ...] np.ndarray
+        :return: [n, dim]
+        """
+        if self._foreign():
+            return self.forward(inputs)
+        request = _Request(inputs)
+        with self._lock:
+            self._pending += len(inputs)
+        self._queue.put(request)
+        request.event.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _collect(self):
+        """
+        取出一批请求：阻塞等待第一个请求，之后在max_wait内尽量凑满max_batch
+        """
+        first, self._carry = self._carry, None
+        if first is None:
+            first = self._queue.get()
+        if first is None:  # stop
+            return []
+        batch, size = [first], len(first.inputs)
+        deadline = time.perf_counter() + self.max_wait
+        while size < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                request = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                break
+            if size + len(request.inputs) > self.max_batch:  # 超出的请求作为下一批的第一个
+                self._carry = request
+                break
+            batch.append(request)
+            size += len(request.inputs)
+        return batch
+
+    def _run(self, batch):
+        begin = time.perf_counter()
+        sizes = [len(request.inputs) for request in batch]
+        total = sum(sizes)
+        with self._lock:
+            self._pending -= total
+            self.batch_sizes[total] += 1
+            self.batches += 1
+            self.requests += len(batch)
+            self.waits.extend(begin - request.enqueue_time for request in batch)
+        try:
+            inputs = batch[0].inputs if len(batch) == 1 else np.concatenate([r.inputs for r in batch], axis=0)
+            outputs = self.forward(inputs)
+            offsets = np.cumsum([0] + sizes)
+            for request, start, end in zip(batch, offsets[:-1], offsets[1:]):
+                request.result = outputs[start:end]
+        except Exception as e:
+            logger.exception("Inference Batch Failed")
+            for request in batch:
+                request.error = e
+        for request in batch:
+            request.event.set()
+
+    def _loop(self):
+        while self._running:
+            batch = self._collect()
+            if batch:
+                self._run(batch)
+
+    def _foreign(self):
+        """
+        在其它线程的hub中调用，不能使用队列与事件
+        """
+        return self._hub is not None and current_hub() is not self._hub
+
+    def stop(self):
+        self._running = False
+        if self._foreign():  # 交给创建时的hub，不等待循环结束
+            self._hub.loop.run_callback_threadsafe(self._queue.put_nowait, None)
+            return
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+
+    @property
+    def queue_depth(self):
+        """
+        :return: 等待中的请求数, 图片数
+        """
+        return self._queue.qsize(), self._pending
+
+    def stats(self):
+        with self._lock:
+            waits = np.array(self.waits, dtype=np.float64) * 1000
+            depth_requests, depth_images = self._queue.qsize(), self._pending
+            images = sum(size * count for size, count in self.batch_sizes.items())
+            return dict(
+                queue_requests=depth_requests,
+                queue_images=depth_images,
+                batches=self.batches,
+                requests=self.requests,
+                batch_sizes={str(size): count for size, count in sorted(self.batch_sizes.items())},
+                mean_batch_size=images / self.batches if self.batches else 0.0,
+                wait_ms=dict(p50=float(np.percentile(waits, 50)) if len(waits) else 0.0,
+                             p99=float(np.percentile(waits, 99)) if len(waits) else 0.0,
+                             max=float(np.max(waits)) if len(waits) else 0.0)
+            )
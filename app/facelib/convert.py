@@ -0,0 +1,143 @@
+"""
+convert.py
+将Keras人脸识别模型转换为TFLite/ONNX，并检查转换前后特征的一致性
+python -m app.facelib.convert --format tflite
+python -m app.facelib.convert --format onnx --check
+转换完成后修改模型配置 config.yaml 的 name 与 format 即可切换推理后端
+模型指纹包含权重文件的内容哈希，转换后的文件不同，需要将检查结果中的 model_version(转换前的指纹)
+写入 config.yaml，指纹保持不变，已保存的特征无需重新编码
+ONNX转换需要安装 tf2onnx
+"""
+import os
+import sys
+
+project_path = os.path.join(os.path.dirname(__file__), os.path.pardir, os.path.pardir)
+sys.path.append(project_path)
+
+import time
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SUFFIX = {"tflite": ".tflite", "onnx": ".onnx"}
+
+
+def convert_tflite(keras_path, output_path):
+    import tensorflow as tf
+    model = tf.keras.models.load_model(keras_path)
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    with open(output_path, "wb") as f:
+        f.write(converter.convert())
+
+
+def convert_onnx(keras_path, output_path, input_shape, opset=13):
+    import tensorflow as tf
+    import tf2onnx
+    model = tf.keras.models.load_model(keras_path)
+    height, width = input_shape[1], input_shape[0]
+    spec = (tf.TensorSpec((None, height, width, 3), tf.float32, name="input"),)
+    tf2onnx.convert.from_keras(model, input_signature=spec, opset=opset, output_path=output_path)
+
+
+def parity_report(reference, candidate, inputs, threshold, metric="l2", batch_size=16):
+    """
+    比较两个后端在相同输入上的特征
+    :param reference: 参考后端 callable(inputs) -> embeddings
+    :param candidate: 待比较的后端
+    :param inputs: 预处理后的图片 [n,height,width,channel]
+    :param threshold: 模型阈值，统计两两比对结果的一致率
+    :param metric:
+    :param batch_size:
+    :return: dict
+    """
+    from .distance import l2_normalize, condensed_distance
+
+    def run(backend):
+        outputs, elapsed = [], 0.0
+        for begin in range(0, len(inputs), batch_size):
+            enter = time.perf_counter()
+            outputs.append(backend(inputs[begin:begin + batch_size]))
+            elapsed += time.perf_counter() - enter
+        return l2_normalize(np.vstack(outputs)), elapsed
+
+    ref, ref_time = run(reference)
+    out, out_time = run(candidate)
+    cosine = np.sum(ref * out, axis=1)
+    ref_dist = condensed_distance(ref, metric)
+    out_dist = condensed_distance(out, metric)
+    agreement = np.mean((ref_dist <= threshold) == (out_dist <= threshold)) if len(ref_dist) else 1.0
+    return dict(
+        n=len(inputs),
+        max_abs_diff=float(np.max(np.abs(ref - out))),
+        min_cosine=float(np.min(cosine)),
+        max_dist_diff=float(np.max(np.abs(ref_dist - out_dist))) if len(ref_dist) else 0.0,
+        decision_agreement=float(agreement),
+        reference_ms_per_image=1000 * ref_time / len(inputs),
+        candidate_ms_per_image=1000 * out_time / len(inputs),
+    )
+
+
+def load_images(folder, limit):
+    """
+    读取文件夹中的人脸图片作为一致性检查的输入
+    :return: list of RGB np.ndarray
+    """
+    import cv2
+    images = []
+    for name in sorted(os.listdir(folder))[:limit]:
+        image = cv2.imread(os.path.join(folder, name))
+        if image is not None:
+            images.append(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+    return images
+
+
+if __name__ == '__main__':
+    import json
+    import argparse
+
+    from app.facelib.backends import load_backend, KerasBackend
+    from app.facelib.face_recogni import FaceRecogni
+
+    parser = argparse.ArgumentParser(description="转换人脸识别模型并检查特征一致性")
+    parser.add_argument("--format", choices=sorted(SUFFIX), required=True)
+    parser.add_argument("--output", default=None, help="默认与Keras模型同名，保存在模型目录")
+    parser.add_argument("--check", action="store_true", help="转换后检查特征一致性")
+    parser.add_argument("--skip-convert", action="store_true", help="只检查已转换的模型")
+    parser.add_argument("--images", default=None, help="一致性检查使用的人脸图片文件夹，默认使用随机图片")
+    parser.add_argument("--samples", type=int, default=64)
+    parser.add_argument("--tolerance", type=float, default=1e-3, help="特征余弦相似度允许的最大偏差")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    config = FaceRecogni.load_config()
+    keras_path = os.path.abspath(os.path.join(FaceRecogni.active_model_root(), config["name"]))
+    output = args.output or os.path.splitext(keras_path.rstrip(os.sep))[0] + SUFFIX[args.format]
+
+    if not args.skip_convert:
+        begin = time.time()
+        if args.format == "tflite":
+            convert_tflite(keras_path, output)
+        else:
+            convert_onnx(keras_path, output, config["input_shape"])
+        logger.info(f"Converted: {output}, time used: {time.time() - begin:3.3f}s")
+
+    if args.check:
+        handler = FaceRecogni()
+        handler.prepare()  # 按config.yaml加载参考模型，并使用相同的预处理
+        if args.images:
+            faces = handler.preprocessing(load_images(args.images, args.samples))
+        else:
+            rng = np.random.default_rng(0)
+            width, height = config["input_shape"][:2]
+            faces = handler.preprocessing(rng.integers(0, 256, (args.samples, height, width, 3)).astype(np.uint8))
+        reference = handler.load_model()
+        if not isinstance(reference, KerasBackend):
+            reference = KerasBackend(keras_path)
+        report = parity_report(reference, load_backend(args.format, output), faces,
+                               threshold=handler.threshold, metric=handler.metric)
+        report["passed"] = report["min_cosine"] >= 1.0 - args.tolerance and report["decision_agreement"] == 1.0
+        report["model_version"] = handler.model_version  # 切换后端时在config.yaml中显式指定
+        print(json.dumps(report, indent=2))
+        sys.exit(0 if report["passed"] else 1)
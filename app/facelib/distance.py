@@ -0,0 +1,150 @@
+"""
+distance.py
+检索与比对共用的距离计算，cosine与l2都由一次float32矩阵乘法得到：
+    cosine(a, b) = 1 - a·b / (|a||b|)
+    l2(a, b)^2 = |a|^2 + |b|^2 - 2a·b，特征已L2正则化时为 2 - 2a·b
+特征数较多时按块计算并合并topk，临时内存只与块大小有关
+"""
+import numpy as np
+
+
+def normalize_metric(metric):
+    """
+    统一距离度量名称
+    :param metric: "l2"|"euclidean"|"cosine"
+    :return: "l2"|"cosine"
+    """
+    metric = metric.lower()
+    if metric in ("l2", "euclidean"):
+        return "l2"
+    if metric != "cosine":
+        raise ValueError(f"不支持的距离度量: {metric}")
+    return metric
+
+
+def l2_normalize(embeddings) -> np.ndarray:
+    """
+    :param embeddings: [n, dim]
+    :return: [n, dim] float32，模长为1
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return embeddings / norms
+
+
+def dot_to_distance(dot, q_sq, g_sq, metric="l2") -> np.ndarray:
+    """
+    由内积与模长平方得到距离，原地修改dot
+    :param dot: [m, n] float32
+    :param q_sq: [m, 1] 或 None(已正则化)
+    :param g_sq: [n] 或 None(已正则化)
+    :param metric: "l2"|"cosine"
+    :return: [m, n]
+    """
+    if metric == "cosine":
+        if q_sq is not None and g_sq is not None:
+            dot /= np.sqrt(q_sq * g_sq)
+        np.subtract(1.0, dot, out=dot)
+        return dot
+    dot *= -2.0
+    dot += 2.0 if q_sq is None else q_sq
+    dot += 0.0 if g_sq is None else g_sq
+    np.maximum(dot, 0.0, out=dot)
+    return np.sqrt(dot, out=dot)
+
+
+def pairwise_distance(queries, gallery, metric="l2", normalized=False) -> np.ndarray:
+    """
+    通过一次矩阵乘法计算queries与gallery两两之间的距离
+    :param queries: [m, dim]
+    :param gallery: [n, dim]
+    :param metric: "l2"|"cosine"
+    :param normalized: 两者均已L2正则化，省去模长计算
+    :return: [m, n]
+    """
+    queries = np.asarray(queries, dtype=np.float32)
+    gallery = np.asarray(gallery, dtype=np.float32)
+    dot = queries @ gallery.T
+    if normalized:
+        return dot_to_distance(dot, None, None, metric)
+    q_sq = np.sum(np.square(queries), axis=1, keepdims=True)
+    g_sq = np.sum(np.square(gallery), axis=1)
+    return dot_to_distance(dot, q_sq, g_sq, metric)
+
+
+def norm_distance(queries, embeddings, sq_norms, metric="l2") -> np.ndarray:
+    """
+    使用预先计算的模长平方计算距离，检索时不再重复计算gallery的模长
+    :param queries: [m, dim]
+    :param embeddings: [n, dim] float32
+    :param sq_norms: [n]
+    :param metric: "l2"|"cosine"
+    :return: [m, n]
+    """
+    dot = queries @ embeddings.T
+    q_sq = np.sum(np.square(queries), axis=1, keepdims=True)
+    return dot_to_distance(dot, q_sq, sq_norms, metric)
+
+
+def condensed_distance(embeddings, metric="l2") -> np.ndarray:
+    """
+    两两距离的上三角，与 scipy.spatial.distance.pdist 的输出顺序一致
+    :param embeddings: [n, dim]
+    :param metric: "l2"|"euclidean"|"cosine"
+    :return: [n*(n-1)/2]
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    dist = pairwise_distance(embeddings, embeddings, normalize_metric(metric))
+    return dist[np.triu_indices(len(embeddings), k=1)]
+
+
+def topk_smallest(dist, k):
+    """
+    按行取距离最小的k个下标
+    :param dist: [m, n]
+    :param k: k <= n
+    :return: [m, k] 每行按距离升序
+    """
+    if k == 1:
+        return np.argmin(dist, axis=1)[:, None]
+    top = np.argpartition(dist, k - 1, axis=1)[:, :k]
+    order = np.argsort(np.take_along_axis(dist, top, axis=1), axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+
+def chunked_topk(queries, embeddings, sq_norms, k, metric="l2", scales=None, chunk_size=65536):
+    """
+    按块计算距离并合并各块的topk
+    :param queries: [m, dim] float32
+    :param embeddings: [n, dim] float32，或压缩存储的float16/int8
+    :param sq_norms: [n] 原始特征的模长平方
+    :param k:
+    :param metric: "l2"|"cosine"
+    :param scales: [n] int8的逐向量缩放系数
+    :param chunk_size: 每块的行数
+    :return: 行号[m, k], 距离[m, k]，每行按距离升序，k不超过n
+    """
+    n = embeddings.shape[0]
+    k = min(k, n)
+    q_sq = np.sum(np.square(queries), axis=1, keepdims=True)
+    rows, dists = None, None
+    for begin in range(0, n, chunk_size):
+        end = min(begin + chunk_size, n)
+        block = embeddings[begin:end]
+        if block.dtype != np.float32:  # 压缩存储时分块反量化
+            block = block.astype(np.float32)
+        dot = queries @ block.T
+        if scales is not None:
+            dot *= scales[begin:end]
+        dist = dot_to_distance(dot, q_sq, sq_norms[begin:end], metric)
+        top = topk_smallest(dist, min(k, end - begin))
+        top_dist = np.take_along_axis(dist, top, axis=1)
+        top += begin
+        if rows is None:
+            rows, dists = top, top_dist
+            continue
+        rows, dists = np.hstack([rows, top]), np.hstack([dists, top_dist])
+        merged = topk_smallest(dists, k)
+        rows, dists = np.take_along_axis(rows, merged, axis=1), np.take_along_axis(dists, merged, axis=1)
+    return rows, dists
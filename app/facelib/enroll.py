@@ -0,0 +1,294 @@
+"""
+enroll.py
+批量录入人脸：遍历按学号分文件夹的图片目录，经 检测->对齐->编码 流水线写入Embeddings表
+    root/
+        <userId>/xxx.jpg
+        <userId>/yyy.png
+python -m app.facelib.enroll --root D:\\photos\\class_2021
+图片在线程池中解码，每批batch_size张图片检测并编码，每chunk条特征提交一次事务
+完成的图片追加写入检查点文件，中断后使用相同参数重新运行即可从断点继续，
+提交事务前记录的特征编号用于删除中断时已提交但未记录完成的特征
+"""
+import os
+import sys
+
+project_path = os.path.join(os.path.dirname(__file__), os.path.pardir, os.path.pardir)
+sys.path.append(project_path)
+
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+logger = logging.getLogger(__name__)
+
+IMAGE_SUFFIX = (".jpg", ".jpeg", ".png", ".bmp")
+
+
+def scan(root):
+    """
+    :return: [(相对路径, 学号)] 按路径排序，多次运行的顺序一致
+    """
+    entries = []
+    for user_id in sorted(os.listdir(root)):
+        folder = os.path.join(root, user_id)
+        if not os.path.isdir(folder):
+            continue
+        for name in sorted(os.listdir(folder)):
+            if name.lower().endswith(IMAGE_SUFFIX):
+                entries.append((f"{user_id}/{name}", user_id))
+    return entries
+
+
+def read_image(path):
+    """
+    :return: RGB np.ndarray，读取失败时为None
+    """
+    image = cv2.imread(path)  # 解码时释放GIL，可以在线程池中并行
+    if image is None:
+        return None
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+class Checkpoint:
+    """
+    检查点文件，每行 "相对路径\t状态"，状态为 ok|noface|unreadable|nouser
+    特征所在的事务提交前先写入 "pending:特征编号:用户编号"，提交后再写入 ok，
+    中断后仍为pending的特征可能已经提交，重新运行时删除后重新录入，见 BulkEnroller.discard_uncommitted
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.done = {}
+        self.pending = {}  # 相对路径 -> (特征编号, 用户编号)
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    name, _, status = line.rstrip("\n").rpartition("\t")
+                    if not name:
+                        continue
+                    if status.startswith("pending:"):
+                        _, uuid, user_id = status.split(":")
+                        self.pending[name] = (int(uuid), int(user_id))
+                    else:
+                        self.done[name] = status
+                        self.pending.pop(name, None)
+
+    def _append(self, lines):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def prepare(self, items):
+        """
+        :param items: [(相对路径, 特征编号, 用户编号)]，在提交特征所在的事务之前记录
+        """
+        if not items:
+            return
+        self._append(f"{name}\tpending:{uuid}:{user_id}\n" for name, uuid, user_id in items)
+        self.pending.update((name, (uuid, user_id)) for name, uuid, user_id in items)
+
+    def record(self, items):
+        """
+        :param items: [(相对路径, 状态)]，特征所在的事务提交后再记录
+        """
+        if not items:
+            return
+        self._append(f"{name}\t{status}\n" for name, status in items)
+        self.done.update(items)
+        for name, _ in items:
+            self.pending.pop(name, None)
+
+
+class BulkEnroller:
+
+    def __init__(self, pipeline, checkpoint, batch_size=64, chunk_size=512, workers=4, sync=None):
+        """
+        :param pipeline: FacePipeline
+        :param checkpoint: Checkpoint
+        :param batch_size: 每次检测并编码的图片数，同时在内存中的图片不超过两批
+        :param chunk_size: 每个事务插入的特征数
+        :param workers: 解码线程数
+        :param sync: GallerySync，不为None时通知运行中的服务更新特征库
+        """
+        self.pipeline = pipeline
+        self.checkpoint = checkpoint
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.sync = sync
+        self._rows = []  # 未提交的 (相对路径, Embedding)
+        self.counts = dict(ok=0, noface=0, unreadable=0, nouser=0)
+        self.timings = dict(decode=0.0, detect=0.0, align=0.0, embed=0.0, insert=0.0)
+
+    def _decode(self, root, batch):
+        """
+        提交一批图片的解码，立即返回
+        :return: [Future]
+        """
+        return [self.pool.submit(read_image, os.path.join(root, name)) for name, _ in batch]
+
+    def _flush(self):
+        from app.extensions import db
+        if not self._rows:
+            return
+        begin = time.perf_counter()
+        names, rows = zip(*self._rows)
+        db.session.add_all(rows)
+        db.session.flush()  # 获取主键
+        uuids = [row.uuid for row in rows]
+        user_ids = [row.userId for row in rows]
+        self.checkpoint.prepare(list(zip(names, uuids, user_ids)))
+        db.session.commit()
+        db.session.expunge_all()
+        self.checkpoint.record([(name, "ok") for name in names])
+        if self.sync is not None:
+            self.sync.publish("add", uuids, user_ids)
+        self.counts["ok"] += len(rows)
+        self._rows = []
+        self.timings["insert"] += time.perf_counter() - begin
+
+    def discard_uncommitted(self):
+        """
+        删除上次运行在提交事务之后、记录检查点之前中断时已提交的特征，这些图片随后重新录入，不会重复
+        只删除检查点中记录的特征编号，不影响服务同时录入的特征，需要在app_context中调用
+        :return: 删除的特征数
+        """
+        from app.extensions import db
+        from app.models.models import Embedding
+
+        pending = set(self.checkpoint.pending.values())
+        uuids = sorted(uuid for uuid, _ in pending)
+        rows = []
+        for begin in range(0, len(uuids), 1000):
+            rows.extend(db.session.query(Embedding.uuid, Embedding.userId)
+                        .filter(Embedding.uuid.in_(uuids[begin:begin + 1000])).all())
+        rows = [(uuid, user_id) for uuid, user_id in rows if (uuid, user_id) in pending]
+        for begin in range(0, len(rows), 1000):
+            db.session.query(Embedding).filter(Embedding.uuid.in_([uuid for uuid, _ in rows[begin:begin + 1000]])) \
+                .delete(synchronize_session=False)
+        db.session.commit()
+        if rows and self.sync is not None:
+            self.sync.publish("remove", *zip(*rows))
+        self.checkpoint.pending.clear()
+        if rows:
+            logger.info(f"Enroll: {len(rows)} uncommitted embeddings discarded")
+        return len(rows)
+
+    def _process(self, batch, images, users):
+        from app.models.models import Embedding
+        from .pipeline import encode_face
+
+        skipped = []
+        valid = []
+        for (name, user_id), image in zip(batch, images):
+            if users.get(user_id) is None:
+                skipped.append((name, "nouser"))
+            elif image is None:
+                skipped.append((name, "unreadable"))
+            else:
+                valid.append((name, users[user_id], image))
+        if valid:
+            result = self.pipeline.run([image for _, _, image in valid])
+            for stage, ms in result.timings.items():
+                self.timings[stage] += ms / 1000
+            found = set(result.index.tolist())
+            skipped.extend((name, "noface") for i, (name, _, _) in enumerate(valid) if i not in found)
+            for i, embedding, face in zip(result.index, result.embeddings, result.faces):
+                name, user_uuid, _ = valid[i]
+                row = Embedding(embdBlob=embedding.tobytes(), base64Img=encode_face(face),
+                                modelVersion=self.pipeline.recogni.model_version, userId=user_uuid)
+                self._rows.append((name, row))
+        for name, status in skipped:
+            self.counts[status] += 1
+        self.checkpoint.record(skipped)
+        if len(self._rows) >= self.chunk_size:
+            self._flush()
+
+    def run(self, root, entries, users):
+        """
+        :param root: 图片目录
+        :param entries: [(相对路径, 学号)] 未完成的图片
+        :param users: {学号: Users.uuid}
+        :return: 处理的图片数
+        """
+        batches = [entries[i:i + self.batch_size] for i in range(0, len(entries), self.batch_size)]
+        if not batches:
+            return 0
+        begin = time.perf_counter()
+        pending = self._decode(root, batches[0])
+        for idx, batch in enumerate(batches):
+            enter = time.perf_counter()
+            images = [future.result() for future in pending]
+            self.timings["decode"] += time.perf_counter() - enter  # 只统计等待解码的时间
+            if idx + 1 < len(batches):  # 编码当前批时解码下一批
+                pending = self._decode(root, batches[idx + 1])
+            self._process(batch, images, users)
+            done = min((idx + 1) * self.batch_size, len(entries))
+            elapsed = time.perf_counter() - begin
+            logger.info(f"{done}/{len(entries)} images, {done / elapsed:.1f} images/s, {self.counts}")
+        self._flush()
+        return len(entries)
+
+    def close(self):
+        self.pool.shutdown()
+
+
+def load_users(user_ids):
+    """
+    :return: {学号: Users.uuid}
+    """
+    from app.models.models import User
+    users = {}
+    user_ids = sorted(set(user_ids))
+    for begin in range(0, len(user_ids), 1000):
+        for user in User.query.filter(User.userId.in_(user_ids[begin:begin + 1000])).all():
+            users[user.userId] = user.uuid
+    return users
+
+
+if __name__ == '__main__':
+    import json
+    import argparse
+
+    from app.config import BaseConfig
+    from app import create_app
+
+    parser = argparse.ArgumentParser(description="批量录入按学号分文件夹的人脸图片")
+    parser.add_argument("--root", required=True, help="图片目录，子文件夹名为学号")
+    parser.add_argument("--checkpoint", default=None, help="默认为 root/enroll.checkpoint")
+    parser.add_argument("--batch-size", type=int, default=BaseConfig.INFERENCE_MAX_BATCH * 2)
+    parser.add_argument("--chunk", type=int, default=512, help="每个事务插入的特征数")
+    parser.add_argument("--workers", type=int, default=BaseConfig.THREAD_NUM, help="解码线程数")
+    parser.add_argument("--publish", action="store_true", help="通过Redis通知运行中的服务更新特征库")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    from app.facelib.pipeline import FacePipeline
+    from app.facelib.sync import GallerySync
+
+    checkpoint = Checkpoint(args.checkpoint or os.path.join(args.root, "enroll.checkpoint"))
+    entries = scan(args.root)
+
+    application = create_app()
+    with application.app_context():
+        pipeline = FacePipeline.get_instance()
+        pipeline.recogni.load_model()
+        sync = GallerySync(application.config["SESSION_REDIS"]) if args.publish else None
+        enroller = BulkEnroller(pipeline, checkpoint, batch_size=args.batch_size, chunk_size=args.chunk,
+                                workers=args.workers, sync=sync)
+        enroller.discard_uncommitted()
+        todo = [entry for entry in entries if entry[0] not in checkpoint.done]
+        logger.info(f"{len(entries)} images, {len(entries) - len(todo)} done in checkpoint")
+        users = load_users(user_id for _, user_id in todo)
+        begin = time.perf_counter()
+        try:
+            n = enroller.run(args.root, todo, users)
+        finally:
+            enroller.close()
+        elapsed = time.perf_counter() - begin
+    report = dict(images=n, seconds=elapsed, images_per_second=n / elapsed if elapsed else 0.0,
+                  counts=enroller.counts, timings=enroller.timings)
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,179 @@
+"""
+executor.py
+将模型推理与特征检索放到原生线程中执行，避免CPU密集的计算阻塞gevent事件循环
+TensorFlow与numpy的计算会释放GIL，事件循环在计算期间仍可以处理其它请求(/init, /login等)
+未启用gevent monkey patch时(命令行工具等)直接在当前线程执行
+原生线程中没有Flask应用上下文，调用方在上下文中时在线程中推入同一个app的上下文(压缩存储重排时读取数据库等)
+gevent的队列、事件与协程绑定创建时所在线程的hub，原生线程的hub在任务结束后不再运行，
+在原生线程中创建长期使用的gevent对象(热切换时的微批处理等)需要通过 call_in_main_hub 交给主线程
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+_MAIN_HUB = None
+
+
+def _gevent_patched():
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched("threading")
+
+
+def native_lock():
+    """
+    原生线程之间使用的锁，启用monkey patch时使用patch之前的实现(patch后的锁只能在同一个hub中使用)
+    """
+    if not _gevent_patched():
+        import threading
+        return threading.Lock()
+    from gevent import monkey
+    return monkey.get_original("_thread", "allocate_lock")()
+
+
+def current_hub():
+    """
+    当前线程的gevent hub，未启用monkey patch时为None
+    """
+    if not _gevent_patched():
+        return None
+    from gevent import get_hub
+    return get_hub()
+
+
+def main_hub():
+    """
+    处理请求的主线程的gevent hub，在主线程中首次调用时记录，未启用monkey patch时为None
+    """
+    global _MAIN_HUB
+    if _MAIN_HUB is None and _gevent_patched():
+        from gevent.threading import main_native_thread
+        hub = current_hub()
+        if hub.thread_ident == main_native_thread().ident:
+            _MAIN_HUB = hub
+    return _MAIN_HUB
+
+
+def call_in_hub(hub, func, *args, **kwargs):
+    """
+    在指定hub的协程中执行并等待结果，调用方使用monkey patch之前的锁等待，不能在该hub所在的线程中调用
+    """
+    import gevent
+    done = native_lock()
+    done.acquire()
+    result = []
+
+    def run():
+        try:
+            result.append((True, func(*args, **kwargs)))
+        except BaseException as e:
+            result.append((False, e))
+        finally:
+            done.release()
+
+    hub.loop.run_callback_threadsafe(gevent.spawn, run)
+    done.acquire()
+    ok, value = result[0]
+    if not ok:
+        raise value
+    return value
+
+
+def call_in_main_hub(func, *args, **kwargs):
+    """
+    在主线程hub的协程中执行并等待结果，已在主线程中或未启用monkey patch时直接执行
+    """
+    hub = main_hub()
+    if hub is None or current_hub() is hub:
+        return func(*args, **kwargs)
+    return call_in_hub(hub, func, *args, **kwargs)
+
+
+def _with_app_context(func):
+    """
+    调用方在Flask应用上下文中时，在执行线程中推入同一个app的上下文，结束时释放数据库会话
+    """
+    from flask import current_app, has_app_context
+    if not has_app_context():
+        return func
+    application = current_app._get_current_object()
+
+    def wrapper(*args, **kwargs):
+        with application.app_context():
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+class Executor:
+    INSTANCES = {}
+
+    def __init__(self, name, workers):
+        """
+        :param name: 名称，只用于日志
+        :param workers: 原生线程数
+        """
+        self.name = name
+        self.workers = max(1, int(workers))
+        self._pool = None
+        if _gevent_patched():
+            from gevent.threadpool import ThreadPool
+            self._pool = ThreadPool(self.workers)
+            logger.info(f"Executor {name}: {self.workers} native threads")
+
+    def run(self, func, *args, **kwargs):
+        """
+        在线程池中执行并等待结果，只阻塞当前协程
+        """
+        if self._pool is None:
+            return func(*args, **kwargs)
+        return self._pool.apply(_with_app_context(func), args, kwargs)
+
+    def spawn(self, func, *args, **kwargs):
+        """
+        在线程池中执行，不等待结果，用于耗时较长的后台任务
+        未启用monkey patch时在新线程中执行
+        """
+        if self._pool is None:
+            import threading
+            thread = threading.Thread(target=func, args=args, kwargs=kwargs, name=self.name, daemon=True)
+            thread.start()
+            return thread
+        return self._pool.spawn(_with_app_context(func), *args, **kwargs)
+
+    def stats(self):
+        if self._pool is None:
+            return dict(name=self.name, workers=self.workers, native=False)
+        # 已提交尚未完成的任务数，包括正在执行的
+        return dict(name=self.name, workers=self.workers, native=True, pending=len(self._pool))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.kill()
+            self._pool = None
+
+    @staticmethod
+    def get_instance(name):
+        """
+        :param name: "inference"|"search"|"background" 热切换等后台任务，不占用推理与检索线程
+        """
+        if name not in Executor.INSTANCES:
+            from app.config import BaseConfig
+            workers = {"inference": BaseConfig.INFERENCE_WORKERS, "search": BaseConfig.SEARCH_WORKERS,
+                       "background": 1}[name]
+            Executor.INSTANCES[name] = Executor(name, workers)
+
+        return Executor.INSTANCES[name]
+
+
+def run_inference(func, *args, **kwargs):
+    return Executor.get_instance("inference").run(func, *args, **kwargs)
+
+
+def run_search(func, *args, **kwargs):
+    return Executor.get_instance("search").run(func, *args, **kwargs)
+
+
+main_hub()  # 在主线程中导入时记录主线程的hub
@@ -5,77 +5,198 @@ ref https://google.github.io/mediapipe/solutions/face_mesh.html
 
 import cv2
 import glob
-import mediapipe as mp
+import queue
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
 
-# mp_drawing = mp.solutions.drawing_utils
-# mp_drawing_styles = mp.solutions.drawing_styles
-mp_face_mesh = mp.solutions.face_mesh
+import numpy as np
+
+NUM_LANDMARKS = 478  # refine_landmarks=True 时包含虹膜关键点
+
+Detection = namedtuple("Detection", ["image", "landmarks", "boxes"])
+
+
+def _empty():
+    return np.zeros((0, NUM_LANDMARKS, 3), dtype=np.float32), np.zeros((0, 4), dtype=np.float32)
+
+
+def _face_mesh():
+    # mediapipe导入较慢，使用时再导入
+    import mediapipe as mp
+    return mp.solutions.face_mesh
+
+
+class FaceMeshPool:
+    """
+    已初始化的FaceMesh实例池，FaceMesh不是线程安全的，每个线程(请求)同时只使用一个实例
+    实例按需创建，最多maxsize个，用完时等待其它请求归还
+    """
+
+    def __init__(self, maxsize=4, static_image_mode=True, max_num_faces=1, min_detection_confidence=0.5):
+        """
+        :param maxsize: 最大实例数，与并发处理图片的线程数一致
+        :param static_image_mode: True每张图片独立检测，False对连续帧跟踪
+        :param max_num_faces:
+        :param min_detection_confidence:
+        """
+        self.maxsize = maxsize
+        self.options = dict(static_image_mode=static_image_mode,
+                            max_num_faces=max_num_faces,
+                            refine_landmarks=True,
+                            min_detection_confidence=min_detection_confidence)
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _create(self):
+        return _face_mesh().FaceMesh(**self.options)
+
+    def prewarm(self, n=1):
+        """
+        预先创建实例，首次检测不再加载模型
+        """
+        for _ in range(min(n, self.maxsize) - self._created):
+            with self._lock:
+                if self._created >= self.maxsize:
+                    break
+                self._created += 1
+            self._idle.put(self._create())
+
+    @contextmanager
+    def acquire(self, timeout=None):
+        """
+        取出一个实例，退出时归还
+        :param timeout: 等待时间/秒，None表示一直等待
+        """
+        try:
+            face_mesh = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._created < self.maxsize
+                if create:
+                    self._created += 1
+            face_mesh = self._create() if create else self._idle.get(timeout=timeout)
+        try:
+            yield face_mesh
+        finally:
+            if not self.options["static_image_mode"] and hasattr(face_mesh, "reset"):
+                face_mesh.reset()  # 清除上一个视频流的跟踪状态
+            self._idle.put(face_mesh)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+            with self._lock:
+                self._created -= 1
 
 
 class LandmarkDetector:
+    INSTANCE = None
 
-    def detect(self, images):
+    def __init__(self, pool_size=4, max_num_faces=1, min_detection_confidence=0.5):
         """
-        检测图片中的人脸及关键点
+        :param pool_size: 每种模式的FaceMesh实例数
+        :param max_num_faces: 每张图片最多检测的人脸数
+        :param min_detection_confidence:
+        """
+        self.pool = FaceMeshPool(pool_size, static_image_mode=True, max_num_faces=max_num_faces,
+                                 min_detection_confidence=min_detection_confidence)
+        self.stream_pool = FaceMeshPool(pool_size, static_image_mode=False, max_num_faces=max_num_faces,
+                                        min_detection_confidence=min_detection_confidence)
+        self.ready = False  # 检测使用的FaceMesh实例已预先创建
+
+    def prewarm(self, n=1):
+        """
+        启动时预先创建检测使用的FaceMesh实例，首个请求不再加载模型
+        :param n: 实例数，一般为 LANDMARK_POOL_SIZE
+        """
+        self.pool.prewarm(n)
+        self.ready = True
+
+    @staticmethod
+    def _parse(image, results):
+        """
+        转换FaceMesh的检测结果，每个人脸的关键点写入预分配数组的对应位置
+        :return: landmarks [n_faces,478,3] 像素坐标(x,y)与相对深度z, boxes [n_faces,4] left,top,right,bottom
+        """
+        multi_face = results.multi_face_landmarks
+        if not multi_face:
+            return _empty()
+        h, w = image.shape[:2]
+        landmarks = np.empty((len(multi_face), len(multi_face[0].landmark), 3), dtype=np.float32)
+        for out, face in zip(landmarks, multi_face):
+            out[:] = np.array([(p.x, p.y, p.z) for p in face.landmark], dtype=np.float32)
+        landmarks[..., :2] *= np.array([w, h], dtype=np.float32)
+        xy = landmarks[..., :2]
+        boxes = np.concatenate([xy.min(axis=1), xy.max(axis=1)], axis=1)  # 最小人脸框
+        return landmarks, boxes
+
+    def detect(self, images, rgb=False):
+        """
+        检测图片中的人脸及关键点，每张图片只读取一次
         :param images: List of images|paths
-        :return: faces in each images [[{boundingbox:[left,top,right,bottom],landmarks:[[x,y,z]...]}]]
+        :param rgb: 传入的图片为RGB而不是BGR，不能与路径混用
+        :return: 与images一一对应的 [Detection(image, landmarks, boxes)]
+            image 解码后的BGR图片，读取失败时为None
+            landmarks [n_faces,478,3], boxes [n_faces,4]，未检测到人脸时n_faces为0
         """
-        faces = []
-        with mp_face_mesh.FaceMesh(
-                static_image_mode=True,
-                max_num_faces=1,
-                refine_landmarks=True,
-                min_detection_confidence=0.50) as face_mesh:
-            for idx, file in enumerate(images):
-                if isinstance(file, str):
-                    image = cv2.imread(file)
-                else:
-                    image = file
-                h, w, c = image.shape
-                # Convert the BGR image to RGB before processing.
-                results = face_mesh.process(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
-                # Print and draw face mesh landmarks on the image.
-                if not results.multi_face_landmarks:
+        detections = []
+        with self.pool.acquire() as face_mesh:
+            for file in images:
+                image = cv2.imread(file) if isinstance(file, str) else file
+                if image is None:
+                    detections.append(Detection(None, *_empty()))
                     continue
+                # Convert the BGR image to RGB before processing.
+                results = face_mesh.process(image if rgb else cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+                detections.append(Detection(image, *self._parse(image, results)))
+        return detections
 
-                # faces in image
-                faces_in_image = []
-                for face_landmarks in results.multi_face_landmarks:
-                    face = {"boundingbox": None, "landmarks": []}
-                    x_min, y_min, x_max, y_max = 1e4, 1e4, -1e4, -1e4  # 最小人脸框
-
-                    for landmark in face_landmarks.landmark:  # 转换保存格式
-                        x, y, z = landmark.x * w, landmark.y * h, landmark.z
-                        x_min = min(x, x_min)
-                        y_min = min(y, y_min)
-                        x_max = max(x, x_max)
-                        y_max = max(y, y_max)
-                        face["landmarks"].append((x, y, z))
-                    face["boundingbox"] = [x_min, y_min, x_max, y_max]
-                    faces_in_image.append(face)
-                faces.append(faces_in_image)
-        return faces
+    @contextmanager
+    def stream(self):
+        """
+        视频流模式，对连续帧跟踪人脸，比逐帧独立检测更快
+        with detector.stream() as process:
+            for frame in frames:
+                detection = process(frame)
+        :return: callable(BGR frame) -> Detection，格式同detect的单张图片
+        """
+        with self.stream_pool.acquire() as face_mesh:
+            def process(frame):
+                results = face_mesh.process(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+                return Detection(frame, *self._parse(frame, results))
+
+            yield process
 
-    def crop_faces(self, images, annotations):
+    @staticmethod
+    def crop_faces(detections):
         """
-        从图片中裁剪人脸
-        :param images:
-        :param annotations: return from LandmarkDetector.detect
-        :return: List of faces
+        从detect已解码的图片中裁剪人脸，不再重复读取文件
+        :param detections: return from LandmarkDetector.detect
+        :return: List of faces in each image
         """
         faces = []
-        for idx, image in enumerate(images):
-            if isinstance(image, str):
-                image = cv2.imread(image)
-            faces_in_image = []
-            for face in annotations[idx]:
-                bbox = face["boundingbox"]
-                left, top, right, bottom = list(map(int, bbox))
-                crop = image[top:bottom, left:right, :]
-                faces_in_image.append(crop)
-            faces.append(faces_in_image)
+        for detection in detections:
+            if detection.image is None or not len(detection.boxes):
+                faces.append([])
+                continue
+            h, w = detection.image.shape[:2]
+            boxes = np.clip(detection.boxes, 0, [w, h, w, h]).astype(np.int32)
+            faces.append([detection.image[top:bottom, left:right] for left, top, right, bottom in boxes])
         return faces
 
+    @staticmethod
+    def get_instance():
+        if LandmarkDetector.INSTANCE is None:
+            from app.config import BaseConfig
+            LandmarkDetector.INSTANCE = LandmarkDetector(pool_size=BaseConfig.LANDMARK_POOL_SIZE)
+
+        return LandmarkDetector.INSTANCE
+
 
 if __name__ == '__main__':
     import os
@@ -84,13 +205,15 @@ if __name__ == '__main__':
     IMAGE_FILES = glob.glob(r"D:\Repository\Datasets\facev5_160\**\*.png")
     Detector = LandmarkDetector()
     ret = Detector.detect(IMAGE_FILES)
-    faces = Detector.crop_faces(IMAGE_FILES, ret)
+    faces = Detector.crop_faces(ret)
     dst_root = r"D:\MyProjects\PyCharm\face_recogni_server\test\casia_v5"
 
     for idx, image in enumerate(IMAGE_FILES):
         _, name = os.path.split(image)
         if idx % 5 == 0:
             os.makedirs(os.path.join(dst_root, name[:3]), exist_ok=True)
+        if not faces[idx]:
+            continue
         face = faces[idx][0]
         face = cv2.resize(face, (112, 112))
         cv2.imwrite(os.path.join(dst_root, name[:3], name), face)
@@ -5,16 +5,18 @@ project_path = os.path.join(os.path.dirname(__file__), os.path.pardir)
 sys.path.append(project_path)
 
 from app.config import BaseConfig
-from .utils import resize_image
+from .utils import letterbox_into
+from .distance import condensed_distance
+from .executor import run_inference
+from .backends import load_backend
 
 import time
+import json
+import hashlib
 import logging
+import threading
 import yaml
 import numpy as np
-import tensorflow as tf
-from tensorflow.keras import Model
-from tensorflow.keras.models import load_model
-from scipy.spatial.distance import pdist
 
 logger = None
 
@@ -30,9 +32,10 @@ def timeit(prefix):
     def decorator(func):
         def inner(*args, **kwargs):
             enter_time = time.time()
-            func(*args, **kwargs)
+            result = func(*args, **kwargs)
             exit_time = time.time()
             logger.info(f"{prefix}time used: {exit_time - enter_time:3.3f}s")
+            return result
 
         return inner
 
@@ -41,26 +44,120 @@ def timeit(prefix):
 
 class FaceRecogni:
     INSTANCE = None
+    _weights_hashes = {}  # 模型路径 -> (文件大小与修改时间, 内容哈希)
 
-    def __init__(self):
+    def __init__(self, model_root=None):
+        """
+        :param model_root: 模型目录(包含config.yaml)，None表示当前启用的模型，见 active_model_root
+        """
+        self.model_root = model_root
+        self.model_version = None  # 模型指纹，特征按此区分
         self.metric = None
         self.model_format = None
         self.model_path = None
         self.input_shape = None
         self.output_shape = None
-        self.normalize = None
         self.config = None
         self.model = None
         self.threshold = None
+        self.batcher = None
+        self._scale = None
+        self._shift = None
+        self._buffers = []  # 空闲的预处理缓冲区 [capacity,height,width,3] float32
+        self._buffers_lock = threading.Lock()
+        self._model_lock = threading.Lock()
+        self.ready = False  # 模型已加载并完成预热
+        self.warm_up_stats = {}  # 批大小 -> 预热耗时
+
+    @staticmethod
+    def active_model_root():
+        """
+        当前启用的模型目录：FACE_RECOGNI_ACTIVE 文件中记录的目录，不存在时为 FACE_RECOGNI_MODEL_PATH
+        """
+        if os.path.exists(BaseConfig.FACE_RECOGNI_ACTIVE):
+            with open(BaseConfig.FACE_RECOGNI_ACTIVE, 'r', encoding="utf-8") as f:
+                model_root = f.read().strip()
+            if model_root:
+                return model_root
+        return BaseConfig.FACE_RECOGNI_MODEL_PATH
+
+    @staticmethod
+    def activate(model_root):
+        """
+        切换启用的模型目录，写入临时文件后原子替换
+        """
+        tmp_path = f"{BaseConfig.FACE_RECOGNI_ACTIVE}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding="utf-8") as f:
+            f.write(os.path.abspath(model_root))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, BaseConfig.FACE_RECOGNI_ACTIVE)
+
+    @staticmethod
+    def load_config(model_root=None):
+        """
+        读取模型配置 config.yaml
+        :param model_root: 模型目录，None表示当前启用的模型
+        :return: dict
+        """
+        config_yaml = os.path.join(model_root or FaceRecogni.active_model_root(), "config.yaml")
+        with open(config_yaml, 'r', encoding="utf-8") as stream:
+            return yaml.safe_load(stream)
+
+    @staticmethod
+    def weights_hash(model_path):
+        """
+        模型权重的内容哈希，SavedModel目录按相对路径与内容计算
+        按路径缓存，文件大小与修改时间不变时不重新读取
+        :return: 40位十六进制字符串，权重不存在时为None
+        """
+        if os.path.isdir(model_path):
+            files = sorted(os.path.join(root, name) for root, _, names in os.walk(model_path) for name in names)
+        elif os.path.exists(model_path):
+            files = [model_path]
+        else:
+            return None
+        stats = [(os.path.relpath(path, model_path), os.stat(path)) for path in files]
+        signature = tuple((name, stat.st_size, stat.st_mtime_ns) for name, stat in stats)
+        cached = FaceRecogni._weights_hashes.get(model_path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        sha1 = hashlib.sha1()
+        for (name, _), path in zip(stats, files):
+            sha1.update(name.encode("utf-8"))
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    sha1.update(chunk)
+        FaceRecogni._weights_hashes[model_path] = (signature, sha1.hexdigest())
+        return sha1.hexdigest()
+
+    @staticmethod
+    def fingerprint(config, model_root=None):
+        """
+        模型指纹，由权重文件的内容哈希与影响特征的配置(预处理、距离等)计算，替换权重后指纹随之改变
+        转换为TFLite/ONNX后权重文件不同，指纹也会改变：--check 一致性检查通过后，
+        在 config.yaml 中用 model_version 显式指定转换前的指纹，已保存的特征仍然可用
+        :param config: load_config()
+        :param model_root: 模型目录，None表示当前启用的模型
+        :return: 16位十六进制字符串，或 config.yaml 中指定的 model_version
+        """
+        if config.get("model_version"):
+            return str(config["model_version"])
+        model_path = os.path.abspath(os.path.join(model_root or FaceRecogni.active_model_root(), config["name"]))
+        keys = ("version", "input_shape", "output_shape", "mean", "std", "metric")
+        content = {key: config.get(key) for key in keys}
+        content["weights"] = FaceRecogni.weights_hash(model_path)
+        content = json.dumps(content, sort_keys=True)
+        return hashlib.sha1(content.encode("utf-8")).hexdigest()[:16]
 
     @timeit(prefix="FaceRecogni Prepare: ")
     def prepare(self):
         # 加载配置
-        config_yaml = os.path.join(BaseConfig.FACE_RECOGNI_MODEL_PATH, "config.yaml")
-        with open(config_yaml, 'r', encoding="utf-8") as stream:
-            config = yaml.safe_load(stream)
+        self.model_root = self.model_root or self.active_model_root()
+        config = self.load_config(self.model_root)
+        self.model_version = self.fingerprint(config, self.model_root)
         # 模型路径
-        self.model_path = os.path.join(BaseConfig.FACE_RECOGNI_MODEL_PATH, config["name"])
+        self.model_path = os.path.join(self.model_root, config["name"])
         self.model_path = os.path.abspath(self.model_path)
         # 输入图片格式
         self.input_shape = config["input_shape"]
@@ -68,50 +165,116 @@ class FaceRecogni:
         # 预处理
         rgb_mean = np.array(config["mean"], dtype=np.float32)
         rgb_std = np.array(config["std"], dtype=np.float32)
-        self.normalize = lambda x: (x / 255.0 - rgb_mean) / rgb_std
+        # (x / 255 - mean) / std 合并为 x * scale + shift
+        self._scale = (1.0 / (255.0 * rgb_std)).astype(np.float32)
+        self._shift = (-rgb_mean / rgb_std).astype(np.float32)
         # 后处理
         self.metric = config["metric"].lower()
         self.threshold = config["threshold"]
 
-        # 加载模型
+        # 模型在首次推理或preload时加载
         self.model_format = config["format"].upper()
-        self.model: Model = load_model(self.model_path)
-        # self.model.summary()
 
         self.config = config
 
+    def load_model(self):
+        """
+        加载模型，由format选择推理后端，可以重复调用
+        :return: 推理后端
+        """
+        if self.model is None:
+            with self._model_lock:
+                if self.model is None:
+                    begin = time.time()
+                    self.model = load_backend(self.model_format, self.model_path)
+                    logger.info(f"FaceRecogni Load Model: time used: {time.time() - begin:3.3f}s")
+        return self.model
+
+    def preload(self):
+        """
+        启动时加载模型并预热，启用推理微批处理
+        """
+        run_inference(self.load_model)
+        self.warm_up(range(1, BaseConfig.INFERENCE_MAX_BATCH + 1))
+        if BaseConfig.INFERENCE_BATCHING and self.batcher is None:
+            self.enable_batching(max_batch=BaseConfig.INFERENCE_MAX_BATCH,
+                                 max_wait_ms=BaseConfig.INFERENCE_MAX_WAIT_MS)
+        self.ready = True
+
     @timeit(prefix="FaceRecogni WarmUp ")
-    def warm_up(self, n: int = 2):
-        # 预热一次
-        inputs = np.random.randint(0, 255, (1, 112, 112, 3))
-        inputs = self.normalize(inputs)
-        for i in range(n):
-            self.model(inputs, training=False)
-
-    def preprocessing(self, faces):
-        """
-        预处理
-        :param faces: RGB人脸图片 np.ndarray/tf.Tensor/List of RGB Image
-        :return: np.ndarray [batch,height,width,channel]
-        """
-        if isinstance(faces, list):
-            faces_list = [resize_image(face, new_shape=self.input_shape, padding=True) for face in faces]
-            faces = np.array(faces_list)
-        elif isinstance(faces, tf.Tensor):
-            faces = faces.numpy()
-        elif not isinstance(faces, np.ndarray):
-            raise TypeError("只接受numpy Array或Tensorflow Tensor")
+    def warm_up(self, batch_sizes=(1,), repeats=2):
+        """
+        按服务时的调用方式(预处理 + serve)预热每个批大小，首次调用的图构建/张量分配不再出现在请求中
+        :param batch_sizes: 需要预热的批大小，微批处理时为 1~INFERENCE_MAX_BATCH
+        :param repeats: 每个批大小首次调用之后再执行的次数
+        :return: {批大小: {first_ms, ms}} 首次及之后的平均耗时
+        """
+        w, h = self.input_shape[:2]
+        rng = np.random.default_rng(0)
+        for batch_size in batch_sizes:
+            faces = self.preprocessing(rng.integers(0, 256, (batch_size, h, w, 3), dtype=np.uint8))
+            times = []
+            for i in range(1 + repeats):
+                begin = time.perf_counter()
+                self.serve(faces)
+                times.append((time.perf_counter() - begin) * 1000)
+            self.warm_up_stats[batch_size] = dict(first_ms=times[0], ms=float(np.mean(times[1 if repeats else 0:])))
+        return self.warm_up_stats
 
-        if len(faces.shape) == 3:
-            np.expand_dims(faces, axis=0)
+    def normalize(self, faces):
+        """
+        原地归一化
+        :param faces: float32 [batch,height,width,channel]
+        :return: faces
+        """
+        faces *= self._scale
+        faces += self._shift
+        return faces
 
-        if len(faces.shape) != 4:
-            raise ValueError("只接受一副或多幅RGB图片")
+    def _acquire_buffer(self, n):
+        """
+        取出容量不小于n的缓冲区，并发请求各自使用不同的缓冲区
+        """
+        with self._buffers_lock:
+            for i, buffer in enumerate(self._buffers):
+                if len(buffer) >= n:
+                    return self._buffers.pop(i)
+        w, h = self.input_shape[:2]
+        capacity = max(n, BaseConfig.INFERENCE_MAX_BATCH)
+        return np.empty((capacity, h, w, 3), dtype=np.float32)
 
-        faces = np.array(faces, dtype=np.float32)
-        faces = self.normalize(faces)
+    def _release_buffer(self, buffer):
+        with self._buffers_lock:
+            self._buffers.append(buffer)
 
-        return faces
+    def preprocessing(self, faces, out=None):
+        """
+        预处理，缩放后的像素直接写入float32缓冲区并原地归一化
+        :param faces: RGB人脸图片 np.ndarray/tf.Tensor/List of RGB Image，uint8
+        :param out: 预分配的缓冲区 [>=batch,height,width,3] float32，None时新建
+        :return: np.ndarray [batch,height,width,channel]，out的前batch个
+        """
+        if hasattr(faces, "numpy"):  # tf.Tensor，不为此导入TensorFlow
+            faces = faces.numpy()
+        if isinstance(faces, np.ndarray):
+            if faces.ndim == 3:
+                faces = faces[np.newaxis]
+            if faces.ndim != 4:
+                raise ValueError("只接受一副或多幅RGB图片")
+        elif not isinstance(faces, list):
+            raise TypeError("只接受numpy Array或Tensorflow Tensor")
+
+        n = len(faces)
+        w, h = self.input_shape[:2]
+        if out is None:
+            out = np.empty((n, h, w, 3), dtype=np.float32)
+        out = out[:n]
+        if isinstance(faces, np.ndarray) and faces.shape[1:] == out.shape[1:]:
+            out[...] = faces  # 尺寸一致时只做一次类型转换
+        else:
+            for face, buffer in zip(faces, out):
+                letterbox_into(face, buffer)
+        return self.normalize(out)
 
     def postprocessing(self, embeddings):
         """
@@ -119,10 +282,8 @@ class FaceRecogni:
         :param norm embeddings:
         :return:
         """
+        embeddings = np.asarray(embeddings, dtype=np.float32)
         embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
-        if isinstance(embeddings, tf.Tensor):
-            embeddings = embeddings.numpy()
-        embeddings = embeddings.astype(np.float32)
         return embeddings
 
     def predict(self, faces):
@@ -130,26 +291,53 @@ class FaceRecogni:
         :param faces: RGB人脸图片 np.ndarray
         :return:  Numpy array of embeddings.
         """
-        faces = self.preprocessing(faces)
-        embs = self.model.predict(faces)
+        buffer = self._acquire_buffer(1 if getattr(faces, "ndim", 4) == 3 else len(faces))
+        try:
+            faces = self.preprocessing(faces, out=buffer)
+            if self.batcher is not None:  # 与并发请求合并为一批计算
+                return self.batcher.submit(faces)
+            return self.serve(faces)
+        finally:
+            self._release_buffer(buffer)
+
+    def forward(self, faces):
+        """
+        一次前向计算
+        :param faces: 预处理后的图片 [batch,height,width,channel]
+        :return: Numpy array of embeddings.
+        """
+        embs = self.load_model()(faces)
         embs = self.postprocessing(embs)
         return embs
 
+    def serve(self, faces):
+        """
+        服务时的前向计算，在推理线程池中执行，微批处理也通过该方法计算
+        """
+        return run_inference(self.forward, faces)
+
+    def enable_batching(self, max_batch=32, max_wait_ms=5.0):
+        """
+        启用推理微批处理，见 app.facelib.batcher
+        热切换时在原生线程中调用，批处理的循环与队列在主线程的hub中创建
+        """
+        from .batcher import InferenceBatcher
+        from .executor import call_in_main_hub
+        if self.batcher is not None:
+            self.batcher.stop()
+        self.batcher = call_in_main_hub(InferenceBatcher, self.serve, max_batch=max_batch, max_wait_ms=max_wait_ms)
+
     def calculate_distance(self, embeddings, metric=None) -> np.ndarray:
         """
-        计算Embeddings两两之间的距离
+        计算Embeddings两两之间的距离，与检索使用相同的距离计算
         :param embeddings
         :param metric:
-        :return: distances
+        :return: distances 上三角，顺序与scipy pdist一致
         """
-        embeddings = np.array(embeddings)
         if metric is None:
             metric = self.metric
 
-        if metric == "l2":
-            metric = "euclidean"
-
-        return pdist(embeddings, metric=metric)
+        return condensed_distance(embeddings, metric=metric)
 
     @staticmethod
     def get_instance():
@@ -159,9 +347,7 @@ class FaceRecogni:
         """
         if FaceRecogni.INSTANCE is None:
             FaceHandler = FaceRecogni()  # 只会创建一次
-            FaceHandler.prepare()  # 加载配置
-            if BaseConfig.USE_FACE_RECOGNI:
-                FaceHandler.warm_up(5)  # 预热
+            FaceHandler.prepare()  # 加载配置，模型在首次推理或preload时加载
             FaceRecogni.INSTANCE = FaceHandler
 
         return FaceRecogni.INSTANCE
@@ -0,0 +1,651 @@
+"""
+gallery.py
+常驻内存的人脸特征库，将所有特征保存为连续的float32矩阵，检索时一次向量化计算距离
+"""
+import os
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from .distance import normalize_metric, pairwise_distance, dot_to_distance, topk_smallest, chunked_topk
+
+logger = logging.getLogger(__name__)
+
+
+class Gallery:
+    INSTANCE = None
+    CHUNK_SIZE = 65536  # 检索时每次计算距离的行数，限制临时内存
+
+    def __init__(self, metric="l2", capacity=1024, dtype="float32", rerank=8, rerank_source=None, model_version=None):
+        """
+        :param metric: 距离度量
+        :param capacity: 初始容量
+        :param dtype: 特征存储格式 "float32"|"float16"|"int8"
+        :param rerank: 压缩存储时，按 k*rerank 个候选进行精确重排
+        :param rerank_source: 压缩存储时提供float32特征的来源，见 app.facelib.quantize
+        :param model_version: 只从数据库加载该模型版本的特征，None表示不区分
+        """
+        self._metric = None
+        self.metric = metric
+        self.dtype = dtype
+        self.rerank = rerank
+        self.rerank_source = rerank_source
+        self.model_version = model_version
+        self.loaded = False
+        self._capacity = capacity
+        self._size = 0
+        self.version = 0  # 每次增删自增，供外部判断特征库是否变化
+        self._embeddings = None  # [capacity, dim] 按dtype存储
+        self._scales = None  # [capacity] int8的逐向量缩放系数
+        self._sq_norms = None  # [capacity] 原始特征的模长平方
+        self._user_ids = None  # [capacity] 用户编号
+        self._uuids = None  # [capacity] 特征编号
+        self._lock = threading.Lock()
+        self._user_index = None  # 用户编号 -> 特征编号，按需构建
+        self.index = None
+        self.observers = []  # 同步增删的附加结构，需实现 add/remove/reset，在持有锁时调用，不能回调Gallery
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def dim(self):
+        return None if self._embeddings is None else self._embeddings.shape[1]
+
+    @property
+    def quantized(self):
+        return self.dtype != "float32"
+
+    @property
+    def embeddings(self) -> np.ndarray:
+        """
+        float32特征，压缩存储时返回反量化后的近似值
+        """
+        state = self._snapshot()
+        if not self.quantized:
+            return state["embeddings"]
+        from .quantize import dequantize
+        return dequantize(state["embeddings"], state["scales"])
+
+    @property
+    def user_ids(self) -> np.ndarray:
+        return self._snapshot()["user_ids"]
+
+    @property
+    def uuids(self) -> np.ndarray:
+        return self._snapshot()["uuids"]
+
+    def _columns(self):
+        columns = ["_embeddings", "_sq_norms", "_user_ids", "_uuids"]
+        if self.dtype == "int8":
+            columns.append("_scales")
+        return columns
+
+    def _snapshot(self):
+        """
+        获取当前特征库的只读视图，写入时数组可能被替换，读取方只持有快照
+        :return: dict embeddings, scales, sq_norms, user_ids, uuids
+        """
+        with self._lock:
+            return self._view()
+
+    def _view(self):
+        """
+        同 _snapshot，调用方已持有锁
+        """
+        size = self._size
+        if self._embeddings is None:
+            return dict(embeddings=np.empty((0, 0), dtype=self.dtype),
+                        scales=None,
+                        sq_norms=np.empty(0, dtype=np.float32),
+                        user_ids=np.empty(0, dtype=np.int64),
+                        uuids=np.empty(0, dtype=np.int64))
+        return dict(embeddings=self._embeddings[:size],
+                    scales=None if self._scales is None else self._scales[:size],
+                    sq_norms=self._sq_norms[:size],
+                    user_ids=self._user_ids[:size],
+                    uuids=self._uuids[:size])
+
+    def _reserve(self, size, dim):
+        """
+        扩容，按两倍增长保证追加为均摊O(1)
+        """
+        if self._embeddings is None:
+            capacity = max(self._capacity, size)
+            self._embeddings = np.empty((capacity, dim), dtype=self.dtype)
+            self._sq_norms = np.empty(capacity, dtype=np.float32)
+            self._user_ids = np.empty(capacity, dtype=np.int64)
+            self._uuids = np.empty(capacity, dtype=np.int64)
+            if self.dtype == "int8":
+                self._scales = np.empty(capacity, dtype=np.float32)
+            return
+        if self._embeddings.shape[1] != dim:
+            raise ValueError(f"特征维度不一致: {self._embeddings.shape[1]} != {dim}")
+        capacity = self._embeddings.shape[0]
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        for name in self._columns():
+            old = getattr(self, name)
+            new = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self._size] = old[:self._size]
+            setattr(self, name, new)
+
+    def add(self, uuids, user_ids, embeddings):
+        """
+        追加特征
+        :param uuids: 特征编号
+        :param user_ids: 用户编号
+        :param embeddings: [n, dim] float32
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if embeddings.ndim == 1:
+            embeddings = np.expand_dims(embeddings, axis=0)
+        uuids = np.asarray(uuids, dtype=np.int64).reshape(-1)
+        user_ids = np.asarray(user_ids, dtype=np.int64).reshape(-1)
+        n = embeddings.shape[0]
+        if len(uuids) != n or len(user_ids) != n:
+            raise ValueError("特征编号、用户编号与特征数量不一致")
+        if n == 0:
+            return
+        codes, scales = embeddings, None
+        if self.quantized:
+            from .quantize import quantize
+            codes, scales = quantize(embeddings, self.dtype)
+        with self._lock:
+            begin = self._size
+            self._reserve(begin + n, embeddings.shape[1])
+            self._embeddings[begin:begin + n] = codes
+            self._sq_norms[begin:begin + n] = np.sum(np.square(embeddings), axis=1)
+            self._user_ids[begin:begin + n] = user_ids
+            self._uuids[begin:begin + n] = uuids
+            if scales is not None:
+                self._scales[begin:begin + n] = scales
+            self._size = begin + n
+            self.version += 1
+            if self._user_index is not None:
+                for uuid, user_id in zip(uuids.tolist(), user_ids.tolist()):
+                    self._user_index.setdefault(user_id, []).append(uuid)
+            if self.index is not None:
+                self.index.add(np.arange(begin, begin + n), embeddings)
+            for observer in self.observers:
+                observer.add(uuids, user_ids, embeddings)
+
+    def remove(self, uuids) -> int:
+        """
+        删除特征
+        :param uuids: 特征编号
+        :return: 删除的数量
+        """
+        uuids = np.asarray(uuids, dtype=np.int64).reshape(-1)
+        with self._lock:
+            if self._embeddings is None or len(uuids) == 0:
+                return 0
+            size = self._size
+            keep = ~np.isin(self._uuids[:size], uuids)
+            remain = int(np.count_nonzero(keep))
+            if remain == size:
+                return 0
+            # 拷贝到新数组，不影响读取方已持有的快照
+            for name in self._columns():
+                old = getattr(self, name)
+                new = np.empty_like(old)
+                new[:remain] = old[:size][keep]
+                setattr(self, name, new)
+            self._size = remain
+            self.version += 1
+            self._user_index = None
+            if self.index is not None:
+                self.index.remove(keep)
+            for observer in self.observers:
+                observer.remove(uuids)
+            return size - remain
+
+    def replace(self, uuids, user_ids, embeddings, sq_norms=None):
+        """
+        替换全部特征，新数组(量化、模长、索引的桶分配)在锁外构建，持有锁时只交换引用，
+        并发检索看到的始终是完整的旧特征库或新特征库
+        :param uuids: 特征编号
+        :param user_ids: 用户编号
+        :param embeddings: [n, dim] float32
+        :param sq_norms: [n] 已计算的模长平方(快照)，None时重新计算
+        """
+        uuids = np.asarray(uuids, dtype=np.int64).reshape(-1)
+        user_ids = np.asarray(user_ids, dtype=np.int64).reshape(-1)
+        n = len(uuids)
+        if n == 0:
+            return self.clear()
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(n, -1)
+        if len(user_ids) != n:
+            raise ValueError("特征编号、用户编号与特征数量不一致")
+        if sq_norms is None:
+            sq_norms = np.sum(np.square(embeddings), axis=1)
+        columns = dict(_embeddings=embeddings, _sq_norms=sq_norms, _user_ids=user_ids, _uuids=uuids)
+        if self.quantized:
+            from .quantize import quantize
+            columns["_embeddings"], scales = quantize(embeddings, self.dtype)
+            if self.dtype == "int8":
+                columns["_scales"] = scales
+        index = self.index
+        assign = None if index is None else index.assign(embeddings)
+        with self._lock:
+            for name, column in columns.items():
+                setattr(self, name, column)
+            self._size = n
+            self.version += 1
+            self._user_index = None
+            if self.index is not None:
+                self.index.reset()
+                self.index.add(np.arange(n), embeddings, assign=assign if self.index is index else None)
+            for observer in self.observers:
+                observer.reset()
+                observer.add(uuids, user_ids, embeddings)
+
+    def clear(self):
+        with self._lock:
+            self._size = 0
+            self.version += 1
+            for name in self._columns():
+                setattr(self, name, None)
+            self._user_index = None
+            if self.index is not None:
+                self.index.reset()
+            for observer in self.observers:
+                observer.reset()
+
+    def get_embeddings(self, uuids) -> np.ndarray:
+        """
+        按特征编号读取float32特征
+        :param uuids: 特征编号
+        :return: [n, dim]，不存在的特征为nan
+        """
+        uuids = np.asarray(uuids, dtype=np.int64).reshape(-1)
+        state = self._snapshot()
+        stored = state["uuids"]
+        if len(stored) == 0:
+            return np.empty((len(uuids), 0), dtype=np.float32)
+        # 特征编号通常为升序，先二分查找，未命中的再线性查找
+        rows = np.minimum(np.searchsorted(stored, uuids), len(stored) - 1)
+        for i in np.flatnonzero(stored[rows] != uuids):
+            found = np.flatnonzero(stored == uuids[i])
+            rows[i] = found[0] if len(found) else -1
+        codes = state["embeddings"][rows]
+        if self.quantized:
+            from .quantize import dequantize
+            codes = dequantize(codes, None if state["scales"] is None else state["scales"][rows])
+        vectors = np.array(codes, dtype=np.float32)
+        vectors[rows < 0] = np.nan
+        return vectors
+
+    def user_embeddings(self, user_id):
+        """
+        读取用户的全部特征
+        :param user_id: 用户编号
+        :return: uuids, embeddings [n, dim] float32
+        """
+        with self._lock:
+            if self._user_index is None:
+                size = self._size
+                user_ids = np.empty(0, dtype=np.int64) if self._user_ids is None else self._user_ids[:size]
+                order = np.argsort(user_ids, kind="stable")
+                users, begins = np.unique(user_ids[order], return_index=True)
+                groups = np.split(self._uuids[:size][order], begins[1:]) if size else []
+                self._user_index = {user: group.tolist() for user, group in zip(users.tolist(), groups)}
+            uuids = np.array(self._user_index.get(int(user_id), []), dtype=np.int64)
+        return uuids, self.get_embeddings(uuids)
+
+    @property
+    def metric(self):
+        return self._metric
+
+    @metric.setter
+    def metric(self, metric):
+        self._metric = normalize_metric(metric)
+
+    def distance(self, queries, gallery) -> np.ndarray:
+        """
+        计算queries与gallery两两之间的距离
+        :param queries: [m, dim]
+        :param gallery: [n, dim]
+        :return: [m, n]
+        """
+        return pairwise_distance(queries, gallery, self.metric)
+
+    def _rerank(self, queries, uuids, user_ids, k):
+        """
+        使用float32特征对候选精确重排
+        :param queries: [m, dim]
+        :param uuids: [m, n] 候选特征编号
+        :param user_ids: [m, n]
+        :param k:
+        :return: uuids, user_ids, distances [m, k]
+        """
+        from .quantize import fetch_from_db
+        fetch = self.rerank_source or fetch_from_db
+        unique, inverse = np.unique(uuids, return_inverse=True)
+        valid = unique >= 0  # 索引的候选不足时以-1补齐
+        vectors = fetch(unique[valid])
+        if not np.all(valid):
+            padded = np.full((len(unique), vectors.shape[1]), np.nan, dtype=np.float32)
+            padded[valid] = vectors
+            vectors = padded
+        inverse = inverse.reshape(uuids.shape)
+        dist = np.einsum("md,mnd->mn", queries, vectors[inverse])
+        q_sq = np.sum(np.square(queries), axis=1, keepdims=True)
+        dist = dot_to_distance(dist, q_sq, np.sum(np.square(vectors), axis=1)[inverse], self.metric)
+        dist[np.isnan(dist)] = np.inf  # 已删除的特征
+        top = topk_smallest(dist, min(k, dist.shape[1]))
+        return (np.take_along_axis(uuids, top, axis=1), np.take_along_axis(user_ids, top, axis=1),
+                np.take_along_axis(dist, top, axis=1).astype(np.float32))
+
+    def set_index(self, index):
+        """
+        挂载近似检索索引，之后的检索只计算索引给出的候选行，增删同步到索引
+        :param index: app.facelib.ann 中的索引，已按当前特征库的行写入，None表示精确检索
+        """
+        with self._lock:
+            if index is not None and len(index) != self._size:
+                raise ValueError(f"索引与特征库不一致: {len(index)} != {self._size}")
+            self.index = index
+
+    def search_batch(self, queries, k=1):
+        """
+        批量检索，每个query返回最相近的k个特征
+        :param queries: [m, dim]
+        :param k:
+        :return: uuids, user_ids, distances 均为[m, k]，每行按距离升序；候选不足k个时编号为-1，距离为inf
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = np.expand_dims(queries, axis=0)
+        with self._lock:
+            state = self._view()
+            index = self.index
+            lists = None if index is None else index.lists()
+        uuids, user_ids = state["uuids"], state["user_ids"]
+        m = queries.shape[0]
+        if len(uuids) <= 0:
+            empty = np.empty((m, 0), dtype=np.int64)
+            return empty, empty, np.empty((m, 0), dtype=np.float32)
+        # 压缩存储时在压缩空间中取 k*rerank 个候选，再用float32精确重排
+        candidates = k * self.rerank if self.quantized else k
+        if index is not None:
+            top, dist = index.search_batch(queries, state, lists, candidates)
+            padded = top < 0
+            top_uuids, top_user_ids = np.where(padded, -1, uuids[top]), np.where(padded, -1, user_ids[top])
+        else:
+            top, dist = chunked_topk(queries, state["embeddings"], state["sq_norms"], candidates, self.metric,
+                                     scales=state["scales"], chunk_size=self.CHUNK_SIZE)
+            top_uuids, top_user_ids = uuids[top], user_ids[top]
+        if not self.quantized:
+            return top_uuids, top_user_ids, dist
+        return self._rerank(queries, top_uuids, top_user_ids, k)
+
+    def search(self, query, k=1):
+        """
+        检索与query最相近的k个特征
+        :param query: [dim] 或 [1, dim]
+        :param k:
+        :return: uuids, user_ids, distances 按距离升序
+        """
+        query = np.asarray(query, dtype=np.float32).reshape(1, -1)
+        uuids, user_ids, dists = self.search_batch(query, k)
+        return uuids[0], user_ids[0], dists[0]
+
+    @staticmethod
+    def read_db(chunk_size=2000, exam_id=None, after_uuid=None, model_version=None):
+        """
+        从数据库读取特征，需要在app_context中调用
+        :param chunk_size: 每次从游标读取的行数
+        :param exam_id: 只读取该考试名单中考生的特征，None表示全部
+        :param after_uuid: 只读取编号大于after_uuid的特征
+        :param model_version: 只读取该模型版本的特征，None表示全部
+        :return: uuids, user_ids, embeddings 按uuids升序
+        """
+        from app.extensions import db
+        from app.models.models import Embedding, ExamList
+
+        query = db.session.query(Embedding.uuid, Embedding.userId, Embedding.embdBlob)
+        if exam_id is not None:
+            query = query.join(ExamList, ExamList.userId == Embedding.userId).filter(ExamList.examId == exam_id)
+        if after_uuid is not None:
+            query = query.filter(Embedding.uuid > after_uuid)
+        if model_version is not None:
+            query = query.filter(Embedding.modelVersion == model_version)
+        query = query.order_by(Embedding.uuid).yield_per(chunk_size)
+        uuids, user_ids, blobs = [], [], []
+        skipped = 0
+        for uuid, user_id, blob in query:
+            if blob is None:  # 未迁移的旧数据
+                skipped += 1
+                continue
+            uuids.append(uuid)
+            user_ids.append(user_id)
+            blobs.append(blob)
+        db.session.remove()
+        if skipped:
+            logger.warning(f"Gallery: {skipped} embeddings without embdBlob, run python -m app.models.migrate")
+
+        uuids = np.array(uuids, dtype=np.int64)
+        user_ids = np.array(user_ids, dtype=np.int64)
+        if not blobs:
+            return uuids, user_ids, np.empty((0, 0), dtype=np.float32)
+        # 拼接后一次解析为矩阵
+        embeddings = np.frombuffer(b"".join(blobs), dtype=np.float32).reshape(len(blobs), -1)
+        return uuids, user_ids, embeddings
+
+    @staticmethod
+    def db_stats(model_version=None):
+        """
+        数据库中可加载的特征数量及最大编号，用于校验快照
+        :param model_version: 只统计该模型版本的特征，None表示全部
+        :return: count, max_uuid
+        """
+        from sqlalchemy import func
+        from app.extensions import db
+        from app.models.models import Embedding
+
+        query = db.session.query(func.count(Embedding.uuid), func.max(Embedding.uuid)) \
+            .filter(Embedding.embdBlob.isnot(None))
+        if model_version is not None:
+            query = query.filter(Embedding.modelVersion == model_version)
+        count, max_uuid = query.one()
+        return count, max_uuid or 0
+
+    def load_from_db(self, chunk_size=2000, exam_id=None):
+        """
+        从数据库加载特征，已加载时整体替换，重新加载期间检索不会看到空的特征库，需要在app_context中调用
+        :param chunk_size: 每次从游标读取的行数
+        :param exam_id: 只加载该考试名单中考生的特征，None表示全部
+        :return: self
+        """
+        uuids, user_ids, embeddings = self.read_db(chunk_size=chunk_size, exam_id=exam_id,
+                                                   model_version=self.model_version)
+        self.replace(uuids, user_ids, embeddings)
+        self.loaded = True
+        if exam_id is None:
+            logger.info(f"Gallery Loaded: {len(self)} embeddings")
+        return self
+
+    def load_snapshot(self, snapshot):
+        """
+        从快照加载特征，快照与数据库不一致时增量更新或重建快照，需要在app_context中调用
+        float32存储时直接使用只读映射，首次写入时才拷贝到进程内存
+        :param snapshot: app.facelib.snapshot.GallerySnapshot
+        :return: self
+        """
+        count, max_uuid = self.db_stats(self.model_version)
+        if not snapshot.validate(count, max_uuid):
+            header = snapshot.read_header()
+            uuids, user_ids, embeddings = None, None, None
+            if header is not None and header["max_uuid"] <= max_uuid:
+                # 只读取快照之后新增的特征
+                _, arrays = snapshot.open()
+                delta = self.read_db(after_uuid=header["max_uuid"], model_version=self.model_version)
+                if header["n"] + len(delta[0]) == count:
+                    uuids = np.concatenate([arrays["uuids"], delta[0]])
+                    user_ids = np.concatenate([arrays["user_ids"], delta[1]])
+                    embeddings = np.vstack([arrays["embeddings"], delta[2]]) if len(delta[0]) else arrays["embeddings"]
+                del arrays
+            if uuids is None:  # 存在删除，全量重建
+                uuids, user_ids, embeddings = self.read_db(model_version=self.model_version)
+            snapshot.write(uuids, user_ids, embeddings)
+            del uuids, user_ids, embeddings
+
+        # 完整构建后替换，加载期间的检索仍使用旧特征库
+        header, arrays = snapshot.open()
+        if not self.quantized:
+            self.replace(arrays["uuids"], arrays["user_ids"], arrays["embeddings"], sq_norms=arrays["sq_norms"])
+        else:
+            from .quantize import ArrayVectors
+            self.replace(arrays["uuids"], arrays["user_ids"], arrays["embeddings"])
+            self.rerank_source = ArrayVectors(arrays["uuids"], arrays["embeddings"])
+        self.loaded = True
+        logger.info(f"Gallery Loaded From Snapshot: {len(self)} embeddings, seq {header['seq']}")
+        return self
+
+    def save_snapshot(self, snapshot):
+        """
+        将当前特征库写入快照，压缩存储时float32特征从数据库读取
+        """
+        if self.quantized:
+            return snapshot.write(*self.read_db(model_version=self.model_version))
+        state = self._snapshot()
+        return snapshot.write(state["uuids"], state["user_ids"], state["embeddings"])
+
+    @staticmethod
+    def snapshot_path(path, model_version=None):
+        """
+        每个模型版本使用单独的快照及索引文件
+        """
+        if model_version is None:
+            return path
+        root, ext = os.path.splitext(path)
+        return f"{root}.{model_version}{ext}"
+
+    @staticmethod
+    def create(metric="l2", model_version=None):
+        """
+        按配置创建并加载特征库(快照、索引)，需要在app_context中调用
+        :param metric: 距离度量
+        :param model_version: 只加载该模型版本的特征
+        :return: Gallery
+        """
+        from app.config import BaseConfig
+        gallery = Gallery(metric=metric, dtype=BaseConfig.GALLERY_DTYPE, rerank=BaseConfig.GALLERY_RERANK,
+                          model_version=model_version)
+        if BaseConfig.GALLERY_SNAPSHOT:
+            from .snapshot import GallerySnapshot
+            path = Gallery.snapshot_path(BaseConfig.GALLERY_SNAPSHOT_PATH, model_version)
+            gallery.load_snapshot(GallerySnapshot(path))
+        else:
+            gallery.load_from_db()
+        if BaseConfig.GALLERY_INDEX == "ivf":
+            from .ann import IVFIndex
+            index = IVFIndex.from_gallery(gallery,
+                                          path=Gallery.snapshot_path(BaseConfig.GALLERY_INDEX_PATH, model_version),
+                                          nlist=BaseConfig.IVF_NLIST, nprobe=BaseConfig.IVF_NPROBE)
+            gallery.set_index(index)
+        return gallery
+
+    @staticmethod
+    def get_instance(metric="l2", model_version=None):
+        """
+        进程内共享的特征库，首次调用时加载，需要在app_context中调用
+        :param metric: 首次创建时使用的距离度量
+        :param model_version: 首次创建时只加载该模型版本的特征
+        :return:
+        """
+        if Gallery.INSTANCE is None:
+            Gallery.INSTANCE = Gallery.create(metric=metric, model_version=model_version)
+
+        return Gallery.INSTANCE
+
+
+class ExamGalleryCache:
+    """
+    按考试缓存考生特征子库，检索范围只包含考试名单中的考生
+    """
+    INSTANCE = None
+
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self._cache = OrderedDict()  # examId -> (Gallery, 名单中的用户编号)
+        self._generation = 0  # 每次失效自增，避免构建期间的失效被覆盖
+        self._lock = threading.Lock()
+
+    def get(self, exam_id) -> Gallery:
+        """
+        获取考试对应的特征子库，未命中时从数据库构建，需要在app_context中调用
+        :param exam_id: 考试编号
+        :return: Gallery
+        """
+        exam_id = int(exam_id)
+        with self._lock:
+            entry = self._cache.get(exam_id, None)
+            if entry is not None:
+                self._cache.move_to_end(exam_id)
+                return entry[0]
+            generation = self._generation
+
+        from app.extensions import db
+        from app.models.models import ExamList
+
+        roster = db.session.query(ExamList.userId).filter(ExamList.examId == exam_id).all()
+        roster = {user_id for user_id, in roster}
+        source = Gallery.INSTANCE
+        gallery = Gallery(metric=source.metric if source else "l2",
+                          model_version=source.model_version if source else None)
+        gallery.load_from_db(exam_id=exam_id)
+        with self._lock:
+            if generation != self._generation:  # 构建期间名单已变更，本次结果不缓存
+                return gallery
+            self._cache[exam_id] = (gallery, roster)
+            self._cache.move_to_end(exam_id)
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return gallery
+
+    def invalidate(self, exam_id=None):
+        """
+        名单变更时清除缓存
+        :param exam_id: 考试编号，None表示全部
+        """
+        with self._lock:
+            self._generation += 1
+            if exam_id is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(int(exam_id), None)
+
+    def invalidate_user(self, user_id):
+        """
+        考生重新录入特征时，清除包含该考生的考试
+        :param user_id: 用户编号
+        """
+        user_id = int(user_id)
+        with self._lock:
+            self._generation += 1
+            stale = [exam_id for exam_id, (_, roster) in self._cache.items() if user_id in roster]
+            for exam_id in stale:
+                self._cache.pop(exam_id, None)
+
+    def on_gallery_change(self, op, uuid, user_id):
+        """
+        其它进程变更特征库时的回调，见 app.facelib.sync
+        """
+        if op == "reload":
+            self.invalidate()
+        else:
+            self.invalidate_user(user_id)
+
+    @staticmethod
+    def get_instance():
+        if ExamGalleryCache.INSTANCE is None:
+            from app.config import BaseConfig
+            ExamGalleryCache.INSTANCE = ExamGalleryCache(maxsize=BaseConfig.EXAM_GALLERY_CACHE_SIZE)
+
+        return ExamGalleryCache.INSTANCE
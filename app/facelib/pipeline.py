@@ -0,0 +1,217 @@
+"""
+pipeline.py
+服务端人脸编码流水线：检测(LandmarkDetector) -> 对齐(由眼/鼻/嘴角关键点做相似变换到模型的112x112模板) -> 批量编码(FaceRecogni)
+客户端上传整幅图片时，对齐后的人脸与训练数据分布一致，编码精度不再受背景与人脸位置影响
+每个阶段分别计时，/debug/pipeline 查看累计耗时
+"""
+import time
+import base64
+import logging
+import threading
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+from .executor import run_inference
+
+logger = logging.getLogger(__name__)
+
+# ArcFace 112x112 对齐模板：左眼、右眼、鼻尖、左嘴角、右嘴角(图片坐标，左右指图片的左右)
+ALIGN_TEMPLATE = np.array([
+    [38.2946, 51.6963],
+    [73.5318, 51.5014],
+    [56.0252, 71.7366],
+    [41.5493, 92.3655],
+    [70.7299, 92.2041],
+], dtype=np.float32)
+TEMPLATE_SIZE = 112
+
+# FaceMesh关键点编号：两个虹膜中心、鼻尖、两个嘴角
+EYES = [468, 473]
+NOSE = 1
+MOUTH = [61, 291]
+
+PipelineResult = namedtuple("PipelineResult", ["embeddings", "index", "faces", "timings"])
+
+
+def key_points(landmarks):
+    """
+    :param landmarks: [n_faces,478,3]
+    :return: [n_faces,5,2] 顺序与ALIGN_TEMPLATE一致
+    """
+    xy = landmarks[..., :2]
+    eyes, mouth = xy[:, EYES], xy[:, MOUTH]
+    # 按图片中的左右排序，与人脸朝向(是否镜像)无关
+    eyes = np.take_along_axis(eyes, np.argsort(eyes[..., :1], axis=1), axis=1)
+    mouth = np.take_along_axis(mouth, np.argsort(mouth[..., :1], axis=1), axis=1)
+    return np.concatenate([eyes, xy[:, NOSE:NOSE + 1], mouth], axis=1)
+
+
+def similarity_transform(src, dst):
+    """
+    最小二乘相似变换(旋转+等比缩放+平移)，Umeyama方法，一次求解一批人脸
+    :param src: [n,k,2] 关键点
+    :param dst: [k,2] 模板
+    :return: [n,2,3] 仿射矩阵，用于cv2.warpAffine
+    """
+    src = np.asarray(src, dtype=np.float64)
+    dst = np.asarray(dst, dtype=np.float64)
+    k = dst.shape[0]
+    src_mean = src.mean(axis=1, keepdims=True)
+    dst_mean = dst.mean(axis=0)
+    src_c = src - src_mean
+    dst_c = dst - dst_mean
+    cov = np.einsum("ki,nkj->nij", dst_c, src_c) / k
+    u, s, vt = np.linalg.svd(cov)
+    d = np.sign(np.linalg.det(u) * np.linalg.det(vt))  # 避免反射
+    diag = np.stack([np.ones_like(d), d], axis=1)
+    rotation = np.einsum("nij,nj,njk->nik", u, diag, vt)
+    scale = np.sum(s * diag, axis=1) / (np.sum(src_c ** 2, axis=(1, 2)) / k)
+    rotation *= scale[:, None, None]
+    translation = dst_mean - np.einsum("nij,nj->ni", rotation, src_mean[:, 0])
+    return np.concatenate([rotation, translation[..., None]], axis=2)
+
+
+def encode_face(face, ext=".jpg"):
+    """
+    将对齐后的RGB人脸编码为 data URL，保存到 Embedding.base64Img
+    """
+    ok, buffer = cv2.imencode(ext, cv2.cvtColor(face, cv2.COLOR_RGB2BGR))
+    if not ok:
+        raise ValueError("人脸图片编码失败")
+    mime = "jpeg" if ext in (".jpg", ".jpeg") else ext.lstrip(".")
+    return f"data:image/{mime};base64,{base64.b64encode(buffer.tobytes()).decode()}"
+
+
+def decode_face(b64_str):
+    """
+    解码 Embedding.base64Img，data URL 或 base64 编码的图片文件
+    :return: RGB np.ndarray，解码失败时为None
+    """
+    if not b64_str:
+        return None
+    if b64_str.startswith("data:"):
+        b64_str = b64_str.partition(",")[2]
+    try:
+        raw = base64.b64decode(b64_str)
+    except ValueError:
+        return None
+    image = cv2.imdecode(np.frombuffer(raw, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        return None
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+class FacePipeline:
+    INSTANCE = None
+
+    def __init__(self, recogni, detector, batch_size=32):
+        """
+        :param recogni: FaceRecogni
+        :param detector: LandmarkDetector
+        :param batch_size: 每次编码的最大人脸数
+        """
+        self.recogni = recogni
+        self.detector = detector
+        self.batch_size = batch_size
+        w, h = recogni.input_shape[:2]
+        self.output_size = (w, h)
+        # 模型输入不是112x112时按比例缩放模板
+        self.template = ALIGN_TEMPLATE * np.array([w / TEMPLATE_SIZE, h / TEMPLATE_SIZE], dtype=np.float32)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.images = 0
+        self.faces = 0
+        self.total_ms = dict(detect=0.0, align=0.0, embed=0.0)
+
+    def detect(self, images):
+        """
+        :param images: RGB图片列表
+        :return: [Detection] 与images一一对应
+        """
+        return self.detector.detect(images, rgb=True)
+
+    def align(self, images, detections):
+        """
+        每张图片取面积最大的人脸，对齐到模型输入尺寸
+        :return: faces [n,height,width,3] uint8, index [n] 人脸所在图片的下标
+        """
+        index, points = [], []
+        for i, detection in enumerate(detections):
+            if not len(detection.boxes):
+                continue
+            boxes = detection.boxes
+            largest = np.argmax((boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]))
+            index.append(i)
+            points.append(detection.landmarks[largest])
+        w, h = self.output_size
+        faces = np.empty((len(index), h, w, 3), dtype=np.uint8)
+        if index:
+            matrices = similarity_transform(key_points(np.stack(points)), self.template)
+            for face, i, matrix in zip(faces, index, matrices):
+                cv2.warpAffine(images[i], matrix, (w, h), dst=face, borderValue=0)
+        return faces, np.array(index, dtype=np.int64)
+
+    def embed(self, faces):
+        """
+        分批编码，每批与并发请求一起进入推理微批处理
+        :return: [n,dim]
+        """
+        if not len(faces):
+            return np.zeros((0, self.recogni.output_shape[-1]), dtype=np.float32)
+        return np.vstack([self.recogni.predict(faces[begin:begin + self.batch_size])
+                          for begin in range(0, len(faces), self.batch_size)])
+
+    def _detect_align(self, images):
+        begin = time.perf_counter()
+        detections = self.detect(images)
+        detected = time.perf_counter()
+        faces, index = self.align(images, detections)
+        return faces, index, (detected - begin) * 1000, (time.perf_counter() - detected) * 1000
+
+    def run(self, images):
+        """
+        :param images: RGB图片列表 [h,w,3] uint8，尺寸可以不同
+        :return: PipelineResult
+            embeddings [n,dim] 检测到人脸的图片的特征
+            index [n] 对应的图片下标，未检测到人脸的图片不在其中
+            faces [n,height,width,3] 对齐后的RGB人脸
+            timings {detect, align, embed} 毫秒
+        """
+        images = [np.ascontiguousarray(image) for image in images]  # RGBA去掉alpha后的视图不连续
+        # 检测与对齐在推理线程中执行，编码由FaceRecogni自行调度
+        faces, index, detect_ms, align_ms = run_inference(self._detect_align, images)
+        begin = time.perf_counter()
+        embeddings = self.embed(faces)
+        embed_ms = (time.perf_counter() - begin) * 1000
+        timings = dict(detect=detect_ms, align=align_ms, embed=embed_ms)
+        with self._lock:
+            self.calls += 1
+            self.images += len(images)
+            self.faces += len(faces)
+            for stage, ms in timings.items():
+                self.total_ms[stage] += ms
+        logger.debug(f"FacePipeline: {len(images)} images, {len(faces)} faces, {timings}")
+        return PipelineResult(embeddings, index, faces, timings)
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                calls=self.calls,
+                images=self.images,
+                faces=self.faces,
+                total_ms=dict(self.total_ms),
+                ms_per_image={stage: ms / self.images if self.images else 0.0 for stage, ms in self.total_ms.items()},
+            )
+
+    @staticmethod
+    def get_instance():
+        if FacePipeline.INSTANCE is None:
+            from app.config import BaseConfig
+            from .face_recogni import FaceRecogni
+            from .face_landmark import LandmarkDetector
+            FacePipeline.INSTANCE = FacePipeline(FaceRecogni.get_instance(), LandmarkDetector.get_instance(),
+                                                 batch_size=BaseConfig.INFERENCE_MAX_BATCH)
+
+        return FacePipeline.INSTANCE
@@ -0,0 +1,190 @@
+"""
+quantize.py
+特征压缩存储：float16 或 逐向量缩放的int8，压缩空间中检索候选，再使用float32特征精确重排
+FaceRecogni.postprocessing 输出的特征已L2正则化，各分量在[-1, 1]内，量化误差有界
+python -m app.facelib.quantize 在已有数据上统计相对精确检索的召回损失
+"""
+import os
+import sys
+
+project_path = os.path.join(os.path.dirname(__file__), os.path.pardir, os.path.pardir)
+sys.path.append(project_path)
+
+import time
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def quantize(embeddings, dtype):
+    """
+    :param embeddings: [n, dim] float32
+    :param dtype: "float16"|"int8"
+    :return: codes [n, dim], scales [n] (仅int8，否则为None)
+    """
+    if dtype == "float16":
+        return embeddings.astype(np.float16), None
+    if dtype == "int8":
+        scales = np.max(np.abs(embeddings), axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.rint(embeddings / scales[:, None]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+    raise ValueError(f"不支持的量化格式: {dtype}")
+
+
+def dequantize(codes, scales=None) -> np.ndarray:
+    """
+    :param codes: [n, dim]
+    :param scales: [n] 或 None
+    :return: [n, dim] float32
+    """
+    embeddings = codes.astype(np.float32)
+    if scales is not None:
+        embeddings *= scales[:, None]
+    return embeddings
+
+
+def fetch_from_db(uuids) -> np.ndarray:
+    """
+    从数据库读取float32特征，需要在app_context中调用
+    :param uuids: 特征编号
+    :return: [n, dim] 与uuids顺序一致，不存在的特征为nan
+    """
+    from app.extensions import db
+    from app.models.models import Embedding
+
+    uuids = np.asarray(uuids, dtype=np.int64)
+    rows = db.session.query(Embedding.uuid, Embedding.embdBlob) \
+        .filter(Embedding.uuid.in_(uuids.tolist())).all()
+    found = {uuid: np.frombuffer(blob, dtype=np.float32) for uuid, blob in rows if blob is not None}
+    if not found:
+        raise KeyError("找不到候选特征")
+    dim = len(next(iter(found.values())))
+    vectors = np.full((len(uuids), dim), np.nan, dtype=np.float32)
+    for i, uuid in enumerate(uuids.tolist()):
+        if uuid in found:
+            vectors[i] = found[uuid]
+    return vectors
+
+
+class ArrayVectors:
+    """
+    按特征编号读取float32特征，uuids需升序
+    """
+
+    def __init__(self, uuids, vectors):
+        """
+        :param uuids: 特征编号 升序
+        :param vectors: [n, dim] float32，可以是快照的只读映射
+        """
+        self._uuids = uuids
+        self._vectors = vectors
+
+    def __call__(self, uuids) -> np.ndarray:
+        uuids = np.asarray(uuids, dtype=np.int64)
+        if len(self._uuids) == 0:
+            return fetch_from_db(uuids)
+        pos = np.minimum(np.searchsorted(self._uuids, uuids), len(self._uuids) - 1)
+        hit = self._uuids[pos] == uuids
+        if np.all(hit):
+            return np.asarray(self._vectors[pos])
+        # 加载之后新增的特征不在数组中
+        vectors = np.empty((len(uuids), self._vectors.shape[1]), dtype=np.float32)
+        vectors[hit] = self._vectors[pos[hit]]
+        vectors[~hit] = fetch_from_db(uuids[~hit])
+        return vectors
+
+
+def recall_report(uuids, user_ids, embeddings, metric="l2", dtypes=("float16", "int8"),
+                  k=1, rerank=8, n_queries=1000, threshold=None, seed=0):
+    """
+    以库中特征作为查询(排除自身)，统计压缩检索相对float32精确检索的召回
+    :param uuids: 特征编号 升序
+    :param user_ids: 用户编号
+    :param embeddings: [n, dim] float32
+    :param metric:
+    :param dtypes: 参与对比的压缩格式
+    :param k: recall@k
+    :param rerank: 重排候选倍数
+    :param n_queries: 查询数量
+    :param threshold: 模型阈值，统计识别结果(是否匹配及匹配用户)的一致率
+    :param seed:
+    :return: dict
+    """
+    from .gallery import Gallery
+
+    uuids = np.asarray(uuids, dtype=np.int64)
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    picked = rng.choice(len(uuids), size=min(n_queries, len(uuids)), replace=False)
+    queries = embeddings[picked]
+    source = ArrayVectors(uuids, embeddings)
+
+    def run(gallery):
+        begin = time.perf_counter()
+        found_uuids, found_users, dists = gallery.search_batch(queries, k + 1)
+        elapsed = time.perf_counter() - begin
+        # 去掉查询自身
+        not_self = found_uuids != uuids[picked][:, None]
+        order = np.argsort(~not_self, axis=1, kind="stable")[:, :k]
+        return tuple(np.take_along_axis(x, order, axis=1) for x in (found_uuids, found_users, dists)) + (elapsed,)
+
+    exact = Gallery(metric=metric)
+    exact.add(uuids, user_ids, embeddings)
+    exact_uuids, exact_users, exact_dists, exact_time = run(exact)
+    report = dict(n=len(uuids), dim=int(embeddings.shape[1]), metric=exact.metric, k=k, queries=len(picked),
+                  float32=dict(bytes=int(embeddings.nbytes), ms_per_query=1000 * exact_time / len(picked)))
+
+    for dtype in dtypes:
+        for factor in (1, rerank):
+            gallery = Gallery(metric=metric, dtype=dtype, rerank=factor, rerank_source=source)
+            gallery.add(uuids, user_ids, embeddings)
+            found_uuids, found_users, found_dists, elapsed = run(gallery)
+            hits = [len(np.intersect1d(a, b)) for a, b in zip(exact_uuids, found_uuids)]
+            result = dict(
+                bytes=int(gallery._embeddings[:len(gallery)].nbytes),
+                rerank=factor,
+                recall=float(np.sum(hits) / exact_uuids.size),
+                max_dist_error=float(np.max(np.abs(found_dists[:, 0] - exact_dists[:, 0]))),
+                ms_per_query=1000 * elapsed / len(picked)
+            )
+            if threshold is not None:
+                exact_match = np.where(exact_dists[:, 0] <= threshold, exact_users[:, 0], -1)
+                found_match = np.where(found_dists[:, 0] <= threshold, found_users[:, 0], -1)
+                result["decision_agreement"] = float(np.mean(exact_match == found_match))
+            report[f"{dtype}@rerank{factor}"] = result
+    return report
+
+
+if __name__ == '__main__':
+    import json
+    import argparse
+
+    from app import create_app
+    from app.config import BaseConfig
+    from app.facelib.gallery import Gallery
+    from app.facelib.face_recogni import FaceRecogni
+
+    parser = argparse.ArgumentParser(description="压缩特征检索的召回损失报告")
+    parser.add_argument("--k", type=int, default=1)
+    parser.add_argument("--rerank", type=int, default=BaseConfig.GALLERY_RERANK)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--output", default=None, help="保存为JSON文件")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    config = FaceRecogni.load_config()
+    application = create_app()
+    with application.app_context():
+        source_gallery = Gallery(metric=config["metric"], model_version=FaceRecogni.fingerprint(config))
+        source_gallery.load_from_db()
+    result = recall_report(source_gallery.uuids, source_gallery.user_ids, source_gallery.embeddings,
+                           metric=config["metric"], k=args.k, rerank=args.rerank,
+                           n_queries=args.queries, threshold=config["threshold"])
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
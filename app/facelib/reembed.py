@@ -0,0 +1,316 @@
+"""
+reembed.py
+更换模型后重新编码：用新模型对旧版本特征保存的人脸图片(base64Img)重新编码，写入新版本的特征
+服务在此期间继续使用旧版本的特征检索，新版本覆盖全部旧特征后原子切换启用的模型目录
+python -m app.facelib.reembed --model-dir resources/FaceRecogniModelV2 --max-rate 200
+python -m app.facelib.reembed --model-dir resources/FaceRecogniModelV2 --cutover
+检测不到人脸的图片记录在报告的failed_rows中，--fallback-unaligned 直接编码未对齐的图片，
+--allow-missing N 允许最多N条旧特征没有新特征时切换(这些用户需要重新录入)
+进度保存在检查点文件，中断后使用相同参数重新运行即可继续；切换后各服务重新加载模型与特征库后生效
+"""
+import os
+import sys
+
+project_path = os.path.join(os.path.dirname(__file__), os.path.pardir, os.path.pardir)
+sys.path.append(project_path)
+
+import time
+import json
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def embed_faces(pipeline, images, fallback=False):
+    """
+    已按模型输入尺寸对齐的人脸直接编码，其它图片经过检测与对齐
+    :param pipeline: FacePipeline
+    :param images: RGB图片列表，解码失败的为None
+    :param fallback: 检测不到人脸时直接编码等比例缩放后的整张图片
+    :return: embeddings [n,dim], index [n] 成功编码的图片下标, unaligned 其中未经对齐编码的图片下标
+    """
+    recogni = pipeline.recogni
+    w, h = recogni.input_shape[:2]
+    aligned = [i for i, image in enumerate(images) if image is not None and image.shape[:2] == (h, w)]
+    others = [i for i, image in enumerate(images) if image is not None and image.shape[:2] != (h, w)]
+    embeddings, index, unaligned = [], [], []
+    if aligned:
+        faces = np.stack([images[i] for i in aligned])
+        embeddings.append(pipeline.embed(faces))
+        index.extend(aligned)
+    if others:
+        result = pipeline.run([images[i] for i in others])
+        embeddings.append(result.embeddings)
+        index.extend(others[i] for i in result.index)
+        detected = set(result.index)
+        unaligned = [others[i] for i in range(len(others)) if i not in detected] if fallback else []
+        if unaligned:
+            embeddings.append(pipeline.embed([images[i] for i in unaligned]))
+            index.extend(unaligned)
+    if not embeddings:
+        return np.zeros((0, recogni.output_shape[-1]), dtype=np.float32), [], []
+    return np.vstack(embeddings), index, unaligned
+
+
+def reembed_late(pipeline, gallery, source_version, after_uuid):
+    """
+    热切换模型版本时，旧实例在加载与排空期间录入的特征(编号大于after_uuid)用新模型重新编码，
+    写入数据库与新特征库并通知其它进程；已有相同人脸的新版本特征时跳过(其它进程已处理)
+    需要在app_context中调用
+    :param pipeline: 使用新模型的 FacePipeline
+    :param gallery: 新特征库
+    :param source_version: 旧特征的模型版本
+    :param after_uuid: 开始切换时的最大特征编号
+    :return: 重新编码的数量, 失败的数量
+    """
+    from app.extensions import db
+    from app.models.models import Embedding
+    from .pipeline import decode_face
+    from .sync import GallerySync
+
+    target_version = pipeline.recogni.model_version
+    rows = db.session.query(Embedding.uuid, Embedding.userId, Embedding.base64Img) \
+        .filter(Embedding.modelVersion == source_version, Embedding.uuid > after_uuid) \
+        .order_by(Embedding.uuid).all()
+    done = set(db.session.query(Embedding.userId, Embedding.base64Img)
+               .filter(Embedding.modelVersion == target_version, Embedding.uuid > after_uuid).all())
+    rows = [row for row in rows if (row[1], row[2]) not in done]
+    if not rows:
+        db.session.remove()
+        return 0, 0
+    embeddings, index, _ = embed_faces(pipeline, [decode_face(base64_img) for _, _, base64_img in rows])
+    new_rows = [Embedding(userId=rows[i][1], embdBlob=embedding.tobytes(), base64Img=rows[i][2],
+                          modelVersion=target_version)
+                for i, embedding in zip(index, embeddings)]
+    db.session.add_all(new_rows)
+    db.session.flush()  # 获取主键
+    uuids = [row.uuid for row in new_rows]
+    user_ids = [row.userId for row in new_rows]
+    db.session.commit()
+    db.session.remove()
+    if uuids:
+        gallery.add(uuids, user_ids, embeddings)
+        GallerySync.notify("add", uuids, user_ids)
+    logger.info(f"Reembed: {len(uuids)} late embeddings, failed {len(rows) - len(uuids)}")
+    return len(uuids), len(rows) - len(uuids)
+
+
+class ReembedJob:
+
+    def __init__(self, pipeline, source_version, checkpoint_path, batch_size=256, max_rate=None, fallback=False):
+        """
+        :param pipeline: 使用新模型的 FacePipeline
+        :param source_version: 旧特征的模型版本
+        :param checkpoint_path: 检查点文件
+        :param batch_size: 每次从数据库读取并编码的行数，一个事务
+        :param max_rate: 每秒最多编码的图片数，None表示不限制，避免影响在线服务
+        :param fallback: 检测不到人脸时直接编码未对齐的图片，见 embed_faces
+        """
+        self.pipeline = pipeline
+        self.recogni = pipeline.recogni
+        self.source_version = source_version
+        self.target_version = pipeline.recogni.model_version
+        self.checkpoint_path = checkpoint_path
+        self.batch_size = batch_size
+        self.max_rate = max_rate
+        self.fallback = fallback
+        # failed_uuids 无法编码的旧特征编号, unaligned 未经对齐编码的数量
+        self.state = dict(source_version=source_version, target_version=self.target_version,
+                          last_uuid=0, target_max_uuid=0, done=0, failed=0, failed_uuids=[], unaligned=0)
+        self.load_checkpoint()
+
+    def load_checkpoint(self):
+        if not os.path.exists(self.checkpoint_path):
+            return
+        with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+        if (state["source_version"], state["target_version"]) != (self.source_version, self.target_version):
+            raise ValueError(f"检查点属于其它模型: {state['source_version']} -> {state['target_version']}")
+        self.state.update(state)
+
+    def save_checkpoint(self):
+        tmp_path = f"{self.checkpoint_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def discard_uncommitted(self):
+        """
+        删除上次运行在保存检查点之前中断时已提交的新特征，之后从检查点重新编码，每条旧特征只编码一次
+        只在切换前调用，切换后服务也会写入新版本的特征
+        """
+        from app.extensions import db
+        from app.models.models import Embedding
+
+        count = db.session.query(Embedding).filter(Embedding.modelVersion == self.target_version,
+                                                   Embedding.uuid > self.state["target_max_uuid"]) \
+            .delete(synchronize_session=False)
+        db.session.commit()
+        if count:
+            logger.info(f"Reembed: {count} uncommitted embeddings discarded")
+        return count
+
+    def embed(self, images):
+        """
+        :return: embeddings [n,dim], index [n] 成功编码的图片下标, unaligned，见 embed_faces
+        """
+        return embed_faces(self.pipeline, images, fallback=self.fallback)
+
+    def run_batch(self):
+        """
+        编码一批旧特征并提交
+        :return: 读取的行数，0表示已全部完成
+        """
+        from app.extensions import db
+        from app.models.models import Embedding
+        from .pipeline import decode_face
+
+        rows = db.session.query(Embedding.uuid, Embedding.userId, Embedding.base64Img) \
+            .filter(Embedding.modelVersion == self.source_version, Embedding.uuid > self.state["last_uuid"]) \
+            .order_by(Embedding.uuid).limit(self.batch_size).all()
+        if not rows:
+            return 0
+        images = [decode_face(base64_img) for _, _, base64_img in rows]
+        embeddings, index, unaligned = self.embed(images)
+        new_rows = [Embedding(userId=rows[i][1], embdBlob=embedding.tobytes(), base64Img=rows[i][2],
+                              modelVersion=self.target_version)
+                    for i, embedding in zip(index, embeddings)]
+        db.session.add_all(new_rows)
+        db.session.flush()  # 获取主键
+        target_max_uuid = max([row.uuid for row in new_rows], default=self.state["target_max_uuid"])
+        db.session.commit()
+        db.session.expunge_all()
+
+        self.state["last_uuid"] = rows[-1][0]
+        self.state["target_max_uuid"] = max(self.state["target_max_uuid"], target_max_uuid)
+        self.state["done"] += len(new_rows)
+        self.state["failed"] += len(rows) - len(new_rows)
+        encoded = set(index)
+        self.state["failed_uuids"].extend(rows[i][0] for i in range(len(rows)) if i not in encoded)
+        self.state["unaligned"] += len(unaligned)
+        self.save_checkpoint()
+        return len(rows)
+
+    def run(self):
+        """
+        编码到没有未处理的旧特征，运行期间新增的旧特征也会处理
+        :return: coverage()
+        """
+        from .face_recogni import FaceRecogni
+        if FaceRecogni.fingerprint(FaceRecogni.load_config()) != self.target_version:  # 尚未切换
+            self.discard_uncommitted()
+        begin = time.perf_counter()
+        processed = 0
+        while True:
+            n = self.run_batch()
+            if n == 0:
+                break
+            processed += n
+            elapsed = time.perf_counter() - begin
+            if self.max_rate:  # 限速，平均速度不超过max_rate
+                delay = processed / self.max_rate - elapsed
+                if delay > 0:
+                    time.sleep(delay)
+                    elapsed += delay
+            logger.info(f"Reembed: {self.state['done'] + self.state['failed']} rows, "
+                        f"{processed / elapsed:.1f} images/s, failed {self.state['failed']}")
+        return self.coverage()
+
+    def coverage(self):
+        """
+        :return: dict total 旧特征数, done 已编码, failed 无法解码或检测不到人脸, remaining 未处理,
+            coverage 已编码比例, users_missing 有旧特征但没有新特征的用户数,
+            failed_rows 仍存在的无法编码的旧特征 [{uuid, userId}], unaligned 未经对齐编码的数量
+        """
+        from sqlalchemy import func
+        from sqlalchemy.orm import aliased
+        from app.extensions import db
+        from app.models.models import Embedding
+
+        source = db.session.query(func.count(Embedding.uuid)).filter(Embedding.modelVersion == self.source_version)
+        total = source.scalar()
+        remaining = source.filter(Embedding.uuid > self.state["last_uuid"]).scalar()
+        # 按数据库统计，编码后被删除的特征不计入
+        done = db.session.query(func.count(Embedding.uuid)) \
+            .filter(Embedding.modelVersion == self.target_version).scalar()
+        target = aliased(Embedding)
+        has_target = db.session.query(target.uuid).filter(target.userId == Embedding.userId,
+                                                          target.modelVersion == self.target_version).exists()
+        users_missing = db.session.query(func.count(func.distinct(Embedding.userId))) \
+            .filter(Embedding.modelVersion == self.source_version, ~has_target).scalar()
+        failed_rows = db.session.query(Embedding.uuid, Embedding.userId) \
+            .filter(Embedding.uuid.in_(self.state["failed_uuids"])).order_by(Embedding.uuid).all() \
+            if self.state["failed_uuids"] else []
+        db.session.remove()
+        return dict(source_version=self.source_version, target_version=self.target_version,
+                    total=total, done=done, failed=self.state["failed"], remaining=remaining,
+                    coverage=min(done / total, 1.0) if total else 1.0, users_missing=users_missing,
+                    failed_rows=[dict(uuid=uuid, userId=user_id) for uuid, user_id in failed_rows],
+                    unaligned=self.state["unaligned"])
+
+    def cutover(self, model_root, min_coverage=1.0, allow_missing=0):
+        """
+        全部旧特征处理完，且覆盖率不低于min_coverage或无法编码的旧特征不超过allow_missing条时切换启用的模型目录
+        :param allow_missing: 允许没有新特征的旧特征数，这些用户切换后需要重新录入
+        :return: bool
+        """
+        from .face_recogni import FaceRecogni
+        report = self.coverage()
+        missing = max(report["total"] - report["done"], 0)
+        if report["remaining"] > 0 or (report["coverage"] < min_coverage and missing > allow_missing):
+            logger.warning(f"Reembed: cutover refused, {report}")
+            return False
+        if missing:
+            logger.warning(f"Reembed: {missing} embeddings without new version, "
+                           f"{report['users_missing']} users need to enroll again: {report['failed_rows']}")
+        FaceRecogni.activate(model_root)
+        logger.info(f"Reembed: model {self.target_version} activated, {model_root}")
+        return True
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from app.config import BaseConfig
+    from app import create_app
+    from app.facelib.face_recogni import FaceRecogni
+    from app.facelib.face_landmark import LandmarkDetector
+    from app.facelib.pipeline import FacePipeline
+
+    parser = argparse.ArgumentParser(description="使用新模型重新编码已保存的人脸，完成后切换模型")
+    parser.add_argument("--model-dir", required=True, help="新模型目录，包含config.yaml")
+    parser.add_argument("--source-version", default=None, help="旧特征的模型版本，默认为当前启用的模型")
+    parser.add_argument("--checkpoint", default=None, help="默认保存在新模型目录")
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--max-rate", type=float, default=None, help="每秒最多编码的图片数")
+    parser.add_argument("--cutover", action="store_true", help="编码完成后切换启用的模型")
+    parser.add_argument("--min-coverage", type=float, default=1.0, help="切换所需的最低覆盖率")
+    parser.add_argument("--allow-missing", type=int, default=0,
+                        help="覆盖率不足时，允许最多该数量的旧特征无法编码(见报告的failed_rows)仍然切换")
+    parser.add_argument("--fallback-unaligned", action="store_true", help="检测不到人脸时直接编码未对齐的图片")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    source_version = args.source_version or FaceRecogni.fingerprint(FaceRecogni.load_config())
+    recogni = FaceRecogni(model_root=args.model_dir)
+    recogni.prepare()
+    if recogni.model_version == source_version:
+        logger.error(f"新模型与当前模型的版本相同: {source_version}")
+        sys.exit(1)
+    recogni.load_model()
+    pipeline = FacePipeline(recogni, LandmarkDetector(pool_size=1), batch_size=BaseConfig.INFERENCE_MAX_BATCH)
+    checkpoint = args.checkpoint or os.path.join(args.model_dir, f"reembed.{source_version}.checkpoint")
+    job = ReembedJob(pipeline, source_version, checkpoint, batch_size=args.batch_size, max_rate=args.max_rate,
+                     fallback=args.fallback_unaligned)
+
+    application = create_app()
+    with application.app_context():
+        report = job.run()
+        if args.cutover:
+            report["activated"] = job.cutover(args.model_dir, min_coverage=args.min_coverage,
+                                              allow_missing=args.allow_missing)
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,184 @@
+"""
+result_cache.py
+识别结果缓存：同一考生在短时间内重复提交(重试、连续多帧)时，跳过全库检索
+查询特征正则化后由随机超平面的符号(LSH)分桶，相近的查询大概率落入同一个桶；
+同一查询在多组超平面下各有一个桶，只要有一组相同即可找到。
+桶内的缓存查询与本次查询的距离在容差内才使用其结果，之后仍与缓存用户的特征计算一次距离确认
+"""
+import time
+import itertools
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from .distance import l2_normalize, pairwise_distance
+
+
+class ResultCache:
+    INSTANCE = None
+
+    def __init__(self, maxsize=4096, ttl=10.0, tolerance=0.4, bits=8, tables=6):
+        """
+        :param maxsize: 最大缓存条数，超出时淘汰最久未使用的
+        :param ttl: 缓存有效期/秒
+        :param tolerance: 正则化后的查询之间的最大欧氏距离，超出时不使用缓存的结果
+        :param bits: 每组超平面数，越少桶越大、越容易命中，桶内仍会按容差确认
+        :param tables: 超平面组数，越多越不容易漏掉容差内的缓存
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.tolerance = tolerance
+        self.bits = bits
+        self.tables = tables
+        self._planes = None  # [tables*bits, dim]，首次使用时按特征维度生成
+        self._entries = OrderedDict()  # 编号 -> (桶key列表, 正则化的查询, uuid, user_id, 过期时间)
+        self._buckets = {}  # 桶key -> 缓存编号集合
+        self._users = {}  # 用户编号 -> 该用户的缓存编号集合
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0  # 命中但距离确认未通过
+
+    def keys(self, query, scope=None):
+        """
+        :param query: 正则化后的查询 [dim]
+        :param scope: 检索范围，如考试编号
+        :return: 每组超平面一个桶key
+        """
+        planes = self._planes
+        if planes is None or planes.shape[1] != len(query):
+            # 固定种子，各进程的分桶一致
+            rng = np.random.default_rng(0)
+            planes = self._planes = rng.standard_normal((self.tables * self.bits, len(query))).astype(np.float32)
+        signs = (planes @ query > 0).reshape(self.tables, self.bits)
+        codes = np.packbits(signs, axis=1)
+        return [(scope, table, code.tobytes()) for table, code in enumerate(codes)]
+
+    def _pop(self, entry_id):
+        entry = self._entries.pop(entry_id, None)
+        if entry is not None:
+            keys, _, _, user_id, _ = entry
+            for key in keys:
+                bucket = self._buckets.get(key, None)
+                if bucket is not None:
+                    bucket.discard(entry_id)
+                    if not bucket:
+                        self._buckets.pop(key, None)
+            ids = self._users.get(user_id, None)
+            if ids is not None:
+                ids.discard(entry_id)
+                if not ids:
+                    self._users.pop(user_id, None)
+        return entry
+
+    def _nearest(self, query, keys):
+        """
+        桶内与query距离在容差内的最近缓存，调用方持有锁
+        :return: 缓存编号 或 None
+        """
+        now = time.monotonic()
+        candidates = []
+        for key in keys:
+            for entry_id in list(self._buckets.get(key, ())):
+                if self._entries[entry_id][4] < now:
+                    self._pop(entry_id)
+                else:
+                    candidates.append(entry_id)
+        if not candidates:
+            return None
+        candidates = list(dict.fromkeys(candidates))
+        cached = np.stack([self._entries[entry_id][1] for entry_id in candidates])
+        dist = pairwise_distance(query[np.newaxis], cached, "l2", normalized=True)[0]
+        best = int(np.argmin(dist))
+        return candidates[best] if dist[best] <= self.tolerance else None
+
+    def get(self, query, gallery, threshold, scope=None):
+        """
+        查找缓存并确认距离，需要在app_context中调用
+        :param query: [dim] 或 [1, dim]
+        :param gallery: 检索使用的特征库，提供 user_embeddings 与 metric
+        :param threshold: 模型阈值
+        :param scope: 检索范围
+        :return: (uuid, user_id, distance) 或 None
+        """
+        normalized = l2_normalize(np.asarray(query, dtype=np.float32).reshape(1, -1))[0]
+        with self._lock:
+            entry_id = self._nearest(normalized, self.keys(normalized, scope))
+            if entry_id is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(entry_id)
+            _, _, uuid, user_id, _ = self._entries[entry_id]
+        uuids, embeddings = gallery.user_embeddings(user_id)
+        valid = ~np.isnan(embeddings).any(axis=1) if len(uuids) else np.empty(0, dtype=bool)
+        if np.any(valid):
+            query = np.asarray(query, dtype=np.float32).reshape(1, -1)
+            dist = pairwise_distance(query, embeddings[valid], gallery.metric)[0]
+            best = int(np.argmin(dist))
+            if dist[best] <= threshold:
+                with self._lock:
+                    self.hits += 1
+                return int(uuids[valid][best]), user_id, float(dist[best])
+        with self._lock:
+            self.rejected += 1
+            self.misses += 1
+            self._pop(entry_id)
+        return None
+
+    def put(self, query, uuid, user_id, scope=None):
+        """
+        缓存识别成功的结果
+        """
+        normalized = l2_normalize(np.asarray(query, dtype=np.float32).reshape(1, -1))[0]
+        user_id = int(user_id)
+        with self._lock:
+            keys = self.keys(normalized, scope)
+            entry_id = next(self._ids)
+            self._entries[entry_id] = (keys, normalized, int(uuid), user_id, time.monotonic() + self.ttl)
+            for key in keys:
+                self._buckets.setdefault(key, set()).add(entry_id)
+            self._users.setdefault(user_id, set()).add(entry_id)
+            while len(self._entries) > self.maxsize:
+                self._pop(next(iter(self._entries)))
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+            self._users.clear()
+
+    def invalidate_user(self, user_id):
+        """
+        用户特征变更时清除其缓存
+        """
+        with self._lock:
+            for entry_id in list(self._users.get(int(user_id), ())):
+                self._pop(entry_id)
+
+    def on_gallery_change(self, op, uuid, user_id):
+        """
+        其它进程变更特征库时的回调，见 app.facelib.sync
+        """
+        if op == "reload":
+            self.invalidate()
+        else:
+            self.invalidate_user(user_id)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return dict(size=len(self._entries), hits=self.hits, misses=self.misses, rejected=self.rejected,
+                        hit_rate=self.hits / total if total else 0.0)
+
+    @staticmethod
+    def get_instance():
+        if ResultCache.INSTANCE is None:
+            from app.config import BaseConfig
+            ResultCache.INSTANCE = ResultCache(maxsize=BaseConfig.RESULT_CACHE_SIZE, ttl=BaseConfig.RESULT_CACHE_TTL,
+                                               tolerance=BaseConfig.RESULT_CACHE_TOLERANCE,
+                                               bits=BaseConfig.RESULT_CACHE_BITS,
+                                               tables=BaseConfig.RESULT_CACHE_TABLES)
+
+        return ResultCache.INSTANCE
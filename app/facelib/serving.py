@@ -0,0 +1,341 @@
+"""
+serving.py
+请求处理使用的模型与特征库，支持不重启服务的热切换
+    with Serving.use() as serving:
+        serving.recogni / serving.gallery / serving.search_engine()
+请求开始时取得当前实例并一直使用到结束；切换只替换引用，正在处理的请求继续使用旧实例，
+旧实例在最后一个请求结束后释放(停止微批处理线程、关闭分片进程等)
+reload() 在后台加载新模型与特征库并预热，完成后原子切换
+"""
+import sys
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def peak_rss_mb():
+    """
+    进程启动以来的最大常驻内存/MB，平台不支持时为None
+    """
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+class _Forwarder:
+    """
+    挂在旧特征库上的观察者：切换前记录增删，切换时重放到新特征库，之后直接转发，
+    保证加载新特征库期间以及旧实例上未完成的请求所做的增删不会丢失
+    模型版本不同时新增的特征不属于新特征库，只转发删除，旧实例上录入的特征在排空后由新模型重新编码
+    """
+
+    def __init__(self, same_version):
+        self.same_version = same_version
+        self.target = None
+        self.pending = []
+        self.stale = False  # 旧特征库被重新加载，记录不再完整
+
+    def _apply(self, op, uuids, user_ids=None, embeddings=None):
+        if op == "add":
+            uuids = np.asarray(uuids, dtype=np.int64)
+            new = ~np.isin(uuids, self.target.uuids)  # 加载时已包含的特征
+            if np.any(new):
+                self.target.add(uuids[new], np.asarray(user_ids)[new], np.asarray(embeddings)[new])
+        else:
+            self.target.remove(uuids)
+
+    def _record(self, *args):
+        if self.target is None:
+            self.pending.append(args)
+        else:
+            self._apply(*args)
+
+    def add(self, uuids, user_ids, embeddings):
+        if self.same_version:
+            self._record("add", np.array(uuids), np.array(user_ids), np.array(embeddings))
+
+    def remove(self, uuids):
+        self._record("remove", np.array(uuids))
+
+    def reset(self):
+        self.stale = True
+        self.pending = []
+
+    def attach(self, target):
+        """
+        重放记录并开始转发，调用方持有旧特征库的锁
+        """
+        self.target = target
+        for args in self.pending:
+            self._apply(*args)
+        self.pending = []
+
+
+class Serving:
+    INSTANCE = None
+    _swap_lock = threading.Lock()
+    _reload_lock = threading.Lock()
+    last_reload = {}  # 最近一次热切换的报告
+    pending_version = None  # 正在切换到的模型版本，与当前版本不同时暂停旧实例上的录入
+    DRAIN_TIMEOUT = 60.0  # 切换模型版本后等待旧实例上的请求结束的最长时间/秒
+
+    def __init__(self, recogni, gallery):
+        """
+        :param recogni: FaceRecogni
+        :param gallery: Gallery
+        """
+        self.recogni = recogni
+        self.gallery = gallery
+        self.created = time.time()
+        self._engine = None
+        self._pipeline = None
+        self._lock = threading.Lock()
+        self.active = 0  # 正在使用该实例的请求数
+        self.retired = False
+        self.closed = False
+        self.on_drained = []  # 切换后最后一个请求结束时的回调
+
+    def search_engine(self):
+        """
+        全量检索使用的结构：按用户聚合的模板、多进程分片或特征库本身，每个实例单独创建
+        """
+        if self._engine is None:
+            from app.config import BaseConfig
+            with self._lock:
+                if self._engine is None:
+                    if BaseConfig.GALLERY_TEMPLATE:
+                        from .template import TemplateSearch
+                        self._engine = TemplateSearch(self.gallery, self.recogni.threshold,
+                                                      margin=BaseConfig.TEMPLATE_MARGIN,
+                                                      candidates=BaseConfig.TEMPLATE_CANDIDATES)
+                    elif BaseConfig.SEARCH_PROCESSES > 0:
+                        from .sharded import ShardedSearchEngine
+                        self._engine = ShardedSearchEngine(self.gallery, workers=BaseConfig.SEARCH_PROCESSES,
+                                                           min_size=BaseConfig.SEARCH_SHARD_MIN_SIZE)
+                    else:
+                        self._engine = self.gallery
+        return self._engine
+
+    def pipeline(self):
+        """
+        使用本实例模型的 检测->对齐->编码 流水线
+        """
+        if self._pipeline is None:
+            from app.config import BaseConfig
+            from .pipeline import FacePipeline
+            from .face_landmark import LandmarkDetector
+            with self._lock:
+                if self._pipeline is None:
+                    self._pipeline = FacePipeline(self.recogni, LandmarkDetector.get_instance(),
+                                                  batch_size=BaseConfig.INFERENCE_MAX_BATCH)
+        return self._pipeline
+
+    def enrollment_paused(self):
+        """
+        正在切换到其它模型版本时不再接受旧实例上的录入，已在处理中的录入在切换后重新编码
+        """
+        pending = Serving.pending_version
+        return pending is not None and pending != self.recogni.model_version
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+            drained = self.retired and self.active == 0
+        if drained:
+            self.close()
+
+    def retire(self):
+        """
+        已被切换，没有请求在使用时释放
+        """
+        with self._lock:
+            self.retired = True
+            drained = self.active == 0
+        if drained:
+            self.close()
+
+    def close(self):
+        if self.recogni.batcher is not None:
+            self.recogni.batcher.stop()
+        engine = self._engine
+        if engine is not None and engine is not self.gallery:
+            if hasattr(engine, "detach"):
+                engine.detach()
+            if hasattr(engine, "close"):
+                engine.close()
+        self.closed = True
+        for callback in self.on_drained:
+            callback(self)
+        logger.info(f"Serving Released: model {self.recogni.model_version}, {len(self.gallery)} embeddings")
+
+    def warm_up(self, k=1):
+        """
+        预热检索：创建检索结构并执行一次检索，触发快照映射的页面加载
+        """
+        engine = self.search_engine()
+        if len(self.gallery) > 0:
+            query = np.random.default_rng(0).standard_normal((1, self.gallery.dim)).astype(np.float32)
+            engine.search_batch(query, k)
+
+    @staticmethod
+    def get_instance():
+        """
+        当前实例，首次调用时由 FaceRecogni/Gallery 的单例创建，需要在app_context中调用
+        """
+        if Serving.INSTANCE is None:
+            from .face_recogni import FaceRecogni
+            from .gallery import Gallery
+            recogni = FaceRecogni.get_instance()
+            gallery = Gallery.get_instance(metric=recogni.metric, model_version=recogni.model_version)
+            with Serving._swap_lock:
+                if Serving.INSTANCE is None:
+                    Serving.INSTANCE = Serving(recogni, gallery)
+
+        return Serving.INSTANCE
+
+    @staticmethod
+    @contextmanager
+    def use():
+        """
+        请求期间持有当前实例，期间发生的切换不影响本次请求
+        """
+        Serving.get_instance()
+        with Serving._swap_lock:
+            serving = Serving.INSTANCE
+            with serving._lock:
+                serving.active += 1
+        try:
+            yield serving
+        finally:
+            serving.release()
+
+    @staticmethod
+    def reload(application, preload=True):
+        """
+        加载当前启用的模型与特征库，预热后替换正在使用的实例
+        :param application: Flask app，读取数据库
+        :param preload: 加载模型并预热，未启用服务端人脸识别时为False，只读取模型配置
+        :return: 报告 dict，正在切换时返回None
+        """
+        if not Serving._reload_lock.acquire(blocking=False):
+            return None
+        try:
+            return Serving._reload(application, preload)
+        except Exception as e:
+            logger.exception("Serving Reload Failed")
+            Serving.last_reload.update(status="failed", error=str(e), end=time.time())
+            return Serving.last_reload
+        finally:
+            Serving.pending_version = None
+            Serving._reload_lock.release()
+
+    @staticmethod
+    def _reload(application, preload):
+        from .face_recogni import FaceRecogni
+        from .gallery import Gallery, ExamGalleryCache
+        from .pipeline import FacePipeline
+        from .result_cache import ResultCache
+
+        old = Serving.get_instance()
+        report = dict(status="loading", begin=time.time(), old_model_version=old.recogni.model_version,
+                      peak_rss_mb_before=peak_rss_mb())
+        Serving.last_reload = report
+        begin = time.perf_counter()
+
+        recogni = FaceRecogni()
+        recogni.prepare()
+        if preload:
+            recogni.preload()
+            report["warm_up"] = {str(size): stats for size, stats in recogni.warm_up_stats.items()}
+        report["model_ms"] = (time.perf_counter() - begin) * 1000
+
+        cross_version = recogni.model_version != old.recogni.model_version
+        if cross_version:
+            # 先暂停录入再记录最大编号，之后旧实例上提交的特征编号都大于after_uuid
+            Serving.pending_version = recogni.model_version
+            from sqlalchemy import func
+            from app.extensions import db
+            from app.models.models import Embedding
+            with application.app_context():
+                after_uuid = db.session.query(func.max(Embedding.uuid)).scalar() or 0
+
+        # 加载期间旧特征库的增删先记录下来
+        forwarder = _Forwarder(same_version=old.gallery.model_version == recogni.model_version)
+        with old.gallery._lock:
+            old.gallery.observers.append(forwarder)
+        enter = time.perf_counter()
+        try:
+            while True:
+                with application.app_context():
+                    gallery = Gallery.create(metric=recogni.metric, model_version=recogni.model_version)
+                if not forwarder.stale:
+                    break
+                forwarder.stale = False  # 旧特征库加载期间被重新加载(同步缺失)，新特征库也重新加载
+            serving = Serving(recogni, gallery)
+            serving.warm_up()
+        except Exception:
+            with old.gallery._lock:
+                old.gallery.observers.remove(forwarder)
+            if recogni.batcher is not None:
+                recogni.batcher.stop()
+            raise
+        report["gallery_ms"] = (time.perf_counter() - enter) * 1000
+
+        enter = time.perf_counter()
+        with Serving._swap_lock, old.gallery._lock:
+            forwarder.attach(gallery)
+            Serving.INSTANCE = serving
+            FaceRecogni.INSTANCE = recogni
+            Gallery.INSTANCE = gallery
+            FacePipeline.INSTANCE = None
+        report["swap_ms"] = (time.perf_counter() - enter) * 1000
+        ExamGalleryCache.get_instance().invalidate()
+        ResultCache.get_instance().invalidate()
+
+        def drained(instance):
+            with instance.gallery._lock:
+                if forwarder in instance.gallery.observers:
+                    instance.gallery.observers.remove(forwarder)
+            report["drain_ms"] = (time.time() - report["end"]) * 1000
+
+        old.on_drained.append(drained)
+        report.update(status="swapped", end=time.time(), model_version=recogni.model_version, embeddings=len(gallery),
+                      in_flight=old.active, total_ms=(time.perf_counter() - begin) * 1000,
+                      peak_rss_mb_after=peak_rss_mb())
+        old.retire()
+        if cross_version:
+            Serving._reembed_late(application, old, serving, after_uuid, report)
+        report["status"] = "done"
+        logger.info(f"Serving Reloaded: {report}")
+        return report
+
+    @staticmethod
+    def _reembed_late(application, old, serving, after_uuid, report):
+        """
+        等待旧实例上的请求结束，用新模型重新编码这些请求录入的特征
+        """
+        from .gallery import ExamGalleryCache
+        from .reembed import reembed_late
+        from .result_cache import ResultCache
+
+        deadline = time.perf_counter() + Serving.DRAIN_TIMEOUT
+        while not old.closed and time.perf_counter() < deadline:
+            time.sleep(0.05)
+        if not old.closed:
+            logger.warning(f"Serving Reload: {old.active} requests still running on the old model")
+        Serving.pending_version = None
+        with application.app_context():
+            before = len(serving.gallery)
+            report["reembedded"], report["reembed_failed"] = reembed_late(
+                serving.pipeline(), serving.gallery, old.recogni.model_version, after_uuid)
+        if len(serving.gallery) != before:
+            ExamGalleryCache.get_instance().invalidate()
+            ResultCache.get_instance().invalidate()
@@ -0,0 +1,278 @@
+"""
+sharded.py
+多进程分片检索：特征矩阵放在共享内存中，按行切分给进程池并行计算，再合并各分片的topk
+gevent只使用一个核，检索在其它进程中进行，不阻塞事件循环
+monkey patch后进程池的管理线程与队列都是协程，只能由创建它的原生线程的hub驱动，
+多个检索线程同时提交会卡住，创建与提交在一个专用线程的hub中进行，
+各检索线程用monkey patch之前的锁等待自己的结果，多个检索可以同时进行
+"""
+import os
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context, shared_memory, parent_process
+
+if parent_process() is not None:
+    # 工作进程各自只计算一个分片，限制BLAS线程数避免多进程争抢CPU，需要在导入numpy之前设置
+    for _var in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ.setdefault(_var, "1")
+
+import numpy as np
+
+from app.facelib.distance import norm_distance, topk_smallest
+from app.facelib.executor import _gevent_patched, call_in_hub, native_lock
+
+logger = logging.getLogger(__name__)
+
+# 工作进程中已映射的共享内存 name -> (SharedMemory, embeddings, sq_norms)
+_ATTACHED = {}
+
+
+def _attach(name, capacity, dim):
+    entry = _ATTACHED.get(name, None)
+    if entry is None:
+        for old in list(_ATTACHED):  # 主进程已发布新的共享内存，释放旧的映射
+            old_shm, _, _ = _ATTACHED.pop(old)
+            old_shm.close()
+        # spawn创建的工作进程与主进程共用resource_tracker，共享内存由主进程负责释放
+        shm = shared_memory.SharedMemory(name=name)
+        embeddings = np.ndarray((capacity, dim), dtype=np.float32, buffer=shm.buf)
+        sq_norms = np.ndarray((capacity,), dtype=np.float32, buffer=shm.buf, offset=capacity * dim * 4)
+        entry = (shm, embeddings, sq_norms)
+        _ATTACHED[name] = entry
+    return entry[1], entry[2]
+
+
+def _search_shard(name, capacity, dim, begin, end, queries, k, metric):
+    """
+    工作进程：检索[begin, end)行
+    :return: 行号[m, k], 距离[m, k]
+    """
+    embeddings, sq_norms = _attach(name, capacity, dim)
+    dist = norm_distance(queries, embeddings[begin:end], sq_norms[begin:end], metric)
+    top = topk_smallest(dist, min(k, end - begin))
+    return top + begin, np.take_along_axis(dist, top, axis=1)
+
+
+class _Dispatcher:
+    """
+    驱动进程池的专用原生线程，线程中只运行自己的hub，任何原生线程都可以通过 run 在其中执行(call_in_hub)
+    run 只应用于创建、提交与关闭等很快返回的操作，等待结果在调用线程中进行
+    未启用monkey patch时直接在调用线程执行
+    """
+
+    def __init__(self):
+        self._hub = None
+        if not _gevent_patched():
+            return
+        from gevent import monkey
+        started = native_lock()
+        started.acquire()
+        monkey.get_original("_thread", "start_new_thread")(self._loop, (started,))
+        started.acquire()
+
+    def _loop(self, started):
+        import gevent
+        from gevent.event import Event
+        self._hub = gevent.get_hub()
+        stopped = Event()
+        # 没有活动的watcher时hub会退出，用于关闭的async watcher同时保持循环运行
+        self._stop = self._hub.loop.async_()
+        self._stop.start(stopped.set)
+        started.release()
+        stopped.wait()  # 让出给hub，处理提交的任务与进程池的管理协程
+        self._stop.close()
+
+    def run(self, func, *args, **kwargs):
+        if self._hub is None:
+            return func(*args, **kwargs)
+        return call_in_hub(self._hub, func, *args, **kwargs)
+
+    def close(self):
+        if self._hub is not None:
+            self._stop.send()
+
+
+class ShardedSearchEngine:
+    """
+    与Gallery相同的检索接口，增删仍由Gallery处理，检索前同步到共享内存
+    新增特征直接追加到共享内存，删除或扩容时重新发布
+    """
+
+    def __init__(self, gallery, workers=None, min_size=50000):
+        """
+        :param gallery: app.facelib.gallery.Gallery，只支持float32存储
+        :param workers: 进程数，默认为CPU核数
+        :param min_size: 特征数小于该值时在当前进程检索，进程间通信的开销大于收益
+        """
+        if gallery.quantized:
+            raise ValueError("分片检索只支持float32存储")
+        self.gallery = gallery
+        self.workers = workers or os.cpu_count()
+        self.min_size = min_size
+        # 进程池只在该线程中使用
+        self._dispatcher = _Dispatcher()
+        # fork会复制gevent的事件循环，使用spawn创建干净的进程
+        self._executor = self._dispatcher.run(ProcessPoolExecutor, max_workers=self.workers,
+                                              mp_context=get_context("spawn"))
+        self._lock = threading.Lock()
+        self._shm = None
+        self._retired = {}  # 已被替换的共享内存 name -> SharedMemory，使用它的检索都结束后释放
+        self._refs = {}  # 共享内存 name -> 正在使用的检索数
+        self._capacity = 0
+        self._dim = 0
+        self._count = 0
+        self._uuids = np.empty(0, dtype=np.int64)
+        self._user_ids = np.empty(0, dtype=np.int64)
+        self._version = None
+
+    def __getattr__(self, name):
+        # add/remove/metric等其余接口直接使用Gallery
+        if name == "gallery":
+            raise AttributeError(name)
+        return getattr(self.gallery, name)
+
+    def __len__(self):
+        return len(self.gallery)
+
+    def _publish(self, state, capacity):
+        """
+        重新创建共享内存并写入全部特征
+        """
+        n, dim = state["embeddings"].shape
+        shm = shared_memory.SharedMemory(create=True, size=max(capacity * (dim + 1) * 4, 1))
+        embeddings = np.ndarray((capacity, dim), dtype=np.float32, buffer=shm.buf)
+        sq_norms = np.ndarray((capacity,), dtype=np.float32, buffer=shm.buf, offset=capacity * dim * 4)
+        embeddings[:n] = state["embeddings"]
+        sq_norms[:n] = state["sq_norms"]
+        del embeddings, sq_norms
+        if self._shm is not None:
+            self._retired[self._shm.name] = self._shm
+            self._release_retired(self._shm.name)
+        self._shm, self._capacity, self._dim = shm, capacity, dim
+        logger.info(f"Sharded Gallery Published: {n} embeddings, capacity {capacity}")
+
+    def _release_retired(self, name):
+        """
+        已被替换且没有检索在使用时释放，调用方持有锁
+        """
+        if name in self._retired and self._refs.get(name, 0) <= 0:
+            shm = self._retired.pop(name)
+            self._refs.pop(name, None)
+            shm.close()
+            shm.unlink()
+
+    def _release(self, name):
+        with self._lock:
+            self._refs[name] -= 1
+            if self._refs[name] <= 0 and name not in self._retired:
+                del self._refs[name]
+            self._release_retired(name)
+
+    def _sync(self):
+        """
+        检索前与Gallery同步，返回的共享内存在 _release 之前不会被释放
+        :return: name, capacity, dim, count, uuids, user_ids
+        """
+        with self._lock:
+            if self._version != self.gallery.version:
+                self._version = self.gallery.version
+                state = self.gallery._snapshot()
+                n = len(state["uuids"])
+                count = self._count
+                appended = (0 < count <= n and n <= self._capacity and state["embeddings"].shape[1] == self._dim
+                            and state["uuids"][count - 1] == self._uuids[count - 1])
+                if appended:  # 只有追加，写入共享内存的空闲部分
+                    embeddings = np.ndarray((self._capacity, self._dim), dtype=np.float32, buffer=self._shm.buf)
+                    sq_norms = np.ndarray((self._capacity,), dtype=np.float32, buffer=self._shm.buf,
+                                          offset=self._capacity * self._dim * 4)
+                    embeddings[count:n] = state["embeddings"][count:n]
+                    sq_norms[count:n] = state["sq_norms"][count:n]
+                    del embeddings, sq_norms
+                elif n > 0:
+                    capacity = max(self._capacity, 1024)
+                    while capacity < n:
+                        capacity *= 2
+                    self._publish(state, capacity)
+                self._count = n
+                self._uuids = state["uuids"]
+                self._user_ids = state["user_ids"]
+            name = None if self._shm is None else self._shm.name
+            if name is not None:
+                self._refs[name] = self._refs.get(name, 0) + 1
+            return name, self._capacity, self._dim, self._count, self._uuids, self._user_ids
+
+    def search_batch(self, queries, k=1):
+        """
+        :param queries: [m, dim]
+        :param k:
+        :return: uuids, user_ids, distances 均为[m, k]，每行按距离升序
+        """
+        if self.gallery.index is not None or len(self.gallery) < self.min_size:
+            return self.gallery.search_batch(queries, k)
+        queries = np.asarray(queries, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = np.expand_dims(queries, axis=0)
+        name, capacity, dim, count, uuids, user_ids = self._sync()
+        if name is None:
+            return self.gallery.search_batch(queries, k)
+        try:
+            if count <= 0:
+                return self.gallery.search_batch(queries, k)
+            pending = self._dispatcher.run(self._submit_shards, name, capacity, dim, count, queries, k)
+            results = []
+            for done, result in pending:
+                done.acquire()
+                ok, value = result[0]
+                if not ok:
+                    raise value
+                results.append(value)
+        finally:
+            self._release(name)
+        # 合并各分片的topk
+        rows = np.hstack([result[0] for result in results])
+        dists = np.hstack([result[1] for result in results])
+        top = topk_smallest(dists, min(k, dists.shape[1]))
+        rows = np.take_along_axis(rows, top, axis=1)
+        return uuids[rows], user_ids[rows], np.take_along_axis(dists, top, axis=1)
+
+    def _submit_shards(self, name, capacity, dim, count, queries, k):
+        """
+        在专用线程中提交各分片，不等待结果
+        :return: [(锁, 结果)]，分片完成时在结果中写入 (成功, 返回值或异常) 并释放锁
+        """
+        bounds = np.linspace(0, count, self.workers + 1, dtype=np.int64)
+        pending = []
+        for begin, end in zip(bounds[:-1], bounds[1:]):
+            if end <= begin:
+                continue
+            done, result = native_lock(), []
+            done.acquire()
+            future = self._executor.submit(_search_shard, name, capacity, dim, int(begin), int(end), queries, k,
+                                           self.gallery.metric)
+            future.add_done_callback(lambda future, done=done, result=result: self._on_done(future, done, result))
+            pending.append((done, result))
+        return pending
+
+    @staticmethod
+    def _on_done(future, done, result):
+        # 在进程池的管理线程中执行，调用线程只等待锁，不访问future
+        try:
+            result.append((True, future.result()))
+        except BaseException as e:
+            result.append((False, e))
+        done.release()
+
+    def search(self, query, k=1):
+        query = np.asarray(query, dtype=np.float32).reshape(1, -1)
+        uuids, user_ids, dists = self.search_batch(query, k)
+        return uuids[0], user_ids[0], dists[0]
+
+    def close(self):
+        self._dispatcher.run(self._executor.shutdown, wait=True)
+        self._dispatcher.close()
+        with self._lock:
+            for shm in list(self._retired.values()) + ([self._shm] if self._shm is not None else []):
+                shm.close()
+                shm.unlink()
+            self._retired, self._refs, self._shm = {}, {}, None
@@ -0,0 +1,108 @@
+"""
+snapshot.py
+特征库快照，启动时通过np.memmap直接映射，多个进程共享同一份物理内存
+
+文件格式(小端):
+    header  64字节  magic, 格式版本, n, dim, seq, max_uuid
+    embeddings  [n, dim] float32
+    sq_norms    [n] float32
+    user_ids    [n] int64
+    uuids       [n] int64 升序
+"""
+import os
+import struct
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"FRGS"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<4sIQIxxxxQq")
+HEADER_SIZE = 64
+
+
+class GallerySnapshot:
+
+    def __init__(self, path):
+        self.path = path
+
+    @property
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def read_header(self):
+        """
+        :return: dict n, dim, seq, max_uuid；文件不存在或格式错误时返回None
+        """
+        if not self.exists:
+            return None
+        with open(self.path, "rb") as f:
+            raw = f.read(HEADER.size)
+        if len(raw) != HEADER.size:
+            return None
+        magic, version, n, dim, seq, max_uuid = HEADER.unpack(raw)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            return None
+        expected = HEADER_SIZE + n * dim * 4 + n * 4 + n * 8 * 2
+        if os.path.getsize(self.path) != expected:  # 写入不完整
+            return None
+        return dict(n=n, dim=dim, seq=seq, max_uuid=max_uuid)
+
+    def write(self, uuids, user_ids, embeddings):
+        """
+        写入临时文件后原子替换，正在映射旧文件的进程不受影响
+        :param uuids: 升序
+        :param user_ids:
+        :param embeddings: [n, dim] float32
+        :return: header
+        """
+        uuids = np.ascontiguousarray(uuids, dtype="<i8")
+        user_ids = np.ascontiguousarray(user_ids, dtype="<i8")
+        embeddings = np.ascontiguousarray(embeddings, dtype="<f4")
+        n = len(uuids)
+        dim = embeddings.shape[1] if embeddings.ndim == 2 and n > 0 else 0
+        old = self.read_header()
+        seq = 0 if old is None else old["seq"] + 1
+        max_uuid = int(uuids[-1]) if n > 0 else 0
+        sq_norms = np.sum(np.square(embeddings), axis=1).astype("<f4")
+
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, FORMAT_VERSION, n, dim, seq, max_uuid).ljust(HEADER_SIZE, b"\0"))
+            for array in (embeddings, sq_norms, user_ids, uuids):
+                f.write(array.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        logger.info(f"Gallery Snapshot Written: {n} embeddings, seq {seq}")
+        return dict(n=n, dim=dim, seq=seq, max_uuid=max_uuid)
+
+    def open(self):
+        """
+        只读映射快照
+        :return: header, dict embeddings, sq_norms, user_ids, uuids
+        """
+        header = self.read_header()
+        if header is None:
+            raise ValueError(f"无效的快照文件: {self.path}")
+        n, dim = header["n"], header["dim"]
+        offset = HEADER_SIZE
+        arrays = {}
+        for name, dtype, shape in (("embeddings", "<f4", (n, dim)), ("sq_norms", "<f4", (n,)),
+                                   ("user_ids", "<i8", (n,)), ("uuids", "<i8", (n,))):
+            if n == 0:
+                arrays[name] = np.empty(shape, dtype=dtype)
+                continue
+            arrays[name] = np.asarray(np.memmap(self.path, dtype=dtype, mode="r", offset=offset, shape=shape))
+            offset += arrays[name].nbytes
+        return header, arrays
+
+    def validate(self, count, max_uuid):
+        """
+        与数据库比对行数及最大编号
+        :return: bool
+        """
+        header = self.read_header()
+        return header is not None and header["n"] == count and header["max_uuid"] == (max_uuid or 0)
@@ -0,0 +1,170 @@
+"""
+sync.py
+多进程部署时通过Redis发布/订阅同步特征库的增删
+每次变更发布 (op, uuid, userId, version)，version由Redis全局自增，各进程按顺序应用
+发现version缺失且等待超时后全量重新加载
+"""
+import json
+import time
+import uuid as _uuid
+import logging
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class GallerySync:
+    INSTANCE = None
+    CHANNEL = "face_recogni:gallery"
+    VERSION_KEY = "face_recogni:gallery:version"
+
+    def __init__(self, redis_client, application=None, gap_timeout=5.0):
+        """
+        :param redis_client: redis.Redis 或 fakeredis.FakeRedis
+        :param application: Flask app，应用新增特征时需要查询数据库
+        :param gap_timeout: 缺失version的最长等待时间/秒，超时后全量重新加载
+        """
+        self.redis = redis_client
+        self.app = application
+        self.gap_timeout = gap_timeout
+        self.token = _uuid.uuid4().hex  # 区分本进程发布的消息
+        self.version = 0  # 已应用的最大version
+        self.reloads = 0
+        self._pending = {}  # version -> (message, 收到的时间)
+        self._pubsub = None
+        self._thread = None
+        self._running = False
+        self._lock = threading.Lock()
+        self.listeners = []  # 变更回调 callable(op, uuid, user_id)
+
+    def start(self):
+        """
+        先订阅再读取当前version，保证之后的变更都能收到，需要在加载特征库之前调用
+        """
+        self._pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(self.CHANNEL)
+        self.version = int(self.redis.get(self.VERSION_KEY) or 0)
+        self._running = True
+        self._thread = threading.Thread(target=self._listen, name="GallerySync", daemon=True)
+        self._thread.start()
+        logger.info(f"Gallery Sync Started: version {self.version}")
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        if self._pubsub is not None:
+            self._pubsub.close()
+
+    def publish(self, op, uuids, user_ids):
+        """
+        发布变更，调用方已经修改了本进程的特征库
+        :param op: "add"|"remove"
+        :param uuids: 特征编号
+        :param user_ids: 用户编号
+        """
+        for uuid, user_id in zip(uuids, user_ids):
+            version = int(self.redis.incr(self.VERSION_KEY))
+            message = dict(op=op, uuid=int(uuid), userId=int(user_id), version=version, origin=self.token)
+            self.redis.publish(self.CHANNEL, json.dumps(message))
+
+    def _listen(self):
+        while self._running:
+            try:
+                raw = self._pubsub.get_message(timeout=1.0)
+                if raw is not None and raw.get("type") == "message":
+                    self.receive(json.loads(raw["data"]))
+                self.check_gap()
+            except Exception:
+                logger.exception("Gallery Sync Error")
+                time.sleep(1)
+
+    def receive(self, message):
+        """
+        按version顺序应用变更
+        :param message: dict op, uuid, userId, version, origin
+        """
+        with self._lock:
+            version = message["version"]
+            if version <= self.version:  # 重复或重新加载前的消息
+                return
+            self._pending[version] = (message, time.monotonic())
+            while self.version + 1 in self._pending:
+                message, _ = self._pending.pop(self.version + 1)
+                if message.get("origin") != self.token:
+                    self.apply(message["op"], message["uuid"], message["userId"])
+                self.version += 1
+
+    def check_gap(self):
+        """
+        缺失的version等待超时后全量重新加载
+        """
+        with self._lock:
+            if not self._pending:
+                return
+            oldest = min(received for _, received in self._pending.values())
+            if time.monotonic() - oldest < self.gap_timeout:
+                return
+            missing = min(self._pending) - 1
+            logger.warning(f"Gallery Sync Gap: version {self.version + 1}-{missing} missing, reloading")
+            self.version = int(self.redis.get(self.VERSION_KEY) or 0)
+            self._pending = {v: item for v, item in self._pending.items() if v > self.version}
+            self.reload()
+
+    def _gallery(self):
+        from .gallery import Gallery
+        return Gallery.INSTANCE
+
+    def apply(self, op, uuid, user_id):
+        gallery = self._gallery()
+        if gallery is not None:
+            if op == "add":
+                if not np.any(gallery.uuids == uuid):  # 加载特征库时可能已包含
+                    vector = self.fetch(uuid, gallery.model_version)
+                    if vector is not None:
+                        gallery.add([uuid], [user_id], vector)
+            elif op == "remove":
+                gallery.remove([uuid])
+        for listener in self.listeners:
+            listener(op, uuid, user_id)
+
+    def fetch(self, uuid, model_version=None):
+        """
+        从数据库读取新增的特征
+        :param model_version: 不是该模型版本的特征不加载
+        :return: [dim] float32 或 None
+        """
+        from app.extensions import db
+        from app.models.models import Embedding
+
+        with self.app.app_context():
+            query = db.session.query(Embedding.embdBlob).filter(Embedding.uuid == uuid)
+            if model_version is not None:
+                query = query.filter(Embedding.modelVersion == model_version)
+            row = query.first()
+            db.session.remove()
+        if row is None or row[0] is None:
+            return None
+        return np.frombuffer(row[0], dtype=np.float32)
+
+    def reload(self):
+        self.reloads += 1
+        gallery = self._gallery()
+        if gallery is not None:
+            with self.app.app_context():
+                gallery.load_from_db()
+        for listener in self.listeners:
+            listener("reload", None, None)
+
+    @staticmethod
+    def notify(op, uuids, user_ids):
+        """
+        发布变更，未启用同步时忽略
+        """
+        if GallerySync.INSTANCE is not None:
+            try:
+                GallerySync.INSTANCE.publish(op, uuids, user_ids)
+            except Exception:
+                logger.exception("Gallery Sync Publish Failed")
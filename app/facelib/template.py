@@ -0,0 +1,193 @@
+"""
+template.py
+按用户聚合的模板检索：每个用户一个重新L2正则化的平均特征，先在模板上检索候选用户，
+距离接近阈值的候选再使用该用户的全部特征精确比对
+每个用户通常有2~4条特征，第一阶段的扫描量相应减少
+"""
+import logging
+import threading
+
+import numpy as np
+
+from app.facelib.distance import norm_distance, pairwise_distance, topk_smallest
+
+logger = logging.getLogger(__name__)
+
+
+class TemplateSearch:
+    """
+    与Gallery相同的检索接口，增删仍由Gallery处理，模板作为Gallery的观察者同步更新
+    新增特征时增量更新所属用户的模板，删除特征后在下一次检索前重建
+    """
+
+    def __init__(self, gallery, threshold, margin=0.1, candidates=4, capacity=1024):
+        """
+        :param gallery: app.facelib.gallery.Gallery
+        :param threshold: 模型阈值
+        :param margin: 模板距离在 threshold±margin 内的候选使用全部特征精确比对，
+                       小于 threshold-margin 直接接受，大于 threshold+margin 直接拒绝
+        :param candidates: 每个query取 k*candidates 个候选用户
+        :param capacity: 初始容量
+        """
+        self.gallery = gallery
+        self.threshold = threshold
+        self.margin = margin
+        self.candidates = candidates
+        self._capacity = capacity
+        self._lock = threading.Lock()
+        self._dirty = True
+        self._size = 0
+        self._rows = {}  # 用户编号 -> 行号
+        self._users = None  # [capacity] 用户编号
+        self._counts = None  # [capacity] 特征数
+        self._sums = None  # [capacity, dim] 特征之和
+        self._templates = None  # [capacity, dim] 正则化后的平均特征
+        self.stats = dict(queries=0, accepted=0, refined=0)
+        with gallery._lock:
+            gallery.observers.append(self)
+
+    def __getattr__(self, name):
+        # add/remove/metric等其余接口直接使用Gallery
+        if name == "gallery":
+            raise AttributeError(name)
+        return getattr(self.gallery, name)
+
+    def __len__(self):
+        return len(self.gallery)
+
+    # Gallery观察者接口，调用时已持有Gallery的锁
+    def add(self, uuids, user_ids, embeddings):
+        with self._lock:
+            if not self._dirty:
+                self._accumulate(np.asarray(user_ids, dtype=np.int64), np.asarray(embeddings, dtype=np.float32))
+
+    def remove(self, uuids):
+        with self._lock:
+            self._dirty = True
+
+    def reset(self):
+        with self._lock:
+            self._dirty = True
+
+    def _accumulate(self, user_ids, embeddings):
+        """
+        将特征累加到所属用户的模板
+        """
+        if len(user_ids) == 0:
+            return
+        order = np.argsort(user_ids, kind="stable")
+        users, begins = np.unique(user_ids[order], return_index=True)
+        sums = np.add.reduceat(embeddings[order], begins, axis=0)
+        counts = np.diff(np.append(begins, len(order)))
+
+        dim = embeddings.shape[1]
+        new_users = [user for user in users.tolist() if user not in self._rows]
+        size = self._size + len(new_users)
+        if self._sums is None or size > self._capacity or self._sums.shape[1] != dim:
+            capacity = self._capacity
+            while capacity < size:
+                capacity *= 2
+            for name, shape, dtype in (("_users", (capacity,), np.int64), ("_counts", (capacity,), np.int64),
+                                       ("_sums", (capacity, dim), np.float32),
+                                       ("_templates", (capacity, dim), np.float32)):
+                array = np.zeros(shape, dtype=dtype)
+                if getattr(self, name) is not None:
+                    array[:self._size] = getattr(self, name)[:self._size]
+                setattr(self, name, array)
+            self._capacity = capacity
+        for user in new_users:
+            self._rows[user] = self._size
+            self._users[self._size] = user
+            self._size += 1
+
+        rows = np.array([self._rows[user] for user in users.tolist()], dtype=np.int64)
+        self._sums[rows] += sums
+        self._counts[rows] += counts
+        norms = np.linalg.norm(self._sums[rows], axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        self._templates[rows] = self._sums[rows] / norms
+
+    def _rebuild(self):
+        """
+        删除特征后重新聚合，持有Gallery的锁以免遗漏重建期间的新增
+        """
+        with self.gallery._lock, self._lock:
+            if not self._dirty:
+                return
+            state = self.gallery._view()
+            embeddings = state["embeddings"]
+            if self.gallery.quantized:
+                from .quantize import dequantize
+                embeddings = dequantize(embeddings, state["scales"])
+            self._size = 0
+            self._rows = {}
+            self._sums = None
+            self._accumulate(state["user_ids"], embeddings)
+            self._dirty = False
+            logger.info(f"User Templates Built: {self._size} users, {len(state['uuids'])} embeddings")
+
+    def _state(self):
+        if self._dirty:
+            self._rebuild()
+        with self._lock:
+            size = self._size
+            if self._templates is None:
+                return np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32)
+            return self._users[:size], self._templates[:size]
+
+    def search_batch(self, queries, k=1):
+        """
+        :param queries: [m, dim]
+        :param k:
+        :return: uuids, user_ids, distances 均为[m, k]，每行按距离升序，每个用户最多一条；
+                 由模板直接接受的候选特征编号为-1，候选不足k个时编号为-1，距离为inf
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = np.expand_dims(queries, axis=0)
+        users, templates = self._state()
+        m = queries.shape[0]
+        found_uuids = np.full((m, k), -1, dtype=np.int64)
+        found_users = np.full((m, k), -1, dtype=np.int64)
+        found_dists = np.full((m, k), np.inf, dtype=np.float32)
+        if len(users) <= 0:
+            return found_uuids, found_users, found_dists
+
+        # 模板已正则化，模长平方为1
+        dist = norm_distance(queries, templates, np.ones(len(users), dtype=np.float32), self.gallery.metric)
+        top = topk_smallest(dist, min(k * self.candidates, dist.shape[1]))
+        low, high = self.threshold - self.margin, self.threshold + self.margin
+        for i in range(m):
+            row = []
+            for col in top[i]:
+                user, d = int(users[col]), float(dist[i, col])
+                uuid = -1
+                if low <= d <= high:  # 接近阈值，与该用户的全部特征比对
+                    user_uuids, embeddings = self.gallery.user_embeddings(user)
+                    valid = ~np.isnan(embeddings).any(axis=1)
+                    if np.any(valid):
+                        exact = pairwise_distance(queries[i:i + 1], embeddings[valid], self.gallery.metric)[0]
+                        best = int(np.argmin(exact))
+                        uuid, d = int(user_uuids[valid][best]), float(exact[best])
+                    self.stats["refined"] += 1
+                elif d < low:
+                    self.stats["accepted"] += 1
+                row.append((d, uuid, user))
+            row.sort()
+            for j, (d, uuid, user) in enumerate(row[:k]):
+                found_uuids[i, j], found_users[i, j], found_dists[i, j] = uuid, user, d
+        self.stats["queries"] += m
+        return found_uuids, found_users, found_dists
+
+    def search(self, query, k=1):
+        query = np.asarray(query, dtype=np.float32).reshape(1, -1)
+        uuids, user_ids, dists = self.search_batch(query, k)
+        return uuids[0], user_ids[0], dists[0]
+
+    def detach(self):
+        """
+        不再跟随Gallery更新
+        """
+        with self.gallery._lock:
+            if self in self.gallery.observers:
+                self.gallery.observers.remove(self)
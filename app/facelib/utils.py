@@ -23,3 +23,30 @@ def resize_image(img: np.ndarray, new_shape, padding=True):
     pad_h = (new_shape[0] - new_h) // 2
     border[pad_h:pad_h + new_h, pad_w:pad_w + new_w, :] = img
     return border
+
+
+def letterbox_into(img: np.ndarray, out: np.ndarray, fill=128):
+    """
+    等比例缩放并居中填充，直接写入预分配的缓冲区
+    :param img: [h, w, 3] uint8
+    :param out: [new_h, new_w, 3] 通常为float32缓冲区的一个切片
+    :param fill: 填充值
+    :return: out
+    """
+    new_h, new_w = out.shape[:2]
+    h, w = img.shape[:2]
+    if (h, w) == (new_h, new_w):
+        out[...] = img
+        return out
+    scale = min(new_w / w, new_h / h)
+    resized_w = int(w * scale)
+    resized_h = int(h * scale)
+    pad_w = (new_w - resized_w) // 2
+    pad_h = (new_h - resized_h) // 2
+    # 只填充边框部分
+    out[:pad_h] = fill
+    out[pad_h + resized_h:] = fill
+    out[pad_h:pad_h + resized_h, :pad_w] = fill
+    out[pad_h:pad_h + resized_h, pad_w + resized_w:] = fill
+    out[pad_h:pad_h + resized_h, pad_w:pad_w + resized_w] = cv2.resize(img, (resized_w, resized_h))
+    return out
@@ -5,6 +5,7 @@ monkey.patch_all()
 
 import os
 import sys
+import time
 
 
 def main():
@@ -15,13 +16,26 @@ def main():
     workspace = os.path.abspath(os.path.join(workspace, ".."))
     sys.path.append(workspace)
 
-    from app.config import AppConfig
-    from app import create_app, ensure_mysql, ensure_redis, init_env
+    phases = []  # 启动各阶段耗时
+
+    def phase(name, func, *args):
+        begin = time.perf_counter()
+        result = func(*args)
+        phases.append((name, time.perf_counter() - begin))
+        return result
 
-    application = create_app()
-    ensure_mysql()
-    ensure_redis()
-    init_env(application)
+    begin = time.perf_counter()
+    from app.config import AppConfig
+    from app import create_app, ensure_mysql, ensure_redis, init_env, init_gallery, init_model, startup_report
+    phases.append(("import", time.perf_counter() - begin))
+
+    application = phase("create_app", create_app)
+    phase("ensure_mysql", ensure_mysql)
+    phase("ensure_redis", ensure_redis)
+    phase("init_env", init_env, application)
+    phase("init_gallery", init_gallery, application)
+    phase("init_model", init_model)
+    startup_report(phases)
     # application.run()
     server = WSGIServer((AppConfig.HOST, AppConfig.PORT), application=application)
     server.serve_forever()
@@ -0,0 +1,118 @@
+"""
+migrate.py
+数据库迁移
+python -m app.models.migrate
+"""
+import os
+import sys
+
+project_path = os.path.join(os.path.dirname(__file__), os.path.pardir, os.path.pardir)
+sys.path.append(project_path)
+
+import time
+import base64
+import logging
+
+from sqlalchemy import inspect, text
+
+from app.extensions import db
+
+logger = logging.getLogger(__name__)
+
+
+def migrate_embedding_blob(chunk_size=1000):
+    """
+    将Embeddings.embdBytes(base64 Text)转换为embdBlob(LargeBinary)，分批提交，可以重复执行
+    需要在app_context中调用
+    :param chunk_size: 每次事务转换的行数
+    :return: 转换的行数
+    """
+    columns = {column["name"]: column for column in inspect(db.engine).get_columns("Embeddings")}
+    if "embdBlob" not in columns:
+        db.session.execute(text("ALTER TABLE Embeddings ADD COLUMN embdBlob BLOB NULL COMMENT '特征值 float32'"))
+        db.session.commit()
+        logger.info("Embeddings.embdBlob Added")
+    if not columns["embdBytes"]["nullable"]:  # 新数据只写入embdBlob
+        db.session.execute(text("ALTER TABLE Embeddings MODIFY embdBytes TEXT NULL"))
+        db.session.commit()
+
+    total = 0
+    last_uuid = 0
+    select = text("SELECT uuid, embdBytes FROM Embeddings "
+                  "WHERE embdBlob IS NULL AND embdBytes IS NOT NULL AND uuid > :uuid "
+                  "ORDER BY uuid LIMIT :limit")
+    update = text("UPDATE Embeddings SET embdBlob = :blob WHERE uuid = :uuid")
+    while True:
+        rows = db.session.execute(select, {"uuid": last_uuid, "limit": chunk_size}).fetchall()
+        if not rows:
+            break
+        params = [{"uuid": uuid, "blob": base64.b64decode(embd.encode("utf-8"))} for uuid, embd in rows]
+        db.session.execute(update, params)
+        db.session.commit()
+        last_uuid = rows[-1][0]
+        total += len(rows)
+        logger.info(f"Embeddings Migrated: {total}")
+    db.session.remove()
+    return total
+
+
+def count_unversioned():
+    """
+    没有模型版本的旧特征数，需要在app_context中调用
+    特征库只加载当前模型版本的特征，旧特征未标记时启动后特征库为空
+    :return: 行数，未添加modelVersion列时为全部行数
+    """
+    columns = {column["name"] for column in inspect(db.engine).get_columns("Embeddings")}
+    if "modelVersion" not in columns:
+        return db.session.execute(text("SELECT COUNT(*) FROM Embeddings")).scalar()
+    return db.session.execute(text("SELECT COUNT(*) FROM Embeddings WHERE modelVersion IS NULL")).scalar()
+
+
+def migrate_model_version(model_version, chunk_size=10000):
+    """
+    添加Embeddings.modelVersion，并将没有版本的旧特征标记为model_version，分批提交，可以重复执行
+    需要在app_context中调用
+    :param model_version: 旧特征所使用模型的指纹，通常为当前启用的模型
+    :param chunk_size: 每次事务更新的行数
+    :return: 标记的行数
+    """
+    columns = {column["name"] for column in inspect(db.engine).get_columns("Embeddings")}
+    if "modelVersion" not in columns:
+        db.session.execute(text("ALTER TABLE Embeddings ADD COLUMN modelVersion VARCHAR(32) NULL COMMENT '模型版本'"))
+        db.session.execute(text("CREATE INDEX ix_Embeddings_modelVersion ON Embeddings (modelVersion)"))
+        db.session.commit()
+        logger.info("Embeddings.modelVersion Added")
+
+    total = 0
+    update = text("UPDATE Embeddings SET modelVersion = :version WHERE modelVersion IS NULL LIMIT :limit")
+    while True:
+        count = db.session.execute(update, {"version": model_version, "limit": chunk_size}).rowcount
+        db.session.commit()
+        if count <= 0:
+            break
+        total += count
+        logger.info(f"Embeddings Tagged: {total}")
+    db.session.remove()
+    return total
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from app import create_app
+    from app.facelib.face_recogni import FaceRecogni
+
+    parser = argparse.ArgumentParser(description="将base64特征转换为二进制BLOB，为旧特征标记模型版本")
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--model-version", default=None, help="旧特征的模型指纹，默认为当前启用的模型")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    model_version = args.model_version or FaceRecogni.fingerprint(FaceRecogni.load_config())
+    application = create_app()
+    begin = time.time()
+    with application.app_context():
+        nums = migrate_embedding_blob(chunk_size=args.chunk_size)
+        tagged = migrate_model_version(model_version, chunk_size=args.chunk_size * 10)
+    logger.info(f"{nums} embeddings migrated, {tagged} tagged as {model_version}, "
+                f"time used: {time.time() - begin:3.3f}s")
@@ -2,7 +2,10 @@
 数据库模型
 """
 import json
+import base64
 from datetime import datetime
+
+import numpy as np
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 
@@ -95,12 +98,28 @@ class Embedding(db.Model):
     uuid = db.Column(db.Integer, primary_key=True, autoincrement=True, comment='特征编号')
     userId = db.Column(db.Integer, db.ForeignKey("Users.uuid"), nullable=False, comment='用户编号')
     createTime = db.Column(db.DateTime, default=datetime.now, comment='创建时间')
-    embdBytes = db.Column(db.Text, nullable=False, comment='特征值')
+    embdBytes = db.Column(db.Text, nullable=True, comment='特征值 base64(已弃用，由embdBlob代替)')
+    embdBlob = db.Column(db.LargeBinary, nullable=True, comment='特征值 float32')
     base64Img = db.Column(db.Text, nullable=False, comment='人脸图片')
+    modelVersion = db.Column(db.String(32), nullable=True, index=True, comment='模型版本')
 
     def __repr__(self):
         return f"Embedding(id:{self.uuid})"
 
+    def get_embedding(self) -> np.ndarray:
+        """
+        特征向量 float32
+        :return:
+        """
+        return np.frombuffer(self.embdBlob, dtype=np.float32)
+
+    def get_base64(self) -> str:
+        """
+        特征向量的base64编码，只在接口返回时使用
+        :return:
+        """
+        return base64.b64encode(self.embdBlob).decode("utf-8")
+
 
 # 中间表
 class ExamList(db.Model):
@@ -1,4 +1,4 @@
-__all__ = ["random_str", "parse_request", "encrypt_response", "base64_to_image", "parse_df"]
+__all__ = ["random_str", "parse_request", "encrypt_response", "base64_to_image", "base64_to_array", "parse_df"]
 
 from app.config import BaseConfig
 
@@ -6,10 +6,14 @@ import json
 import base64
 import traceback
 from PIL import Image
+import numpy as np
 from random import sample
 
 import io
-import pandas as pd
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 
 def random_str(size=32):
@@ -115,7 +119,29 @@ def base64_to_image(b64_str, size, mode="RGBA"):
     return False, "图片转换失败"
 
 
-def parse_df(filename: str, file_data: bytes, try_convert=False) -> pd.DataFrame:
+def base64_to_array(b64_str, size, mode="RGBA"):
+    """
+    从base64获取RGB图片数组，直接引用解码后的字节，不经过PIL
+    :param b64_str:
+    :param size: (w, h)
+    :param mode:
+    :return: ret, np.ndarray [h, w, 3] uint8 只读
+    """
+    accept_type = ("RGBA", "RGB")
+    if b64_str is None or b64_str == "":
+        return False, "图片为空"
+    if mode is None or mode == "" or mode not in accept_type:
+        return False, "错误的图片格式"
+    im_raw = base64.b64decode(b64_str)
+    w, h = size
+    channels = len(mode)
+    if len(im_raw) < w * h * channels:
+        return False, "图片转换失败"
+    im0 = np.frombuffer(im_raw, dtype=np.uint8, count=w * h * channels).reshape((h, w, channels))
+    return True, im0[:, :, :3]
+
+
+def parse_df(filename: str, file_data: bytes, try_convert=False) -> "pd.DataFrame":
     """
     从字节流中将csv/xlsx解析成pandas.DataFrame
     :param filename: str
@@ -123,6 +149,7 @@ def parse_df(filename: str, file_data: bytes, try_convert=False) -> pd.DataFrame
     :param try_convert: 尝试编码转换
     :return: pd.DataFrame
     """
+    import pandas as pd  # 只在导入名单时使用，不在启动时导入
     df = None
 
     if try_convert:  # 尝试转换编码
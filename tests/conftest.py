@@ -0,0 +1,65 @@
+"""
+测试使用sqlite数据库代替MySQL，不连接Redis
+python -m pytest -q tests
+"""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.path.pardir))
+
+import numpy as np
+import pytest
+
+from app.config import BaseConfig
+
+# 管理界面在导入app.extensions时检查上传目录
+BaseConfig.UPLOAD_FILES = tempfile.mkdtemp()
+
+
+@pytest.fixture
+def application(tmp_path, monkeypatch):
+    from app import create_app
+    from app.config import AppConfig
+    from app.extensions import db
+
+    monkeypatch.setattr(AppConfig, "SQLALCHEMY_DATABASE_URI", f"sqlite:///{tmp_path / 'test.db'}")
+    monkeypatch.setattr(BaseConfig, "GALLERY_SYNC", False)
+    application = create_app()
+    with application.app_context():
+        db.create_all()
+    yield application
+    with application.app_context():
+        db.session.remove()
+        db.drop_all()
+
+
+def write_model_config(root, version=1, dim=8, metric="l2", threshold=1.0):
+    """
+    写入模型配置 config.yaml，不包含模型文件，只用于prepare()
+    """
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, "config.yaml"), "w", encoding="utf-8") as f:
+        f.write(f"name: model\nversion: {version}\nformat: onnx\ninput_shape: [112, 112, 3]\n"
+                f"output_shape: [null, {dim}]\nmean: [0.5, 0.5, 0.5]\nstd: [0.5, 0.5, 0.5]\n"
+                f"metric: {metric}\nthreshold: {threshold}\n")
+    return root
+
+
+def add_embeddings(users, dim=8, model_version=None, seed=0):
+    """
+    写入随机特征，需要在app_context中调用
+    :param users: [用户编号]，每个元素一条特征
+    :return: uuids, embeddings [n,dim] L2正则化
+    """
+    from app.extensions import db
+    from app.models.models import Embedding
+
+    rng = np.random.default_rng(seed)
+    embeddings = rng.standard_normal((len(users), dim)).astype(np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    rows = [Embedding(userId=user_id, embdBlob=embedding.tobytes(), base64Img="", modelVersion=model_version)
+            for user_id, embedding in zip(users, embeddings)]
+    db.session.add_all(rows)
+    db.session.commit()
+    return np.array([row.uuid for row in rows], dtype=np.int64), embeddings
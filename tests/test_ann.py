@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+
+from app.facelib.ann import IVFIndex
+from app.facelib.distance import l2_normalize
+from app.facelib.gallery import Gallery
+from app.facelib.quantize import ArrayVectors
+
+
+def make_gallery(n=400, dim=16, dtype="float32", seed=0):
+    embeddings = l2_normalize(np.random.default_rng(seed).standard_normal((n, dim)))
+    uuids = np.arange(1, n + 1)
+    gallery = Gallery(dtype=dtype)
+    gallery.add(uuids, uuids % 37, embeddings)
+    if gallery.quantized:
+        gallery.rerank_source = ArrayVectors(uuids, embeddings)
+    return gallery, embeddings
+
+
+def exact(embeddings, uuids, queries, k):
+    dist = np.linalg.norm(queries[:, None] - embeddings[None], axis=2)
+    top = np.argsort(dist, axis=1)[:, :k]
+    return uuids[top], np.take_along_axis(dist, top, axis=1)
+
+
+def test_full_probe_matches_exact_after_changes():
+    gallery, embeddings = make_gallery()
+    index = IVFIndex(nlist=8, nprobe=8).build(gallery.embeddings)
+    gallery.set_index(index)
+    assert all(rows.dtype == np.int64 for rows in index.lists())
+
+    # 删除后各桶的行号随特征库前移
+    gallery.remove(np.arange(1, 401, 3))
+    extra = l2_normalize(np.random.default_rng(1).standard_normal((20, 16)))
+    gallery.add(np.arange(1000, 1020), np.zeros(20), extra)
+    assert len(index) == len(gallery)
+
+    queries = l2_normalize(np.random.default_rng(2).standard_normal((10, 16)))
+    uuids, _, dists = gallery.search_batch(queries, k=5)
+    expected_uuids, expected_dists = exact(gallery.embeddings, gallery.uuids, queries, 5)
+    np.testing.assert_array_equal(uuids, expected_uuids)
+    np.testing.assert_allclose(dists, expected_dists, atol=1e-5)
+
+
+@pytest.mark.parametrize("dtype", ["float16", "int8"])
+def test_quantized_candidates_are_reranked(dtype):
+    gallery, embeddings = make_gallery(dtype=dtype)
+    gallery.set_index(IVFIndex(nlist=8, nprobe=8).build(gallery.embeddings))
+    queries = embeddings[:10] + 0.01
+    uuids, _, dists = gallery.search_batch(queries, k=3)
+    # 返回的是float32特征的精确距离，而不是压缩特征的近似距离
+    expected_uuids, expected_dists = exact(embeddings, np.arange(1, 401), queries, 3)
+    np.testing.assert_array_equal(uuids, expected_uuids)
+    np.testing.assert_allclose(dists, expected_dists, atol=1e-5)
+
+
+def test_padded_candidates():
+    gallery, _ = make_gallery(n=5, dtype="int8")
+    gallery.set_index(IVFIndex(nlist=1).build(gallery.embeddings))
+    uuids, user_ids, dists = gallery.search_batch(np.ones((1, 16), dtype=np.float32), k=8)
+    assert np.all(uuids[0, 5:] == -1) and np.all(user_ids[0, 5:] == -1) and np.all(np.isinf(dists[0, 5:]))
+    assert sorted(uuids[0, :5].tolist()) == [1, 2, 3, 4, 5]
+
+
+def test_saved_index_maps_uuids_to_rows(tmp_path):
+    path = str(tmp_path / "ivf.npz")
+    gallery, embeddings = make_gallery()
+    index = IVFIndex(nlist=8, nprobe=8).build(gallery.embeddings)
+    index.save(path, gallery.uuids)
+
+    # 保存之后删除了一部分、新增了一部分特征
+    reloaded, _ = make_gallery()
+    reloaded.remove(np.arange(1, 50))
+    extra = l2_normalize(np.random.default_rng(3).standard_normal((10, 16)))
+    reloaded.add(np.arange(1000, 1010), np.zeros(10), extra)
+    loaded = IVFIndex.from_gallery(reloaded, path=path, nprobe=8)
+    reloaded.set_index(loaded)
+    assert len(loaded) == len(reloaded)
+
+    uuids, _, _ = reloaded.search_batch(np.vstack([embeddings[100], extra[4]]), k=1)
+    assert uuids[:, 0].tolist() == [101, 1004]
+    with pytest.raises(ValueError):
+        Gallery().set_index(loaded)
+
+
+def test_chunked_assignment_matches_full():
+    from app.facelib.ann import nearest_centroid
+    from app.facelib.distance import pairwise_distance
+
+    rng = np.random.default_rng(3)
+    data = rng.standard_normal((1000, 16)).astype(np.float32)
+    centroids = rng.standard_normal((37, 16)).astype(np.float32)
+    expected = np.argmin(pairwise_distance(data, centroids), axis=1)
+    # 每块 10 行
+    np.testing.assert_array_equal(nearest_centroid(data, centroids, max_elements=370), expected)
+    np.testing.assert_array_equal(nearest_centroid(data, centroids, max_elements=1), expected)
@@ -0,0 +1,71 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+import numpy as np
+import pytest
+
+ROOT = os.path.join(os.path.dirname(__file__), os.path.pardir)
+
+# monkey patch只能在新进程中启用
+GEVENT_RELOAD = textwrap.dedent("""
+    from gevent import monkey
+    monkey.patch_all()
+    import sys
+    sys.path.insert(0, sys.argv[1])
+    import gevent
+    import numpy as np
+    from app.facelib.executor import Executor
+    from app.facelib.face_recogni import FaceRecogni
+
+    recogni = FaceRecogni()
+    recogni.forward = lambda faces: faces.reshape(len(faces), -1).sum(axis=1, keepdims=True)
+    # 与热切换相同，在后台原生线程中启用微批处理
+    Executor.get_instance("background").run(recogni.enable_batching, 4, 5.0)
+
+    def predict(i):
+        return recogni.batcher.submit(np.full((1, 2, 2, 3), i, dtype=np.float32))[0, 0]
+
+    with gevent.Timeout(5):
+        results = [job.get() for job in [gevent.spawn(predict, i) for i in range(8)]]
+    assert results == [12.0 * i for i in range(8)], results
+    assert recogni.batcher.batches < 8
+    # 后台线程(重新编码)中直接计算，停止也不会阻塞
+    with gevent.Timeout(5):
+        assert Executor.get_instance("background").run(predict, 2) == 24.0
+        Executor.get_instance("background").run(recogni.batcher.stop)
+        gevent.sleep(0.1)
+    assert not recogni.batcher._thread.is_alive()
+    print("ok")
+""")
+
+
+def test_batcher_created_in_native_thread_serves_main_hub():
+    pytest.importorskip("gevent")
+    result = subprocess.run([sys.executable, "-c", GEVENT_RELOAD, ROOT], capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr[-2000:]
+    assert result.stdout.strip().endswith("ok")
+
+
+def test_batcher_merges_concurrent_requests():
+    import threading
+    from app.facelib.batcher import InferenceBatcher
+
+    calls = []
+
+    def forward(inputs):
+        calls.append(len(inputs))
+        return inputs.reshape(len(inputs), -1).sum(axis=1, keepdims=True)
+
+    batcher = InferenceBatcher(forward, max_batch=8, max_wait_ms=50)
+    results = {}
+    threads = [threading.Thread(target=lambda i=i: results.update({i: batcher.submit(np.full((1, 3), i))[0, 0]}))
+               for i in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    batcher.stop()
+    assert results == {i: 3.0 * i for i in range(6)}
+    assert sum(calls) == 6 and len(calls) < 6
@@ -0,0 +1,93 @@
+import threading
+
+import numpy as np
+import pytest
+
+from app.facelib.convert import parity_report
+
+
+def inputs(n=12, size=16):
+    return np.random.default_rng(0).random((n, size, size, 3), dtype=np.float32)
+
+
+@pytest.fixture(scope="module")
+def keras_model(tmp_path_factory):
+    tf = pytest.importorskip("tensorflow")
+    tf.keras.utils.set_random_seed(0)
+    model = tf.keras.Sequential([
+        tf.keras.layers.Input((16, 16, 3)),
+        tf.keras.layers.Conv2D(4, 3, activation="relu"),
+        tf.keras.layers.GlobalAveragePooling2D(),
+        tf.keras.layers.Dense(8),
+    ])
+    path = str(tmp_path_factory.mktemp("model") / "model.h5")
+    model.save(path)
+    return path
+
+
+def test_parity_report_detects_drift():
+    projection = np.random.default_rng(1).standard_normal((16 * 16 * 3, 8)).astype(np.float32)
+
+    def reference(batch):
+        return batch.reshape(len(batch), -1) @ projection
+
+    faces = inputs()
+    same = parity_report(reference, reference, faces, threshold=1.0, batch_size=5)
+    assert same["n"] == len(faces) and same["max_abs_diff"] == 0.0
+    assert same["min_cosine"] == pytest.approx(1.0) and same["decision_agreement"] == 1.0
+
+    noise = np.random.default_rng(2).standard_normal((len(faces), 8)).astype(np.float32)
+    drifted = parity_report(reference, lambda batch: reference(batch) + noise[:len(batch)] * 10, faces,
+                            threshold=1.0, batch_size=len(faces))
+    assert drifted["min_cosine"] < 0.99 and drifted["max_dist_diff"] > 0
+
+
+def test_tflite_parity(keras_model, tmp_path):
+    from app.facelib.backends import KerasBackend, TFLiteBackend
+    from app.facelib.convert import convert_tflite
+
+    output = str(tmp_path / "model.tflite")
+    convert_tflite(keras_model, output)
+    report = parity_report(KerasBackend(keras_model), TFLiteBackend(output), inputs(), threshold=1.0, batch_size=5)
+    assert report["min_cosine"] >= 1.0 - 1e-3 and report["decision_agreement"] == 1.0
+
+
+def test_tflite_concurrent_batches(keras_model, tmp_path):
+    from app.facelib.backends import TFLiteBackend
+    from app.facelib.convert import convert_tflite
+
+    output = str(tmp_path / "model.tflite")
+    convert_tflite(keras_model, output)
+    backend = TFLiteBackend(output)
+    faces = inputs(24)
+    expected = np.vstack([backend(faces[i:i + 1]) for i in range(len(faces))])
+    # 多个推理线程共用一个解释器，批大小不同时交替重新分配张量
+    results, errors = {}, []
+
+    def run(begin, size):
+        try:
+            for _ in range(30):
+                results[begin] = backend(faces[begin:begin + size])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(begin, size)) for begin, size in [(0, 1), (4, 3), (8, 8), (16, 5)]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    for begin, output in results.items():
+        np.testing.assert_allclose(output, expected[begin:begin + len(output)], atol=1e-5)
+
+
+def test_onnx_parity(keras_model, tmp_path):
+    pytest.importorskip("tf2onnx")
+    pytest.importorskip("onnxruntime")
+    from app.facelib.backends import KerasBackend, ONNXBackend
+    from app.facelib.convert import convert_onnx
+
+    output = str(tmp_path / "model.onnx")
+    convert_onnx(keras_model, output, [16, 16, 3])
+    report = parity_report(KerasBackend(keras_model), ONNXBackend(output), inputs(), threshold=1.0, batch_size=5)
+    assert report["min_cosine"] >= 1.0 - 1e-3 and report["decision_agreement"] == 1.0
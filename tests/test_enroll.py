@@ -0,0 +1,75 @@
+import os
+
+import numpy as np
+import pytest
+
+
+class FakePipeline:
+    """
+    每张图片检测到一个人脸，以像素均值作为特征
+    """
+
+    def __init__(self):
+        from types import SimpleNamespace
+        self.recogni = SimpleNamespace(model_version="v1")
+
+    def run(self, images):
+        from app.facelib.pipeline import PipelineResult
+        embeddings = np.stack([np.resize(image.mean(axis=(0, 1)), 8) for image in images]).astype(np.float32)
+        return PipelineResult(embeddings, np.arange(len(images)), [image[:16, :16] for image in images], {})
+
+
+class Crash(Exception):
+    pass
+
+
+def test_resume_after_crash_between_commit_and_checkpoint(application, tmp_path, monkeypatch):
+    from app.extensions import db
+    from app.facelib.enroll import BulkEnroller, Checkpoint
+    from app.models.models import Embedding, User
+
+    rng = np.random.default_rng(0)
+    images = {f"{user}/{i}.jpg": rng.integers(0, 256, (32, 32, 3), dtype=np.uint8)
+              for user in ("s1", "s2") for i in range(3)}
+    entries = [(name, name.split("/")[0]) for name in sorted(images)]
+    paths = {os.path.join(str(tmp_path), name): image for name, image in images.items()}
+    monkeypatch.setattr("app.facelib.enroll.read_image", paths.get)
+    with application.app_context():
+        users = [User(userId=user_id, name=user_id, passwd="x", department="d") for user_id in ("s1", "s2")]
+        db.session.add_all(users)
+        db.session.commit()
+        users = {user.userId: user.uuid for user in users}
+
+        # 第二个事务提交后、写入ok之前中断
+        path = str(tmp_path / "enroll.checkpoint")
+        record = Checkpoint.record
+        crash = dict(ok=1)
+
+        def crashing(self, items):
+            if items and items[0][1] == "ok":
+                crash["ok"] -= 1
+                if crash["ok"] < 0:
+                    raise Crash()
+            return record(self, items)
+
+        monkeypatch.setattr(Checkpoint, "record", crashing)
+        enroller = BulkEnroller(FakePipeline(), Checkpoint(path), batch_size=2, chunk_size=2, workers=1)
+        with pytest.raises(Crash):
+            enroller.run(str(tmp_path), entries, users)
+        enroller.close()
+        assert Embedding.query.count() == 4
+        monkeypatch.setattr(Checkpoint, "record", record)
+
+        # 使用相同参数重新运行
+        checkpoint = Checkpoint(path)
+        assert len(checkpoint.done) == 2 and len(checkpoint.pending) == 2
+        enroller = BulkEnroller(FakePipeline(), checkpoint, batch_size=2, chunk_size=2, workers=1)
+        assert enroller.discard_uncommitted() == 2
+        todo = [entry for entry in entries if entry[0] not in checkpoint.done]
+        assert enroller.run(str(tmp_path), todo, users) == 4
+        enroller.close()
+
+        rows = Embedding.query.all()
+        assert len(rows) == len(images)
+        assert sorted(row.userId for row in rows) == sorted([users["s1"]] * 3 + [users["s2"]] * 3)
+    assert not Checkpoint(path).pending and set(Checkpoint(path).done) == set(images)
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from conftest import add_embeddings
+
+
+@pytest.fixture
+def native_search():
+    """
+    使用原生线程池执行检索，与monkey patch后的服务一致
+    """
+    threadpool = pytest.importorskip("gevent.threadpool")
+    from app.facelib.executor import Executor
+
+    executor = Executor("search", 2)
+    executor._pool = threadpool.ThreadPool(2)
+    previous = Executor.INSTANCES.get("search")
+    Executor.INSTANCES["search"] = executor
+    yield executor
+    executor.close()
+    if previous is None:
+        Executor.INSTANCES.pop("search", None)
+    else:
+        Executor.INSTANCES["search"] = previous
+
+
+@pytest.mark.parametrize("dtype", ["float16", "int8"])
+def test_quantized_search_in_native_thread(application, native_search, dtype):
+    from app.facelib.executor import run_search
+    from app.facelib.gallery import Gallery
+
+    with application.app_context():
+        uuids, embeddings = add_embeddings([1, 1, 2, 2, 3], model_version="v1")
+        gallery = Gallery(metric="l2", dtype=dtype, rerank=2, model_version="v1").load_from_db()
+        # 重排时从数据库读取float32特征，需要执行线程中的应用上下文
+        found_uuids, found_users, dists = run_search(gallery.search_batch, embeddings, k=1)
+
+    np.testing.assert_array_equal(found_uuids[:, 0], uuids)
+    np.testing.assert_allclose(dists[:, 0], 0.0, atol=1e-3)
+
+
+def test_snapshot_rerank_falls_back_for_new_embeddings(application, native_search):
+    from app.facelib.executor import run_search
+    from app.facelib.gallery import Gallery
+    from app.facelib.quantize import ArrayVectors
+
+    with application.app_context():
+        old_uuids, old_embeddings = add_embeddings([1, 2], model_version="v1", seed=1)
+        new_uuids, new_embeddings = add_embeddings([3], model_version="v1", seed=2)
+        gallery = Gallery(metric="l2", dtype="int8", rerank=2, model_version="v1",
+                          rerank_source=ArrayVectors(old_uuids, old_embeddings))
+        gallery.add(np.concatenate([old_uuids, new_uuids]), [1, 2, 3], np.vstack([old_embeddings, new_embeddings]))
+        found_uuids, _, dists = run_search(gallery.search, new_embeddings[0], k=1)
+
+    assert found_uuids[0] == new_uuids[0]
+    assert dists[0] == pytest.approx(0.0, abs=1e-3)
@@ -0,0 +1,41 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from app.facelib.face_landmark import LandmarkDetector
+
+
+class FakeLandmarkList:
+    def __init__(self, points):
+        self.landmark = [SimpleNamespace(x=float(x), y=float(y), z=float(z)) for x, y, z in points]
+
+
+def test_parse_pixel_coordinates_and_boxes():
+    faces = [FakeLandmarkList([(0.25, 0.5, 0.0), (0.75, 0.25, -0.1), (0.5, 1.0, 0.1)])]
+    landmarks, boxes = LandmarkDetector._parse(np.zeros((100, 200, 3), dtype=np.uint8),
+                                               SimpleNamespace(multi_face_landmarks=faces))
+    np.testing.assert_allclose(landmarks[0, :, :2], [[50, 50], [150, 25], [100, 100]])
+    np.testing.assert_allclose(boxes, [[50, 25, 150, 100]])
+    empty, _ = LandmarkDetector._parse(np.zeros((10, 10, 3)), SimpleNamespace(multi_face_landmarks=None))
+    assert empty.shape == (0, 478, 3)
+
+
+def test_parse_mediapipe_landmarks():
+    landmark_pb2 = pytest.importorskip("mediapipe.framework.formats.landmark_pb2")
+    rng = np.random.default_rng(1)
+    faces = []
+    for _ in range(2):
+        face = landmark_pb2.NormalizedLandmarkList()
+        for x, y, z in rng.random((478, 3)):
+            point = face.landmark.add()
+            point.x, point.y, point.z = x, y, z
+        faces.append(face)
+    faces[0].landmark[3].visibility = 0.5
+    landmarks, boxes = LandmarkDetector._parse(np.zeros((100, 200, 3), dtype=np.uint8),
+                                               SimpleNamespace(multi_face_landmarks=faces))
+    expected = np.array([[(p.x, p.y, p.z) for p in face.landmark] for face in faces], dtype=np.float32)
+    expected[..., :2] *= np.array([200, 100], dtype=np.float32)
+    assert landmarks.shape == (2, 478, 3) and landmarks.dtype == np.float32
+    np.testing.assert_allclose(landmarks, expected, rtol=1e-6)
+    np.testing.assert_allclose(boxes[:, :2], expected[..., :2].min(axis=1))
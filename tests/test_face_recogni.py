@@ -0,0 +1,33 @@
+import os
+
+from conftest import write_model_config
+
+
+def test_fingerprint_follows_weights(tmp_path):
+    from app.facelib.face_recogni import FaceRecogni
+
+    root = write_model_config(str(tmp_path / "A"))
+    config = FaceRecogni.load_config(root)
+    weights = os.path.join(root, config["name"])
+    with open(weights, "wb") as f:
+        f.write(b"weights-a")
+    before = FaceRecogni.fingerprint(config, root)
+    assert FaceRecogni.fingerprint(config, root) == before
+
+    # 替换权重而不修改配置
+    with open(weights, "wb") as f:
+        f.write(b"weights-b")
+    os.utime(weights, ns=(0, 0))
+    swapped = FaceRecogni.fingerprint(config, root)
+    assert swapped != before
+
+    # 预处理变化
+    assert FaceRecogni.fingerprint(dict(config, mean=[0.0, 0.0, 0.0]), root) != swapped
+    # SavedModel 目录
+    os.remove(weights)
+    os.makedirs(os.path.join(weights, "variables"))
+    with open(os.path.join(weights, "variables", "data"), "wb") as f:
+        f.write(b"weights-b")
+    assert FaceRecogni.fingerprint(config, root) not in (before, swapped)
+    # 转换后端时显式指定转换前的指纹
+    assert FaceRecogni.fingerprint(dict(config, model_version=before), root) == before
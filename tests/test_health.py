@@ -0,0 +1,46 @@
+class FakeFaceMesh:
+    def __init__(self, **options):
+        self.options = options
+
+    def close(self):
+        pass
+
+
+class FakeRecogni:
+    ready = False
+    warm_up_stats = {}
+
+    def preload(self):
+        self.ready = True
+
+
+def get_ready(application):
+    # 会话保存在Redis中，直接调用视图函数
+    from app.api.health import ready
+    with application.test_request_context("/ready"):
+        resp, _ = ready()
+        return resp.get_json()
+
+
+def test_init_model_prewarms_face_mesh(application, monkeypatch):
+    from types import SimpleNamespace
+    from app import init_model
+    from app.config import BaseConfig
+    from app.facelib import face_landmark
+    from app.facelib.face_landmark import LandmarkDetector
+    from app.facelib.face_recogni import FaceRecogni
+
+    recogni = FakeRecogni()
+    monkeypatch.setattr(BaseConfig, "USE_FACE_RECOGNI", True)
+    monkeypatch.setattr(BaseConfig, "FACE_ALIGN", True)
+    monkeypatch.setattr(BaseConfig, "LANDMARK_POOL_SIZE", 3)
+    monkeypatch.setattr(face_landmark, "_face_mesh", lambda: SimpleNamespace(FaceMesh=FakeFaceMesh))
+    monkeypatch.setattr(FaceRecogni, "INSTANCE", recogni)
+    monkeypatch.setattr(LandmarkDetector, "INSTANCE", None)
+
+    assert get_ready(application)["landmark"] is False
+    init_model(background=False)
+    detector = LandmarkDetector.INSTANCE
+    assert detector.ready and detector.pool._created == 3 and detector.pool._idle.qsize() == 3
+    body = get_ready(application)
+    assert body["model"] is True and body["landmark"] is True
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+from conftest import write_model_config
+
+
+class FakeRecogni:
+    input_shape = [112, 112, 3]
+    output_shape = [1, 8]
+    model_version = "target"
+
+    def predict(self, faces):
+        return np.stack([np.resize(np.asarray(face, dtype=np.float32).mean(axis=(0, 1)), 8) + 1 for face in faces])
+
+
+class UndetectedPipeline:
+    """
+    检测不到任何人脸的流水线
+    """
+
+    def __init__(self):
+        self.recogni = FakeRecogni()
+
+    def embed(self, faces):
+        return self.recogni.predict(faces)
+
+    def run(self, images):
+        from app.facelib.pipeline import PipelineResult
+        return PipelineResult(np.zeros((0, 8), dtype=np.float32), [], [], {})
+
+
+@pytest.fixture
+def source_rows(application, tmp_path, monkeypatch):
+    from app.config import BaseConfig
+    from app.extensions import db
+    from app.facelib.pipeline import encode_face
+    from app.models.models import Embedding
+
+    monkeypatch.setattr(BaseConfig, "FACE_RECOGNI_ACTIVE", str(tmp_path / "FaceRecogniModel.active"))
+    monkeypatch.setattr(BaseConfig, "FACE_RECOGNI_MODEL_PATH", write_model_config(str(tmp_path / "A")))
+    rng = np.random.default_rng(0)
+    # 两张已对齐的人脸，一张检测不到人脸的原图
+    images = [rng.integers(0, 256, shape, dtype=np.uint8) for shape in [(112, 112, 3), (112, 112, 3), (200, 160, 3)]]
+    with application.app_context():
+        rows = [Embedding(userId=user_id, embdBlob=np.zeros(8, dtype=np.float32).tobytes(),
+                          base64Img=encode_face(image), modelVersion="source")
+                for user_id, image in enumerate(images)]
+        db.session.add_all(rows)
+        db.session.commit()
+        uuids = [row.uuid for row in rows]
+        db.session.remove()
+    return uuids
+
+
+def test_undetectable_rows_reported_and_allowed_missing(application, tmp_path, source_rows):
+    from app.facelib.face_recogni import FaceRecogni
+    from app.facelib.reembed import ReembedJob
+
+    job = ReembedJob(UndetectedPipeline(), "source", str(tmp_path / "job.checkpoint"))
+    with application.app_context():
+        report = job.run()
+        assert report["remaining"] == 0 and report["failed"] == 1
+        assert report["failed_rows"] == [dict(uuid=source_rows[2], userId=2)]
+        assert report["users_missing"] == 1 and report["coverage"] < 1.0
+
+        model_root = str(tmp_path / "B")
+        assert not job.cutover(model_root)
+        assert job.cutover(model_root, allow_missing=1)
+    assert FaceRecogni.active_model_root() == model_root
+
+    # 从检查点恢复后仍然记录着失败的行
+    resumed = ReembedJob(UndetectedPipeline(), "source", str(tmp_path / "job.checkpoint"))
+    assert resumed.state["failed_uuids"] == [source_rows[2]]
+
+
+def test_fallback_embeds_unaligned_crop(application, tmp_path, source_rows):
+    from app.facelib.reembed import ReembedJob
+
+    job = ReembedJob(UndetectedPipeline(), "source", str(tmp_path / "job.checkpoint"), fallback=True)
+    with application.app_context():
+        report = job.run()
+        assert report["failed"] == 0 and report["failed_rows"] == [] and report["unaligned"] == 1
+        assert report["coverage"] == 1.0
+        assert job.cutover(str(tmp_path / "B"))
@@ -0,0 +1,60 @@
+import numpy as np
+
+from app.facelib.distance import l2_normalize
+from app.facelib.result_cache import ResultCache
+
+
+class FakeGallery:
+    metric = "l2"
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+
+    def user_embeddings(self, user_id):
+        return np.array([user_id]), self.embeddings[user_id:user_id + 1]
+
+
+def perturb(embeddings, distance, rng):
+    """
+    沿随机方向移动，正则化后与原特征的距离约为distance
+    """
+    noise = l2_normalize(rng.standard_normal(embeddings.shape)) * distance
+    return l2_normalize(embeddings + noise)
+
+
+def test_perturbed_queries_hit_within_tolerance():
+    rng = np.random.default_rng(0)
+    embeddings = l2_normalize(rng.standard_normal((50, 128)))
+    gallery = FakeGallery(embeddings)
+    cache = ResultCache(tolerance=0.4)
+    for user_id, embedding in enumerate(embeddings):
+        cache.put(embedding, user_id, user_id, scope=1)
+
+    for _ in range(5):
+        for user_id, query in enumerate(perturb(embeddings, 0.3, rng)):
+            result = cache.get(query, gallery, threshold=1.0, scope=1)
+            assert result is None or result[1] == user_id
+    assert cache.stats()["hit_rate"] >= 0.9
+
+    # 超出容差、其它检索范围都不使用缓存
+    hits = cache.hits
+    for user_id, query in enumerate(perturb(embeddings, 0.8, rng)):
+        assert cache.get(query, gallery, threshold=1.0, scope=1) is None
+        assert cache.get(embeddings[user_id], gallery, threshold=1.0, scope=2) is None
+    assert cache.hits == hits and cache.rejected == 0
+
+
+def test_rejected_entry_and_user_invalidation():
+    rng = np.random.default_rng(1)
+    embeddings = l2_normalize(rng.standard_normal((2, 64)))
+    cache = ResultCache()
+    cache.put(embeddings[0], 0, 0)
+    cache.put(embeddings[1], 1, 1)
+
+    # 缓存用户的特征已变更，确认距离未通过时删除该缓存
+    moved = FakeGallery(embeddings[::-1].copy())
+    assert cache.get(embeddings[0], moved, threshold=0.5) is None
+    assert cache.rejected == 1 and cache.stats()["size"] == 1
+
+    cache.invalidate_user(1)
+    assert cache.stats()["size"] == 0 and not cache._buckets and not cache._users
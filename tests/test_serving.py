@@ -0,0 +1,179 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from conftest import write_model_config, add_embeddings
+
+
+class FakeModel:
+    """
+    以像素均值作为特征，不加载模型文件，不同version的特征不同
+    """
+
+    def __init__(self, dim, version):
+        self.dim = dim
+        self.version = version
+
+    def __call__(self, faces):
+        n = len(faces)
+        pooled = faces.reshape(n, self.dim, -1).mean(axis=2)
+        return pooled + self.version * np.arange(1, self.dim + 1, dtype=np.float32)
+
+
+@pytest.fixture
+def serving_env(application, tmp_path, monkeypatch):
+    from app.config import BaseConfig
+    from app.facelib.face_recogni import FaceRecogni
+    from app.facelib.gallery import Gallery, ExamGalleryCache
+    from app.facelib.result_cache import ResultCache
+    from app.facelib.serving import Serving
+
+    monkeypatch.setattr(BaseConfig, "FACE_RECOGNI_ACTIVE", str(tmp_path / "FaceRecogniModel.active"))
+    monkeypatch.setattr(BaseConfig, "FACE_RECOGNI_MODEL_PATH", write_model_config(str(tmp_path / "A"), version=1))
+    monkeypatch.setattr(BaseConfig, "GALLERY_SNAPSHOT", False)
+    monkeypatch.setattr(BaseConfig, "GALLERY_INDEX", "flat")
+    monkeypatch.setattr(BaseConfig, "GALLERY_DTYPE", "float32")
+    monkeypatch.setattr(BaseConfig, "GALLERY_TEMPLATE", False)
+    monkeypatch.setattr(BaseConfig, "SEARCH_PROCESSES", 0)
+    monkeypatch.setattr(BaseConfig, "INFERENCE_BATCHING", False)
+    monkeypatch.setattr(FaceRecogni, "load_model",
+                        lambda self: FakeModel(self.output_shape[-1], self.config["version"]))
+    for cls in (Serving, FaceRecogni, Gallery, ExamGalleryCache, ResultCache):
+        monkeypatch.setattr(cls, "INSTANCE", None)
+    monkeypatch.setattr(Serving, "last_reload", {})
+    return tmp_path
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        assert time.perf_counter() < deadline
+        time.sleep(0.01)
+
+
+def test_reload_same_version_forwards_changes(application, serving_env):
+    from app.facelib.face_recogni import FaceRecogni
+    from app.facelib.serving import Serving
+
+    with application.app_context():
+        uuids, _ = add_embeddings([1, 2, 3], model_version=FaceRecogni.get_instance().model_version)
+        old = Serving.get_instance()
+
+    with Serving.use() as serving:
+        report = Serving.reload(application, preload=False)
+        serving.gallery.remove(uuids[:1])  # 切换后旧实例上的删除转发到新特征库
+    new = Serving.INSTANCE
+    assert report["status"] == "done" and report["in_flight"] == 1
+    assert new is not old and old.closed
+    assert sorted(new.gallery.uuids.tolist()) == sorted(uuids[1:].tolist())
+    assert "drain_ms" in report and report["swap_ms"] >= 0
+
+
+def test_reload_cross_version_reembeds_inflight_enrollment(application, serving_env):
+    from app.extensions import db
+    from app.facelib.face_recogni import FaceRecogni
+    from app.facelib.pipeline import encode_face, decode_face
+    from app.facelib.reembed import reembed_late
+    from app.facelib.serving import Serving
+    from app.models.models import Embedding
+
+    with application.app_context():
+        old = Serving.get_instance()
+        old_version = old.recogni.model_version
+    FaceRecogni.activate(write_model_config(str(serving_env / "B"), version=2))
+
+    entered, go = threading.Event(), threading.Event()
+    face = np.random.default_rng(0).integers(0, 256, (112, 112, 3), dtype=np.uint8)
+
+    def enroll():
+        # 切换前开始、切换后才提交的录入
+        with Serving.use() as serving:
+            assert not serving.enrollment_paused()
+            entered.set()
+            go.wait()
+            embedding = serving.recogni.predict(face[np.newaxis])
+            with application.app_context():
+                row = Embedding(userId=7, embdBlob=embedding[0].tobytes(), base64Img=encode_face(face),
+                                modelVersion=serving.recogni.model_version)
+                db.session.add(row)
+                db.session.commit()
+                uuid = row.uuid
+                db.session.remove()
+            serving.gallery.add([uuid], [7], embedding)
+
+    enrolling = threading.Thread(target=enroll)
+    enrolling.start()
+    entered.wait()
+    reloading = threading.Thread(target=Serving.reload, args=(application, False))
+    reloading.start()
+    wait_for(lambda: Serving.INSTANCE is not old)
+    new = Serving.INSTANCE
+    assert old.enrollment_paused() and not new.enrollment_paused()
+    go.set()
+    enrolling.join()
+    reloading.join()
+
+    report = Serving.last_reload
+    assert report["status"] == "done"
+    assert report["reembedded"] == 1 and report["reembed_failed"] == 0
+    assert Serving.pending_version is None and not old.enrollment_paused()
+    with application.app_context():
+        row = Embedding.query.filter_by(modelVersion=new.recogni.model_version).one()
+        assert row.userId == 7 and row.uuid in new.gallery.uuids.tolist()
+        # 使用新模型对保存的人脸重新编码
+        expected = new.recogni.predict(decode_face(row.base64Img)[np.newaxis])[0]
+        np.testing.assert_allclose(row.get_embedding(), expected, atol=1e-5)
+        assert not np.allclose(row.get_embedding(), old.recogni.predict(decode_face(row.base64Img)[np.newaxis])[0])
+        # 已重新编码的特征不会重复处理
+        assert reembed_late(new.pipeline(), new.gallery, old_version, 0) == (0, 0)
+    assert len(new.gallery) == 1
+
+
+def test_reload_with_batching(application, serving_env, monkeypatch):
+    from app.config import BaseConfig
+    from app.facelib.face_recogni import FaceRecogni
+    from app.facelib.serving import Serving
+
+    monkeypatch.setattr(BaseConfig, "INFERENCE_BATCHING", True)
+    face = np.random.default_rng(0).integers(0, 256, (1, 112, 112, 3), dtype=np.uint8)
+    with application.app_context():
+        old = Serving.get_instance()
+    old.recogni.preload()  # 启动时预加载并启用微批处理
+    assert old.recogni.batcher is not None
+    FaceRecogni.activate(write_model_config(str(serving_env / "B"), version=2))
+    # 与接口相同，在后台线程中完成热切换
+    reloading = threading.Thread(target=Serving.reload, args=(application, True))
+    reloading.start()
+    reloading.join(timeout=30)
+    assert not reloading.is_alive() and Serving.last_reload["status"] == "done"
+
+    new = Serving.INSTANCE
+    assert new is not old and old.closed and not old.recogni.batcher._thread.is_alive()
+    before = new.recogni.batcher.requests
+    np.testing.assert_allclose(new.recogni.predict(face), new.recogni.forward(new.recogni.preprocessing(face)),
+                               atol=1e-5)
+    assert new.recogni.batcher.requests == before + 1
+    new.close()
+
+
+def test_init_gallery_refuses_unversioned_rows(application, serving_env):
+    from app import init_gallery
+    from app.extensions import db
+    from app.facelib.face_recogni import FaceRecogni
+    from app.facelib.gallery import Gallery
+    from app.models.models import Embedding
+
+    with application.app_context():
+        uuids, _ = add_embeddings([1, 2, 3])  # 迁移前没有模型版本的旧特征
+    with pytest.raises(SystemExit):
+        init_gallery(application)
+    assert Gallery.INSTANCE is None
+
+    with application.app_context():
+        model_version = FaceRecogni.get_instance().model_version
+        Embedding.query.update({Embedding.modelVersion: model_version})
+        db.session.commit()
+    init_gallery(application)
+    assert sorted(Gallery.INSTANCE.uuids.tolist()) == sorted(uuids.tolist())
@@ -0,0 +1,103 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+import numpy as np
+import pytest
+
+ROOT = os.path.join(os.path.dirname(__file__), os.path.pardir)
+
+
+@pytest.fixture
+def engine():
+    from app.facelib.gallery import Gallery
+    from app.facelib.sharded import ShardedSearchEngine
+
+    embeddings = np.random.default_rng(0).standard_normal((64, 8)).astype(np.float32)
+    gallery = Gallery()
+    gallery.add(np.arange(64), np.arange(64) % 8, embeddings)
+    engine = ShardedSearchEngine(gallery, workers=2, min_size=0)
+    yield engine, embeddings
+    engine.close()
+
+
+def test_search_matches_gallery(engine):
+    engine, embeddings = engine
+    uuids, _, dists = engine.search_batch(embeddings[:4], k=3)
+    expected_uuids, _, expected_dists = engine.gallery.search_batch(embeddings[:4], k=3)
+    np.testing.assert_array_equal(uuids, expected_uuids)
+    np.testing.assert_allclose(dists, expected_dists, atol=1e-4)
+
+
+def test_retired_generations_released_after_last_search(engine):
+    engine, embeddings = engine
+    # 两个未结束的检索分别使用两代共享内存
+    first = engine._sync()[0]
+    engine.gallery.remove([0])
+    second = engine._sync()[0]
+    engine.gallery.remove([1])
+    engine.search_batch(embeddings[:1])
+    assert first != second and set(engine._retired) == {first, second}
+
+    engine._release(second)
+    assert set(engine._retired) == {first}
+    engine._release(first)
+    assert not engine._retired and not engine._refs
+    uuids, _, _ = engine.search_batch(embeddings[:3])
+    assert uuids[2, 0] == 2
+
+
+# monkey patch只能在新进程中启用
+GEVENT_SEARCH = textwrap.dedent("""
+    from gevent import monkey
+    monkey.patch_all()
+    import sys
+    sys.path.insert(0, sys.argv[1])
+    import gevent
+    import numpy as np
+    from app.facelib.executor import run_search
+    from app.facelib.gallery import Gallery
+    from app.facelib.sharded import ShardedSearchEngine
+
+    if __name__ == "__main__":
+        embeddings = np.random.default_rng(0).standard_normal((2000, 16)).astype(np.float32)
+        gallery = Gallery()
+        gallery.add(np.arange(2000), np.arange(2000) % 8, embeddings)
+        engine = ShardedSearchEngine(gallery, workers=2, min_size=0)
+
+        def search(i):
+            queries = embeddings[i * 4:i * 4 + 4]
+            for _ in range(5):
+                uuids, _, _ = run_search(engine.search_batch, queries, 3)
+                assert uuids[:, 0].tolist() == list(range(i * 4, i * 4 + 4)), uuids
+            return True
+
+        # 多个检索线程同时提交与等待
+        with gevent.Timeout(60):
+            assert all(job.get() for job in [gevent.spawn(search, i) for i in range(6)])
+            engine.close()
+        print("ok")
+""")
+
+
+def test_concurrent_search_with_gevent(tmp_path):
+    pytest.importorskip("gevent")
+    script = tmp_path / "search.py"  # spawn的工作进程需要导入主模块
+    script.write_text(GEVENT_SEARCH)
+    result = subprocess.run([sys.executable, str(script), ROOT], capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stderr[-2000:]
+    assert result.stdout.strip().endswith("ok")
+
+
+def test_quantized_gallery_rejected_at_startup(application, monkeypatch):
+    from app import init_gallery
+    from app.config import BaseConfig
+    from app.facelib.gallery import Gallery
+
+    monkeypatch.setattr(BaseConfig, "SEARCH_PROCESSES", 2)
+    monkeypatch.setattr(BaseConfig, "GALLERY_DTYPE", "int8")
+    monkeypatch.setattr(Gallery, "INSTANCE", None)
+    with pytest.raises(SystemExit):
+        init_gallery(application)
+    assert Gallery.INSTANCE is None
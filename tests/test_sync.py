@@ -0,0 +1,96 @@
+import sys
+import threading
+
+import numpy as np
+import pytest
+
+from conftest import add_embeddings
+
+
+class SizeObserver:
+    """
+    记录通知时特征库的大小，通知在持有锁时发出，不能回调Gallery
+    """
+
+    def __init__(self, gallery):
+        self.gallery = gallery
+        self.sizes = []
+
+    def add(self, uuids, user_ids, embeddings):
+        self.sizes.append(self.gallery._size)
+
+    def remove(self, uuids):
+        self.sizes.append(self.gallery._size)
+
+    def reset(self):
+        self.sizes.append(self.gallery._size)
+
+
+@pytest.mark.parametrize("dtype", ["float32", "int8"])
+def test_reload_never_exposes_empty_gallery(application, monkeypatch, dtype):
+    from app.facelib.ann import IVFIndex
+    from app.facelib.gallery import Gallery
+    from app.facelib.sync import GallerySync
+
+    with application.app_context():
+        uuids, embeddings = add_embeddings(list(range(200)))
+        gallery = Gallery(dtype=dtype).load_from_db()
+    if gallery.quantized:
+        from app.facelib.quantize import ArrayVectors
+        gallery.rerank_source = ArrayVectors(uuids, embeddings)
+    gallery.set_index(IVFIndex(nlist=4, nprobe=4).build(gallery.embeddings))
+    observer = SizeObserver(gallery)
+    gallery.observers.append(observer)
+    monkeypatch.setattr(Gallery, "INSTANCE", gallery)
+    sync = GallerySync(None, application)
+
+    stop, empty = threading.Event(), []
+
+    def search():
+        while not stop.is_set():
+            try:
+                found, _, _ = gallery.search(embeddings[0])
+            except Exception as e:
+                found = e
+            if not isinstance(found, np.ndarray) or len(found) == 0 or found[0] != uuids[0]:
+                empty.append(found)
+
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    reader = threading.Thread(target=search)
+    reader.start()
+    try:
+        for _ in range(20):
+            sync.reload()
+    finally:
+        stop.set()
+        reader.join()
+        sys.setswitchinterval(interval)
+
+    assert not empty
+    assert observer.sizes and min(observer.sizes) == len(uuids)
+    assert sync.reloads == 20 and len(gallery.index) == len(gallery) == len(uuids)
+
+    # 重新加载后包含数据库中新增的特征
+    with application.app_context():
+        added, _ = add_embeddings([500], seed=1)
+    sync.reload()
+    assert added[0] in gallery.uuids.tolist() and len(gallery.index) == len(gallery)
+
+
+@pytest.mark.parametrize("dtype", ["float32", "int8"])
+def test_load_snapshot_never_exposes_empty_gallery(application, tmp_path, dtype):
+    from app.facelib.gallery import Gallery
+    from app.facelib.snapshot import GallerySnapshot
+
+    with application.app_context():
+        uuids, embeddings = add_embeddings(list(range(50)))
+        gallery = Gallery(dtype=dtype).load_from_db()
+        add_embeddings([100, 101], seed=1)  # 快照包含新增的特征
+        observer = SizeObserver(gallery)
+        gallery.observers.append(observer)
+        gallery.load_snapshot(GallerySnapshot(str(tmp_path / "gallery.snapshot")))
+    assert observer.sizes and min(observer.sizes) == len(uuids) + 2
+    assert len(gallery) == len(uuids) + 2
+    found, _, _ = gallery.search(embeddings[3])
+    assert found[0] == uuids[3]